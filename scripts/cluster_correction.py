@@ -0,0 +1,202 @@
+# Cluster correction of every randomise tstat map of an analysis at several thresholds in one run (instead of calling
+# run_cluster_correction.sh once per map and threshold, which runs smoothest and fsl-cluster each time)
+# Each map is read once and its smoothness estimated once (as smoothest -z does, from the correlation of neighbouring
+# voxels in the mask), then for every threshold the clusters are found (26 connectivity, as fsl-cluster) and given
+# their Gaussian random field p-value (as fsl-cluster -p, treating the threshold as a z value). The clusters with
+# p < --pval are saved as the index and thresholded images with the names run_cluster_correction.sh uses (with _t and
+# the threshold added when several thresholds are given), and all of the clusters go in one table for the analysis
+#
+# example command: python scripts/cluster_correction.py Imm_Detail --thresholds 2.41 3.1
+# or only some of the maps: python scripts/cluster_correction.py Imm_Detail --maps all_group_3_tstat1 comp_3_tstat1
+#
+# 10182026
+
+import os
+import re
+import glob
+import math
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import ndimage, special, stats
+from multiprocessing import Pool
+
+# base directory
+base_dir='' # ommitted for privacy
+
+# where do randomise files live?
+randomise_dir='%s/data/randomise' % base_dir
+
+# what is the intersect mask?
+mask_file='%s/data/intersect_mask.nii.gz' % base_dir
+
+# set some criteria for the analysis (as in run_cluster_correction.sh)
+pval=0.05 # p < .05
+tval=2.41 # equal to p < .01 for an N of 46
+
+# fsl-cluster forms clusters with 26 connectivity
+cluster_structure=ndimage.generate_binary_structure(3,3)
+
+######################################################################################
+####### Finding the maps
+
+def find_maps(analysis_type):
+    # the tstat maps randomise saved for an analysis, as (root, tstat), e.g., ('all_group_3', 'tstat1'), leaving out
+    # its p-value maps (e.g., all_group_3_tfce_corrp_tstat1) and our own thresholded maps
+    maps=[]
+    for file_name in sorted(glob.glob('%s/%s/*_tstat*.nii.gz' %(randomise_dir,analysis_type))):
+        match=re.match(r'(.+)_(tstat\d+)\.nii\.gz$',os.path.basename(file_name))
+        if match is None or re.search(r'_(p|corrp|cluster_manual)$',match.group(1)):
+            continue
+        maps.append((match.group(1),match.group(2)))
+
+    return maps
+
+def output_names(analysis_type,root,tstat,threshold,several_thresholds):
+    # the index image, thresholded image (without .nii.gz) as in run_cluster_correction.sh
+    thresh_suffix='_t%g' % threshold if several_thresholds else ''
+    return ('%s/%s/%s_%s_cluster_index%s' %(randomise_dir,analysis_type,root,tstat,thresh_suffix),
+            '%s/%s/%s_cluster_manual_%s%s' %(randomise_dir,analysis_type,root,tstat,thresh_suffix))
+
+######################################################################################
+####### Smoothness and cluster p-values
+
+def estimate_smoothness(stat_volume,mask):
+    # the smoothness of a statistic map in the mask, as smoothest -z: in each direction, the correlation of the
+    # neighbouring voxels that are both in the mask gives the variance of the Gaussian kernel (in voxels)
+    # returns DLH, VOLUME (voxels in the mask), and RESELS (the size of a resel, in voxels)
+    sigmasq=[]
+    for axis in range(3):
+        first=[slice(None)]*3
+        second=[slice(None)]*3
+        first[axis]=slice(None,-1)
+        second[axis]=slice(1,None)
+        pairs=mask[tuple(first)] & mask[tuple(second)]
+        values, neighbours=stat_volume[tuple(first)][pairs], stat_volume[tuple(second)][pairs]
+        ss_minus=np.mean(values*neighbours)
+        s2=np.mean((values**2+neighbours**2)/2)
+        sigmasq.append(-1/(4*math.log(abs(ss_minus/s2))))
+
+    dlh=(sigmasq[0]*sigmasq[1]*sigmasq[2])**-0.5*8**-0.5
+    resels=np.prod([math.sqrt(8*math.log(2)*s) for s in sigmasq])
+
+    return dlh, int(mask.sum()), resels
+
+def cluster_p(n_voxels,threshold,dlh,volume):
+    # the Gaussian random field p-value of a cluster of n voxels above a z threshold (as fsl-cluster, 3D): the
+    # expected number of clusters (Em) and of voxels above the threshold (EN) give the chance of a cluster this big
+    # returns p and -log10(p), which for big clusters is worked out in log space (p itself rounds to 0)
+    if threshold <= 1:
+        raise ValueError('the cluster forming threshold has to be above 1 (got %g)' % threshold)
+    D=3
+    Em=volume*(2*math.pi)**(-(D+1)/2)*dlh*(threshold**2-1)**((D-1)/2)*math.exp(-threshold**2/2)
+    EN=volume*stats.norm.sf(threshold)
+    beta=(special.gamma(D/2+1)*Em/EN)**(2/D)
+
+    # p = 1 - exp(-Em exp(-beta n^(2/D))), which is Em exp(-beta n^(2/D)) when that is tiny
+    log_x=math.log(Em)-beta*n_voxels**(2/D)
+    p=-math.expm1(-math.exp(log_x))
+    minus_log10_p=-math.log10(p) if log_x > -20 else -log_x/math.log(10)
+
+    return p, minus_log10_p
+
+def find_clusters(stat_volume,threshold,dlh,volume,affine,max_p=pval):
+    # the clusters of voxels at or above the threshold with p < max_p, numbered from the smallest (1) to the biggest
+    # as fsl-cluster does; returns the index image and a table row per cluster (the biggest first, coordinates in mm)
+    labels, n_clusters=ndimage.label(stat_volume >= threshold,cluster_structure)
+    sizes=np.bincount(labels.ravel(),minlength=n_clusters+1)[1:]
+    p_values, minus_log10_p=np.array([cluster_p(size,threshold,dlh,volume) for size in sizes]).reshape(-1,2).T
+
+    # keep the significant clusters, smallest first
+    kept=[label+1 for label in np.argsort(sizes,kind='stable') if p_values[label] < max_p]
+    index=np.zeros(labels.shape,dtype=np.int16)
+    rows=[]
+    for cluster_index, label in enumerate(kept,start=1):
+        in_cluster=labels==label
+        index[in_cluster]=cluster_index
+        voxels=np.argwhere(in_cluster)
+        values=stat_volume[in_cluster]
+        peak=nib.affines.apply_affine(affine,voxels[np.argmax(values)])
+        # the centre of gravity is weighted by the statistic
+        cog=nib.affines.apply_affine(affine,np.average(voxels,axis=0,weights=values))
+        rows.append({'Cluster Index': cluster_index, 'Voxels': len(voxels), 'P': p_values[label-1],
+                     '-log10(P)': minus_log10_p[label-1],
+                     'MAX': values.max(), 'MAX X (mm)': peak[0], 'MAX Y (mm)': peak[1], 'MAX Z (mm)': peak[2],
+                     'COG X (mm)': cog[0], 'COG Y (mm)': cog[1], 'COG Z (mm)': cog[2]})
+
+    return index, rows[::-1]
+
+######################################################################################
+####### Running them all
+
+def correct_map(analysis_type,root,tstat,thresholds,mask,max_p=pval):
+    # cluster correct one tstat map at every threshold; returns its rows of the table
+    stat_nii=nib.load('%s/%s/%s_%s.nii.gz' %(randomise_dir,analysis_type,root,tstat))
+    stat_volume=np.asarray(stat_nii.dataobj,dtype=np.float64)
+    dlh, volume, resels=estimate_smoothness(stat_volume,mask)
+    print('%s_%s: DLH %f VOLUME %d RESELS %f' %(root,tstat,dlh,volume,resels))
+
+    rows=[]
+    for threshold in thresholds:
+        index, clusters=find_clusters(stat_volume,threshold,dlh,volume,stat_nii.affine,max_p)
+        output_index, output_thresh=output_names(analysis_type,root,tstat,threshold,len(thresholds) > 1)
+
+        index_nii=nib.Nifti1Image(index,stat_nii.affine,header=stat_nii.header)
+        index_nii.set_data_dtype(np.int16)
+        nib.save(index_nii,output_index+'.nii.gz')
+        thresh_nii=nib.Nifti1Image(np.where(index > 0,stat_volume,0).astype(np.float32),stat_nii.affine,
+                                   header=stat_nii.header)
+        thresh_nii.set_data_dtype(np.float32)
+        nib.save(thresh_nii,output_thresh+'.nii.gz')
+
+        for cluster in clusters:
+            rows.append(dict({'map': '%s_%s' %(root,tstat), 'threshold': threshold, 'DLH': dlh, 'VOLUME': volume,
+                              'RESELS': resels}, **cluster))
+        print('%s_%s at %g: %d clusters with p < %g' %(root,tstat,threshold,len(clusters),max_p))
+
+    return rows
+
+def correct_maps(analysis_type,maps,thresholds,max_p=pval,n_jobs=1):
+    # cluster correct every map (in parallel) and save one table of all of the clusters for the analysis
+    mask=np.asarray(nib.load(mask_file).dataobj) > 0
+    with Pool(n_jobs) as pool:
+        map_rows=pool.starmap(correct_map,[(analysis_type,root,tstat,thresholds,mask,max_p) for root, tstat in maps])
+
+    table=pd.DataFrame([row for rows in map_rows for row in rows],
+                       columns=['map','threshold','DLH','VOLUME','RESELS','Cluster Index','Voxels','P','-log10(P)',
+                                'MAX','MAX X (mm)','MAX Y (mm)','MAX Z (mm)','COG X (mm)','COG Y (mm)','COG Z (mm)'])
+    table_file='%s/%s/cluster_manual_table.csv' %(randomise_dir,analysis_type)
+    table.to_csv(table_file,index=False)
+    print('Saved %d clusters from %d maps to %s' %(len(table),len(maps),table_file))
+
+    return table
+
+def cluster_threshold(value):
+    # a threshold for argparse (the random field p-values need a z above 1)
+    threshold=float(value)
+    if threshold <= 1:
+        raise argparse.ArgumentTypeError('cluster forming thresholds have to be above 1 (got %s)' % value)
+    return threshold
+
+if __name__ == '__main__':
+    # take the inputs
+    parser = argparse.ArgumentParser(description='Cluster correct the randomise tstat maps of an analysis')
+    parser.add_argument('analysis_type', help='For instance "FaceObject" or "trialwise_detailed"')
+    parser.add_argument('--maps', nargs='+',
+                        help='only these maps (e.g., all_group_3_tstat1; default: every tstat map of the analysis)')
+    parser.add_argument('--thresholds', nargs='+', default=[tval], type=cluster_threshold,
+                        help='cluster forming thresholds (default: %g)' % tval)
+    parser.add_argument('--pval', default=pval, type=float, help='keep clusters below this p (default: %g)' % pval)
+    parser.add_argument('--n-jobs', default=int(os.environ.get('SLURM_CPUS_PER_TASK',os.cpu_count())), type=int,
+                        help='maps to correct at once (default: the cores slurm gives the job, or all)')
+    args = parser.parse_args()
+
+    maps=find_maps(args.analysis_type)
+    if args.maps is not None:
+        maps=[(root,tstat) for root, tstat in maps if '%s_%s' %(root,tstat) in args.maps]
+    if len(maps)==0:
+        parser.error('no tstat maps found in %s/%s' %(randomise_dir,args.analysis_type))
+
+    table=correct_maps(args.analysis_type,maps,args.thresholds,args.pval,args.n_jobs)
+    print(table.to_string(index=False))
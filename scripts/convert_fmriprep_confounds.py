@@ -1,84 +1,168 @@
 # Script to convert large fmriprep confounds file into the relevant columns to be used for analyses
 #
 # example command: python scripts/convert_fmriprep_confounds.py 002 memory_run-1
-# 
-# Re-organized to be its own script 02/15/2025 TY  
+# or for every subject and run in fmriprep_memory: python scripts/convert_fmriprep_confounds.py --all
+#
+# Re-organized to be its own script 02/15/2025 TY
+# Batch mode (in parallel, only reading the columns we use, skipping runs that have not changed) 10182026
 
 import numpy as np
 import pandas as pd
 import os
-import sys
+import re
+import glob
+import json
+import fcntl
+import argparse
+from multiprocessing import Pool
 
-# Set some paths 
-base_dir='' # omitted for privacy 
+# Set some paths
+base_dir='' # omitted for privacy
 fmriprep_path = '%s/data/fmriprep_memory/' % base_dir
 
-# set some paramenters 
-burn_in_TRs=4 # remove this number of TRs before analysis 
-motion_threshold=0.9 # motion threshold for main analyses 
-
-# take some inputs 
-# first, which participant?
-ppt=sys.argv[1] # numbers only, e.g., 002 
-elfk_id='EL%s' % ppt # name with EL prefix (used in raw data)
-sub_id='sub-%s' % ppt # name with sub- prefix (used in fmriprep) 
-
-# then, which task? 
-task=sys.argv[2] # memory_run-1, rest_run-1, rest_run-2
-
-# what is the confound file suffix? 
-confounds_suffix = 'task-%s_desc-confounds_timeseries.tsv' % task
-
-# get the full path to the confounds 
-# NOTE: for one subject, the rest run after encoding was actually rest run 3, so clarify that
-if elfk_id =='EL141' and task=='rest_run-2':
-    fmriprep_confs ='%s/%s/func/%s_%s' % (fmriprep_path,sub_id,sub_id,'task-rest_run-3_desc-confounds_timeseries.tsv')    
-else:
-    fmriprep_confs ='%s/%s/func/%s_%s' % (fmriprep_path,sub_id,sub_id,confounds_suffix)
-
-# load as pandas data frame
-all_confs_df = pd.read_csv(fmriprep_confs,delimiter='\t')
-
-# remove 4 volumes of burn-in (as we did for the functionals)
-all_confs_df = all_confs_df[burn_in_TRs:]
-
-# get only the FD motion outliers (and not the dvars one) that exceed the threshold 
-motion_outlier_columns = [val for val in all_confs_df.columns if 'motion_outlier' in val]
-subset_motion_outliers = []
-for motion_out in motion_outlier_columns:
-    # Get the timepoints where this motion outlier is flagged
-    flagged_timepoints = all_confs_df[motion_out] == 1
-    if flagged_timepoints.any():
-        # Get the FD values for those timepoints
-        fd_values = all_confs_df.loc[flagged_timepoints, 'framewise_displacement']
-        # Check if any of the FD values exceed the threshold
-        if (fd_values > motion_threshold).any():
-            subset_motion_outliers.append(motion_out)
-
-
-#### GLM analysis confound file 
-# append to the translation and rotation
-motion_columns = np.hstack((['trans_x','trans_y','trans_z',
-                 'rot_x','rot_y','rot_z',
-                'trans_x_derivative1','trans_y_derivative1','trans_z_derivative1',
-                'rot_x_derivative1','rot_y_derivative1','rot_z_derivative1',
-                             'white_matter','csf'],subset_motion_outliers))
-# make the df and save it
-motion_confounds_df = all_confs_df[motion_columns]
-np.savetxt('%s/%s/func/%s_task-%s_glm_confounds.txt' % (fmriprep_path,sub_id,sub_id,task),
-                np.array(motion_confounds_df),)
-
-
-#### Similarity analysis (MVPA) confound file 
-cosines = [col for col in all_confs_df.columns if 'cosine' in col] ## cosine numbers could vary! 
-# append to the translation and rotation
-motion_columns = np.hstack((['trans_x','trans_y','trans_z',
-                 'rot_x','rot_y','rot_z',
+# set some paramenters
+burn_in_TRs=4 # remove this number of TRs before analysis
+motion_threshold=0.9 # motion threshold for main analyses
+
+# the columns we use (besides the cosines and motion outliers, which vary in number)
+motion_columns=['trans_x','trans_y','trans_z',
+                'rot_x','rot_y','rot_z',
                 'trans_x_derivative1','trans_y_derivative1','trans_z_derivative1',
                 'rot_x_derivative1','rot_y_derivative1','rot_z_derivative1',
-                             'white_matter','csf'],cosines,subset_motion_outliers))
+                'white_matter','csf']
+
+# where the batch mode remembers what each output was made from
+stamps_file='%s/confounds_stamps.json' % fmriprep_path
+
+# NOTE: for one subject, the rest run after encoding was actually rest run 3 (participant: (task, fmriprep task))
+renamed_runs={'141': ('rest_run-2','rest_run-3')}
+
+def confounds_file(ppt,task):
+    # get the full path to the confounds
+    # (for one subject, the rest run after encoding was actually rest run 3, so clarify that)
+    sub_id='sub-%s' % ppt # name with sub- prefix (used in fmriprep)
+    if ppt in renamed_runs and task==renamed_runs[ppt][0]:
+        task=renamed_runs[ppt][1]
+
+    return '%s/%s/func/%s_task-%s_desc-confounds_timeseries.tsv' % (fmriprep_path,sub_id,sub_id,task)
+
+def output_files(ppt,task):
+    # the GLM and similarity analysis (MVPA) confound files of a run
+    sub_id='sub-%s' % ppt
+    return ['%s/%s/func/%s_task-%s_%s_confounds.txt' % (fmriprep_path,sub_id,sub_id,task,analysis)
+            for analysis in ['glm','mvpa']]
+
+def find_runs():
+    # every subject and run with a confounds file in fmriprep_memory (e.g., ('002','memory_run-1')), with the task
+    # names that the single run mode (and the analyses) use, so both modes make the same files
+    runs=[]
+    for file_name in sorted(glob.glob('%s/sub-*/func/sub-*_task-*_desc-confounds_timeseries.tsv' % fmriprep_path)):
+        match=re.search(r'sub-([^_/]+)_task-(.+)_desc-confounds_timeseries\.tsv$',file_name)
+        ppt, task=match.group(1), match.group(2)
+        if ppt in renamed_runs and task==renamed_runs[ppt][1]:
+            task=renamed_runs[ppt][0]
+        # (a run that is never used because another run takes its name is left out)
+        if os.path.normpath(confounds_file(ppt,task))==os.path.normpath(file_name):
+            runs.append((ppt,task))
+
+    return runs
+
+def load_confounds(file_name):
+    # load only the columns we use (the header is read first, since the number of cosines and outliers varies)
+    with open(file_name) as f:
+        header=f.readline().rstrip('\n').split('\t')
+    columns=[col for col in header if col in motion_columns or col=='framewise_displacement' or 'cosine' in col or
+             'motion_outlier' in col]
+
+    # remove the volumes of burn-in (as we did for the functionals)
+    return pd.read_csv(file_name,delimiter='\t',usecols=columns)[columns][burn_in_TRs:]
+
+def fd_outliers(all_confs_df):
+    # get only the FD motion outliers (and not the dvars one) that exceed the threshold
+    # i.e., the outlier columns flagging at least one timepoint whose FD is over the threshold
+    motion_outlier_columns = [val for val in all_confs_df.columns if 'motion_outlier' in val]
+    flagged_timepoints = all_confs_df[motion_outlier_columns].values == 1
+    high_fd = (all_confs_df['framewise_displacement'].values > motion_threshold)[:,None]
+
+    return [col for col, keep in zip(motion_outlier_columns,(flagged_timepoints & high_fd).any(axis=0)) if keep]
+
+def convert_confounds(ppt,task):
+    # write the GLM and MVPA confound files of a run
+    all_confs_df = load_confounds(confounds_file(ppt,task))
+    subset_motion_outliers = fd_outliers(all_confs_df)
+    cosines = [col for col in all_confs_df.columns if 'cosine' in col] ## cosine numbers could vary!
+    glm_file, mvpa_file = output_files(ppt,task)
+
+    #### GLM analysis confound file
+    np.savetxt(glm_file,np.array(all_confs_df[motion_columns+subset_motion_outliers]),)
+
+    #### Similarity analysis (MVPA) confound file
+    np.savetxt(mvpa_file,np.array(all_confs_df[motion_columns+cosines+subset_motion_outliers]),)
+
+    return ppt, task
+
+def file_stamp(file_name):
+    # what we check to know whether a file has changed
+    file_stat=os.stat(file_name)
+    return dict(size=file_stat.st_size, mtime=file_stat.st_mtime)
+
+def run_stamp(ppt,task):
+    # what the outputs of a run depend on: its confounds file and the settings
+    return dict(source=file_stamp(confounds_file(ppt,task)), burn_in_TRs=burn_in_TRs,
+                motion_threshold=motion_threshold)
+
+def load_stamps():
+    if os.path.exists(stamps_file):
+        with open(stamps_file) as f:
+            return json.load(f)
+    return dict()
+
+def update_stamps(new_stamps):
+    # add the stamps of the runs just converted (locked, since several single runs can be converted at once, e.g., by
+    # feat_pipeline.py)
+    with open(stamps_file+'.lock','w') as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        stamps=load_stamps()
+        stamps.update(new_stamps)
+
+        # write to a temporary file first so a half-written file is never used
+        with open(stamps_file+'.tmp','w') as f:
+            json.dump(stamps,f,indent=1)
+        os.replace(stamps_file+'.tmp',stamps_file)
+
+def convert_all(n_jobs=1,force=False):
+    # convert every run in fmriprep_memory whose confounds (or the settings) changed since it was last converted
+    stamps=load_stamps()
+
+    runs=find_runs()
+    to_convert=[]
+    for ppt, task in runs:
+        key='sub-%s_task-%s' % (ppt,task)
+        if force or stamps.get(key) != run_stamp(ppt,task) or \
+                not all(os.path.exists(file_name) for file_name in output_files(ppt,task)):
+            to_convert.append((ppt,task))
+    print('Converting %d of %d runs' % (len(to_convert),len(runs)))
+
+    with Pool(n_jobs) as pool:
+        converted=pool.starmap(convert_confounds,to_convert)
+    update_stamps({'sub-%s_task-%s' % (ppt,task): run_stamp(ppt,task) for ppt, task in converted})
+
+if __name__ == '__main__':
+    # take some inputs
+    parser = argparse.ArgumentParser(description='Make the GLM and MVPA confound files from the fmriprep confounds')
+    parser.add_argument('ppt', nargs='?', help='numbers only, e.g., 002')
+    parser.add_argument('task', nargs='?', help='memory_run-1, rest_run-1, rest_run-2')
+    parser.add_argument('--all', action='store_true', help='every subject and run in fmriprep_memory')
+    parser.add_argument('--n-jobs', default=int(os.environ.get('SLURM_CPUS_PER_TASK',os.cpu_count())), type=int,
+                        help='runs to convert at once with --all (default: the cores slurm gives the job, or all)')
+    parser.add_argument('--force', action='store_true', help='with --all, convert runs even if they have not changed')
+    args = parser.parse_args()
 
-# make the df and save it
-motion_confounds_df = all_confs_df[motion_columns]
-np.savetxt('%s/%s/func/%s_task-%s_mvpa_confounds.txt' % (fmriprep_path,sub_id,sub_id,task),
-                np.array(motion_confounds_df),)
+    if args.all:
+        convert_all(args.n_jobs,args.force)
+    elif args.ppt is not None and args.task is not None:
+        convert_confounds(args.ppt,args.task)
+        # so --all knows this run is up to date
+        update_stamps({'sub-%s_task-%s' % (args.ppt,args.task): run_stamp(args.ppt,args.task)})
+    else:
+        parser.error('give a participant and a task, or --all')
@@ -1,190 +1,199 @@
 # Create group randomise files without having to open the FSL GUI
-# This creates a .txt file of participant names, and .mat and .con files to then provide to FSL randomise 
+# This creates a .txt file of participant names, and .mat and .con files to then provide to FSL randomise
 # These allow the possibility of looking at covariates for age and overall memory performance (z-scored within group) as well
+# Any number of groups, analyses, and memory types can be given at once (separated by commas), and a file is only
+# rewritten if its contents changed, so the merged data and randomise are not redone for nothing. The participant
+# list and the group and age designs do not depend on the memory type, and a participant left out for one memory type
+# only (e.g., sub-134 for recognition) is only left out of its memory design, which has its own participant list
 #
-# V1 02/17/2025 
+# example command: python scripts/create_randomise_group_files.py all,comp,pi Imm_Detail,trialwise_detailed
+#     detailed_assoc_imm,hit_rates_imm
+#
+# V1 02/17/2025
+# All combinations in one run 10182026
 
-# Import a few things 
+# Import a few things
 import numpy as np
 import pandas as pd
 import os
-import sys
+import argparse
 import scipy.stats as stats
 
 # set the base dir
 base_dir='' # ommitted for privacy
 
-# first read in the participant information (created separately) 
-data_df=pd.read_csv('%s/data/memory_fmri_data.csv' %base_dir,index_col=0)
-
-# Take the inputs from the command line 
-suffix=sys.argv[1] # 'all' 'comp' 'pi' 
-analysis_type=sys.argv[2] # 'FaceObject' 'Imm_Detail' 'Imm_Recognition' 'trialwise_detailed' 'trialwise_recognition'
-mem_type=sys.argv[3] #'hit_rates_imm' 'detailed_assoc_imm'
-
-# set a shorter suffix for save files 
-if mem_type=='detailed_assoc_imm':
-    mem_suffix='detailed' 
-else:
-    mem_suffix='recog'
-    
-# what is the value we are looking for in the pi_status column?
-if suffix=='comp':
-    group_val=0
-elif suffix=='pi':
-    group_val=1
-    
-# preset
-memory=[]
-ages=[]
-usable_subs=[]
-
-# cycle through the participants in the data frame
-for s, sub_id in enumerate(data_df.sub_ids):
-
-    # if you are getting all subjects, or this subject is in the group
-    if suffix=='all' or float(data_df.pi_status[data_df.sub_ids==sub_id])==group_val:
-        
-        # we know we cannot include this subject for this analysis 
-        if sub_id=='sub-134' and mem_suffix=='recog':
-            print('skipping %s for having perfect memory' % sub_id)
-            continue
-
-        # check whether this is an encoding or reinstatement anlaysis 
-        if 'trialwise' in analysis_type:
-            inclusion = data_df.included_reinstatement[s]
-        else:
-            inclusion = data_df.included_encoding[s]
-            
-        # don't include this subject if they aren't supposed to be
-        if inclusion ==0:
-            print('not including %s ' % sub_id)
-            continue
-
-        # append memory, age, and id 
-        memory.append(data_df[mem_type][s])
-        ages.append(data_df.ages[s])
-        usable_subs.append(sub_id.split('sub-')[-1])
-
-# z-score the values for just this group of subjects 
-zscored_mem=stats.zscore(memory)
-zscored_age=stats.zscore(ages)
-
-# print how many subjects are included 
-print(len(zscored_age))
-
-# First save a list of the participant IDs 
-np.savetxt('%s/randomise_group_files/%s_%s.txt' %(base_dir,suffix,analysis_type),usable_subs,fmt='%s')
-
-# Then we will fill out the randomise . mat files for having age as a covariate 
-all_text = [] 
-
-# The header includes information about the contrasts --- if you are looking at all subjects, also include the two groups
-if suffix=='all':
-    file_name='%s/randomise_group_files/%s_%s_group.mat' %(base_dir,suffix,analysis_type)
-    # NOTE the ppheights don't matter for running randomise analysis 
-    all_text.append('/NumWaves\t3\n/NumPoints\t%d\n/PPheights\n\n/Matrix' % (len(usable_subs)))
-
-else:
-    file_name='%s/randomise_group_files/%s_%s_age.mat' %(base_dir,suffix,analysis_type)
-    # NOTE the ppheights don't matter for running randomise analysis 
-    all_text.append('/NumWaves\t2\n/NumPoints\t%d\n/PPheights\n\n/Matrix' % (len(usable_subs)))
-
-# Then, fill out the values for each subject included 
-for s, sub_id in enumerate(usable_subs):
-
-    # again, two columns for each group if you are looking at all subjecst
+# The contrasts we care about for each design
+# if you are looking at all subjects, also include the two groups (columns are comp, pi, age (, memory))
+group_contrasts=['/ContrastName1\tcomp\n/ContrastName2\tpi',
+                 '/ContrastName3\tcomp > pi',
+                 '/ContrastName4\tpi > comp',
+                 '/ContrastName5\tpositive age',
+                 '/ContrastName6\tnegative age',
+                 '/NumWaves\t3',
+                 '/NumContrasts\t6',
+                 '/PPheights',
+                 '/RequiredEffect\n',
+                 '\n/Matrix',
+                 '1.000000e+00\t0.000000e+00\t0.000000e+00',
+                 '0.000000e+00\t1.000000e+00\t0.000000e+00',
+                 '1.000000e+00\t-1.000000e+00\t0.000000e+00',
+                 '-1.000000e+00\t1.000000e+00\t0.000000e+00',
+                 '0.000000e+00\t0.000000e+00\t1.000000e+00',
+                 '0.000000e+00\t0.000000e+00\t-1.000000e+00']
+# otherwise the columns are group, age
+age_contrasts=['/ContrastName1\t group',
+               '/ContrastName2\tpositive age',
+               '/ContrastName3\tnegative age',
+               '/NumWaves\t2',
+               '/NumContrasts\t3',
+               '/PPheights',
+               '/RequiredEffect\n',
+               '\n/Matrix',
+               '1.000000e+00\t0.000000e+00',
+               '0.000000e+00\t1.000000e+00',
+               '0.000000e+00\t-1.000000e+00']
+group_mem_contrasts=['/ContrastName1\tcomp\n/ContrastName2\tpi',
+                     '/ContrastName3\tcomp > pi',
+                     '/ContrastName4\tpi > comp',
+                     '/ContrastName5\tpositive age',
+                     '/ContrastName6\tnegative age',
+                     '/ContrastName7\tmemory',
+                     '/NumWaves\t4',
+                     '/NumContrasts\t7',
+                     '/PPheights',
+                     '/RequiredEffect',
+                     '\n/Matrix',
+                     '1.000000e+00\t0.000000e+00\t0.000000e+00\t0.000000e+00',
+                     '0.000000e+00\t1.000000e+00\t0.000000e+00\t0.000000e+00',
+                     '1.000000e+00\t-1.000000e+00\t0.000000e+00\t0.000000e+00',
+                     '-1.000000e+00\t1.000000e+00\t0.000000e+00\t0.000000e+00',
+                     '0.000000e+00\t0.000000e+00\t1.000000e+00\t0.000000e+00',
+                     '0.000000e+00\t0.000000e+00\t-1.000000e+00\t0.000000e+00',
+                     '0.000000e+00\t0.000000e+00\t0.000000e+00\t1.000000e+00']
+
+def memory_suffix(mem_type):
+    # set a shorter suffix for save files
+    return 'detailed' if mem_type=='detailed_assoc_imm' else 'recog'
+
+def group_subjects(data_df,suffix,analysis_type,mem_type,exclude_for_memory=True):
+    # the participants in a group that can be included in an analysis, with their age and memory z-scored within
+    # the group; returns a data frame with sub_id (numbers only), comp (1 for comparison participants), age, memory
+    # (without exclude_for_memory, the participants left out for their memory of this memory type are kept, as for
+    # the designs without memory)
+    mem_suffix=memory_suffix(mem_type)
+
+    # if you are getting all subjects, or the subjects in the group (what is the value in the pi_status column?)
     if suffix=='all':
-        if float(data_df.pi_status[data_df.sub_ids=='sub-%s' % sub_id])==0:
-             all_text.append('%0.6f\t %0.6f\t%0.6f' %(1, 0, zscored_age[s])) # columns are comp, pi, age 
-        else:
-             all_text.append('%0.6f\t %0.6f\t%0.6f' %(0, 1, zscored_age[s])) # columns are comp, pi, age 
+        in_group=np.ones(len(data_df),dtype=bool)
     else:
-        
-         all_text.append('%0.6f\t%0.6f' %(1, zscored_age[s])) # columns are group, age 
-
-# Then save this out 
-np.savetxt(file_name,all_text,fmt='%s')
-
-# Also save the contrast files
-all_text=[]
-if suffix=='all':
-    file_name='%s/randomise_group_files/%s_%s_group.con' %(base_dir,suffix,analysis_type)
-    # These are the contrasts we care about 
-    all_text = ['/ContrastName1\tcomp\n/ContrastName2\tpi',
-            '/ContrastName3\tcomp > pi',
-           '/ContrastName4\tpi > comp',
-           '/ContrastName5\tpositive age',
-           '/ContrastName6\tnegative age',
-           '/NumWaves\t3',
-           '/NumContrasts\t6',
-           '/PPheights',
-           '/RequiredEffect\n',
-           '\n/Matrix',
-           '1.000000e+00\t0.000000e+00\t0.000000e+00',
-           '0.000000e+00\t1.000000e+00\t0.000000e+00',
-           '1.000000e+00\t-1.000000e+00\t0.000000e+00',
-           '-1.000000e+00\t1.000000e+00\t0.000000e+00',
-           '0.000000e+00\t0.000000e+00\t1.000000e+00',
-           '0.000000e+00\t0.000000e+00\t-1.000000e+00']
-else:
-    file_name='%s/randomise_group_files/%s_%s_age.con' %(base_dir,suffix,analysis_type)
-    # These are the contrasts we care about 
-    all_text = ['/ContrastName1\t group',
-           '/ContrastName2\tpositive age',
-           '/ContrastName3\tnegative age',
-           '/NumWaves\t2',
-           '/NumContrasts\t3',
-           '/PPheights',
-           '/RequiredEffect\n',
-           '\n/Matrix',
-           '1.000000e+00\t0.000000e+00',
-           '0.000000e+00\t1.000000e+00',
-           '0.000000e+00\t-1.000000e+00']
-    
-# Save it
-np.savetxt(file_name,all_text,fmt='%s')
-
-# Next we will fill out the mat files with memory as an additional column, only when we are looking at the contrast of all groups 
-all_text=[]
-if suffix =='all':
-
-    all_text.append('/NumWaves\t4\n/NumPoints\t%d\n/PPheights\t\n\n/Matrix' % (len(usable_subs)))
-    file_name='%s/randomise_group_files/%s_%s_group_%s_mem.mat' %(base_dir,suffix,analysis_type,mem_suffix)
-    
-    # First 
-    for s, sub_id in enumerate(usable_subs):
-
-        if float(data_df.pi_status[data_df.sub_ids=='sub-%s' % sub_id])==0:
-            all_text.append('%0.6f\t %0.6f\t%0.6f\t %0.6f' %(1, 0, zscored_age[s],zscored_mem[s]))
+        in_group=data_df.pi_status.values.astype(float)==(0 if suffix=='comp' else 1)
+
+    # we know we cannot include this subject for this analysis
+    perfect_memory=(data_df.sub_ids.values=='sub-134') & (mem_suffix=='recog') & exclude_for_memory
+    for sub_id in data_df.sub_ids.values[in_group & perfect_memory]:
+        print('skipping %s for having perfect memory' % sub_id)
+
+    # check whether this is an encoding or reinstatement anlaysis, and don't include the subjects that aren't
+    # supposed to be
+    inclusion=data_df.included_reinstatement.values if 'trialwise' in analysis_type else \
+        data_df.included_encoding.values
+    for sub_id in data_df.sub_ids.values[in_group & ~perfect_memory & (inclusion==0)]:
+        print('not including %s ' % sub_id)
+    included=in_group & ~perfect_memory & (inclusion!=0)
+
+    # z-score the values for just this group of subjects
+    return pd.DataFrame(dict(sub_id=[sub_id.split('sub-')[-1] for sub_id in data_df.sub_ids.values[included]],
+                             comp=data_df.pi_status.values[included].astype(float)==0,
+                             age=stats.zscore(data_df.ages.values[included]),
+                             memory=stats.zscore(data_df[mem_type].values[included])))
+
+def design_rows(subjects,columns):
+    # one line of the /Matrix for every participant (columns: 'group' for a column of ones, 'comp_pi' for the two
+    # group columns, 'age', 'memory')
+    values=[]
+    for column in columns:
+        if column=='group':
+            values.append(np.ones(len(subjects)))
+        elif column=='comp_pi':
+            values+=[subjects.comp.values.astype(float),1-subjects.comp.values.astype(float)]
         else:
-            all_text.append('%0.6f\t %0.6f\t%0.6f\t %0.6f' %(0, 1, zscored_age[s],zscored_mem[s]))
-
-    # Save it
-    np.savetxt(file_name,all_text,fmt='%s')           
-
-# also the contrast file 
-if suffix=='all':
-    file_name='%s/randomise_group_files/%s_%s_group_%s_mem.con' %(base_dir,suffix,analysis_type,mem_suffix)
-    # These are the contrasts we care about 
-    all_text = ['/ContrastName1\tcomp\n/ContrastName2\tpi',
-            '/ContrastName3\tcomp > pi',
-           '/ContrastName4\tpi > comp',
-           '/ContrastName5\tpositive age',
-           '/ContrastName6\tnegative age',
-           '/ContrastName7\tmemory',
-           '/NumWaves\t4',
-           '/NumContrasts\t7',
-           '/PPheights',
-           '/RequiredEffect',
-           '\n/Matrix',
-           '1.000000e+00\t0.000000e+00\t0.000000e+00\t0.000000e+00',
-           '0.000000e+00\t1.000000e+00\t0.000000e+00\t0.000000e+00',
-           '1.000000e+00\t-1.000000e+00\t0.000000e+00\t0.000000e+00',
-           '-1.000000e+00\t1.000000e+00\t0.000000e+00\t0.000000e+00',
-           '0.000000e+00\t0.000000e+00\t1.000000e+00\t0.000000e+00',
-           '0.000000e+00\t0.000000e+00\t-1.000000e+00\t0.000000e+00',
-           '0.000000e+00\t0.000000e+00\t0.000000e+00\t1.000000e+00']
-
-    # Save it
-    np.savetxt(file_name,all_text,fmt='%s')
+            values.append(subjects[column].values)
+    values=np.column_stack(values)
+
+    # the group columns of the all designs have a space after the tab (as they always have)
+    if columns[0]=='comp_pi':
+        formats='%0.6f\t %0.6f\t%0.6f' if values.shape[1]==3 else '%0.6f\t %0.6f\t%0.6f\t %0.6f'
+    else:
+        formats='%0.6f\t%0.6f'
+
+    return [formats % tuple(row) for row in values]
+
+def randomise_files(data_df,suffix,analysis_type,mem_type):
+    # the contents of every file for a group, analysis, and memory type (file name: list of lines)
+    # the participant list and the designs without memory are the same for every memory type
+    subjects=group_subjects(data_df,suffix,analysis_type,mem_type,exclude_for_memory=False)
+    root='%s/randomise_group_files/%s_%s' %(base_dir,suffix,analysis_type)
+    n_subjects=len(subjects)
+
+    # First a list of the participant IDs
+    files={'%s.txt' % root: list(subjects.sub_id)}
+
+    # Then the .mat files for having age as a covariate (NOTE the ppheights don't matter for running randomise)
+    # and the contrast files; if you are looking at all subjects, also include the two groups
+    if suffix=='all':
+        files['%s_group.mat' % root]=['/NumWaves\t3\n/NumPoints\t%d\n/PPheights\n\n/Matrix' % n_subjects]+\
+            design_rows(subjects,['comp_pi','age'])
+        files['%s_group.con' % root]=group_contrasts
+
+        # memory as an additional column, only when we are looking at the contrast of all groups
+        # (with its own list of participants, which run_randomise.sh uses if it differs from the one above)
+        mem_subjects=group_subjects(data_df,suffix,analysis_type,mem_type)
+        mem_root='%s_group_%s_mem' % (root,memory_suffix(mem_type))
+        files['%s.txt' % mem_root]=list(mem_subjects.sub_id)
+        files['%s.mat' % mem_root]=['/NumWaves\t4\n/NumPoints\t%d\n/PPheights\t\n\n/Matrix' % len(mem_subjects)]+\
+            design_rows(mem_subjects,['comp_pi','age','memory'])
+        files['%s.con' % mem_root]=group_mem_contrasts
+    else:
+        files['%s_age.mat' % root]=['/NumWaves\t2\n/NumPoints\t%d\n/PPheights\n\n/Matrix' % n_subjects]+\
+            design_rows(subjects,['group','age'])
+        files['%s_age.con' % root]=age_contrasts
+
+    return files
+
+def write_if_changed(file_name,lines):
+    # save the lines (like np.savetxt with fmt='%s') unless the file already has them; returns whether it was written
+    contents=''.join('%s\n' % line for line in lines)
+    if os.path.exists(file_name):
+        with open(file_name) as f:
+            if f.read()==contents:
+                return False
+    with open(file_name,'w') as f:
+        f.write(contents)
+
+    return True
+
+if __name__ == '__main__':
+    # Take the inputs from the command line (each can be several, separated by commas)
+    parser = argparse.ArgumentParser(description='Make the participant lists, designs, and contrasts for randomise')
+    parser.add_argument('suffixes', help="'all' 'comp' 'pi'")
+    parser.add_argument('analysis_types', help="'FaceObject' 'Imm_Detail' 'Imm_Recognition' 'trialwise_detailed' "
+                                               "'trialwise_recognition'")
+    parser.add_argument('mem_types', help="'hit_rates_imm' 'detailed_assoc_imm'")
+    args = parser.parse_args()
+
+    # first read in the participant information (created separately)
+    data_df=pd.read_csv('%s/data/memory_fmri_data.csv' %base_dir,index_col=0)
+
+    # the files of every combination (the ones that do not depend on the memory type are the same for each)
+    all_files=dict()
+    for suffix in args.suffixes.split(','):
+        for analysis_type in args.analysis_types.split(','):
+            for mem_type in args.mem_types.split(','):
+                files=randomise_files(data_df,suffix,analysis_type,mem_type)
+                # print how many subjects are included
+                print('%s %s %s: %d participants' % (suffix,analysis_type,mem_type,len(list(files.values())[0])))
+                all_files.update(files)
+
+    # Save them, leaving the ones that have not changed alone
+    written=[file_name for file_name, lines in all_files.items() if write_if_changed(file_name,lines)]
+    print('Wrote %d of %d files (the others had not changed)' % (len(written),len(all_files)))
@@ -0,0 +1,313 @@
+# Run the first level FEAT analyses for many participants, analyses, and runs at once (the steps of
+# scripts/supervisor_feat_analysis.sh, which does one participant and analysis at a time)
+# Every step is a node of a graph: putting the brain mask in the space of the functional data, masking the
+# preprocessed data and removing the burn-in, the confound files (convert_fmriprep_confounds.py), filling in the FSF
+# template, and FEAT. The steps that are shared (e.g., the masked data of a run is used by every analysis of that run)
+# are only done once, nodes that do not depend on each other are run at the same time as long as they fit in the
+# cores and memory given, and a node is skipped if its outputs are there and were made from the same inputs and
+# settings (remembered in feat_pipeline_stamps.json). --dry-run lists what would be run without running anything,
+# and --tool can swap any FSL program for a stand-in (e.g., to try it out without FSL)
+#
+# example command: python scripts/feat_pipeline.py 002,003,004 Imm_Detail,FaceObject --max-cores 8 --max-mem-gb 32
+#
+# 10182026
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import shlex
+import nibabel as nib
+from convert_fmriprep_confounds import confounds_file as confounds_source_file
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Hard code some parameters to use in the analysis IF they are an option (the same as supervisor_feat_analysis.sh)
+# (i.e., high pass filtering is automatically turned off for MVPA preproc FSF templates)
+burn_in=4
+high_pass_cutoff=100
+default_run='task-memory_run-1' # outputs of this run have no run suffix
+
+preproc_suffix='_space-MNI152NLin6Asym_desc-preproc_bold.nii.gz'
+# use the anatomical mask because fmriprep func mask is too strict
+mask_suffix='space-MNI152NLin6Asym_desc-brain_mask.nii.gz'
+
+# set these important things
+base_dir='' # ommitted for privacy
+timing_dir='' # ommitted for privacy
+fmriprep_path='%s/data/fmriprep_memory' % base_dir
+feat_path='%s/data/memory_feat_folders' % base_dir
+stamps_file='%s/feat_pipeline_stamps.json' % feat_path
+
+# the programs the nodes call (any can be replaced with --tool, e.g., by a stand-in script)
+tools=dict(flirt='flirt', fslmaths='fslmaths', fslroi='fslroi', feat='feat',
+           convert_fmriprep_confounds='%s %s/convert_fmriprep_confounds.py' %(sys.executable,
+                                                                           os.path.dirname(os.path.abspath(__file__))))
+
+# the cores and memory (GB) a node of each kind needs
+node_resources=dict(mask=(1,1), masked_data=(1,4), confounds=(1,0.5), fsf=(1,0.1), feat=(1,8))
+
+######################################################################################
+####### The files of each step
+
+def preproc_files(sub,run):
+    # the preprocessed data of a run, its masked and trimmed version, and the participant's brain mask
+    preproc_file='%s/sub-%s/func/sub-%s_%s%s' %(fmriprep_path,sub,sub,run,preproc_suffix)
+    mask_file='%s/sub-%s/anat/sub-%s_%s' %(fmriprep_path,sub,sub,mask_suffix)
+    return preproc_file, preproc_file.replace('.nii.gz','_masked.nii.gz'), mask_file
+
+def registered_mask_file(sub):
+    return preproc_files(sub,default_run)[2].replace('.nii.gz','_reg_func.nii.gz')
+
+def confounds_files(sub,run):
+    # the GLM and MVPA confound files (made by convert_fmriprep_confounds.py)
+    return ['%s/sub-%s/func/sub-%s_%s_%s_confounds.txt' %(fmriprep_path,sub,sub,run,analysis)
+            for analysis in ['glm','mvpa']]
+
+def feat_files(sub,analysis_type,run):
+    # the FEAT folder (without .feat) and FSF file of an analysis (with a suffix if it is not the default run)
+    output_folder='%s/sub-%s' %(feat_path,sub)
+    output_feat='%s/Memory_%s' %(output_folder,analysis_type)
+    if run != default_run:
+        output_feat='%s_%s' %(output_feat,run)
+
+    return output_feat, '%s/%s.fsf' %(output_folder,os.path.basename(output_feat))
+
+def n_volumes(file_name):
+    # what is the TR number?
+    return nib.load(file_name).shape[3]
+
+def render_fsf(template_file,fsf_file,replacements):
+    # Put this info in the actual template we will use
+    with open(template_file) as f:
+        fsf=f.read()
+    for placeholder, value in replacements.items():
+        fsf=fsf.replace('<?= $%s ?>' % placeholder,str(value))
+    os.makedirs(os.path.dirname(fsf_file),exist_ok=True)
+    with open(fsf_file,'w') as f:
+        f.write(fsf)
+
+def remove_feat_folders(output_feat):
+    # remove the old FEAT folders (FEAT adds a + to the name rather than overwriting), but not the ones of other runs
+    # (e.g., Memory_Imm_Detail_task-rest_run-1.feat when this is Memory_Imm_Detail)
+    for folder in glob.glob('%s.feat' % output_feat)+glob.glob('%s+*.feat' % output_feat):
+        shutil.rmtree(folder)
+
+######################################################################################
+####### The graph
+# A node is a dictionary with its name, the names of the nodes it needs (deps), the files it reads and makes, its
+# settings, its cores and memory, and a function that returns its steps when it is run (each step is either a
+# command, a list of strings, or a python function with no arguments)
+
+def tool(name):
+    # the command for one of the tools (which can have arguments of its own)
+    return shlex.split(tools[name])
+
+def make_node(name,kind,deps,inputs,outputs,steps,settings=None):
+    cores, mem_gb=node_resources[kind]
+    return dict(name=name, kind=kind, deps=deps, inputs=inputs, outputs=outputs, steps=steps,
+                settings=settings if settings is not None else dict(), cores=cores, mem_gb=mem_gb)
+
+def build_graph(subs,analysis_types,runs):
+    # the nodes for every participant, analysis, and run (shared steps are only added once)
+    graph=dict()
+    for sub in subs:
+        for run in runs:
+            preproc_file, preproc_file_masked, mask_file=preproc_files(sub,run)
+            mask_reg=registered_mask_file(sub)
+
+            # put the mask in the example func space and bin it (once per participant; the runs share a grid)
+            name='mask:%s' % sub
+            if name not in graph:
+                graph[name]=make_node(name,'mask',[],[mask_file,preproc_file],[mask_reg],
+                                      lambda mask_file=mask_file, preproc_file=preproc_file, mask_reg=mask_reg: [
+                    tool('flirt')+['-in',mask_file,'-ref',preproc_file,'-applyxfm','-usesqform','-out',mask_reg],
+                    tool('fslmaths')+[mask_reg,'-bin',mask_reg]])
+
+            # mask the preprocessed data, and don't forget to remove the burn in though !!!!
+            def masked_data_steps(preproc_file=preproc_file, preproc_file_masked=preproc_file_masked,
+                                  mask_reg=mask_reg):
+                TR_Number=n_volumes(preproc_file)
+                start_TR=burn_in-1
+                TR_Length=TR_Number-burn_in
+                return [tool('fslmaths')+[preproc_file,'-mas',mask_reg,preproc_file_masked],
+                        tool('fslroi')+[preproc_file_masked,preproc_file_masked,str(start_TR),str(TR_Length)]]
+            graph['masked_data:%s:%s' %(sub,run)]=make_node('masked_data:%s:%s' %(sub,run),'masked_data',
+                                                            ['mask:%s' % sub],[preproc_file,mask_reg],
+                                                            [preproc_file_masked],masked_data_steps,
+                                                            dict(burn_in=burn_in))
+
+            # the confound files
+            task=run.replace('task-','')
+            graph['confounds:%s:%s' %(sub,run)]=make_node('confounds:%s:%s' %(sub,run),'confounds',[],
+                                                          [confounds_source_file(sub,task)],confounds_files(sub,run),
+                                                          lambda sub=sub, task=task: [
+                                                              tool('convert_fmriprep_confounds')+[sub,task]])
+
+            for analysis_type in analysis_types:
+                output_feat, fsf_file=feat_files(sub,analysis_type,run)
+                template_file='%s/fsf_templates/Memory_%s.fsf.template' %(base_dir,analysis_type)
+                # include the confounds file (checking if this is for mvpa or not)
+                confounds_file=confounds_files(sub,run)[1 if 'MVPA' in analysis_type else 0]
+                key='%s:%s:%s' %(sub,analysis_type,run)
+
+                def fsf_steps(template_file=template_file, fsf_file=fsf_file, output_feat=output_feat,
+                              preproc_file_masked=preproc_file_masked, confounds_file=confounds_file):
+                    replacements={'FEAT_FOLDER': output_feat, 'TR_NUMBER': n_volumes(preproc_file_masked),
+                                  '4D_DATA': preproc_file_masked, 'CONFOUNDS': confounds_file,
+                                  'TIMING_DIR': timing_dir, 'HIGH_PASS_CUTOFF': high_pass_cutoff}
+                    return [lambda: render_fsf(template_file,fsf_file,replacements)]
+                graph['fsf:%s' % key]=make_node('fsf:%s' % key,'fsf',['masked_data:%s:%s' %(sub,run)],
+                                                [template_file,preproc_file_masked],[fsf_file],fsf_steps,
+                                                dict(timing_dir=timing_dir, high_pass_cutoff=high_pass_cutoff,
+                                                     confounds_file=confounds_file))
+
+                graph['feat:%s' % key]=make_node(
+                    'feat:%s' % key,'feat',['fsf:%s' % key,'confounds:%s:%s' %(sub,run)],
+                    [fsf_file,preproc_file_masked,confounds_file],['%s.feat/filtered_func_data.nii.gz' % output_feat],
+                    lambda output_feat=output_feat, fsf_file=fsf_file: [lambda: remove_feat_folders(output_feat),
+                                                                      tool('feat')+[fsf_file]])
+
+    return graph
+
+######################################################################################
+####### Running the graph
+
+def file_stamp(file_name):
+    # what we check to know whether a file has changed
+    file_stat=os.stat(file_name)
+    return dict(size=file_stat.st_size, mtime=file_stat.st_mtime)
+
+def node_stamp(node):
+    # what the outputs of a node were made from (None if an input is missing)
+    if not all(os.path.exists(file_name) for file_name in node['inputs']):
+        return None
+    return dict(inputs={file_name: file_stamp(file_name) for file_name in node['inputs']}, settings=node['settings'])
+
+def is_current(node,stamps):
+    # are the node's outputs there and made from its current inputs?
+    # outputs made before there was a stamp for the node (e.g., by supervisor_feat_analysis.sh) count if they are
+    # newer than all of the inputs
+    stamp=node_stamp(node)
+    if stamp is None or not all(os.path.exists(file_name) for file_name in node['outputs']):
+        return False
+    if node['name'] not in stamps:
+        return min(os.path.getmtime(file_name) for file_name in node['outputs']) >= \
+            max(os.path.getmtime(file_name) for file_name in node['inputs'])
+
+    return stamps[node['name']]==stamp
+
+def run_node(node,log_dir):
+    # run the steps of a node one after the other (the output of the commands goes to a log for the node)
+    log_file='%s/%s.log' %(log_dir,node['name'].replace(':','_'))
+    with open(log_file,'w') as log:
+        for step in node['steps']():
+            if callable(step):
+                step()
+            else:
+                log.write('%s\n' % ' '.join(step))
+                log.flush()
+                subprocess.run(step,stdout=log,stderr=subprocess.STDOUT,check=True)
+
+def run_graph(graph,max_cores=1,max_mem_gb=8,dry_run=False,force=False,log_dir=None):
+    # run every node once the nodes it needs are done, as many at once as fit in max_cores and max_mem_gb (a node
+    # that needs more than that runs on its own), skipping the ones that are up to date
+    # returns the names of the nodes that were run, skipped, and failed (or not run because a node they need failed)
+    stamps=dict()
+    if os.path.exists(stamps_file):
+        with open(stamps_file) as f:
+            stamps=json.load(f)
+    if log_dir is None:
+        log_dir='%s/feat_pipeline_logs' % feat_path
+    os.makedirs(log_dir,exist_ok=True)
+
+    status=dict()
+    running=dict()
+    waiting=[name for name in graph]
+    with ThreadPoolExecutor(max_workers=max(1,max_cores)) as pool:
+        while waiting or running:
+            # start what is ready and fits
+            for name in list(waiting):
+                node=graph[name]
+                dep_status=[status.get(dep) for dep in node['deps']]
+                if any(state is None for state in dep_status):
+                    continue
+                waiting.remove(name)
+                if any(state=='failed' for state in dep_status):
+                    status[name]='failed'
+                    print('not running %s (a step it needs failed)' % name)
+                    continue
+                # a node is only up to date if nothing it needs was (or would be) run again
+                if not force and all(state=='skipped' for state in dep_status) and is_current(node,stamps):
+                    status[name]='skipped'
+                    stamps.setdefault(name,node_stamp(node))
+                    continue
+                if dry_run:
+                    status[name]='run'
+                    print('would run %s' % name)
+                    continue
+                cores=sum(graph[other]['cores'] for other in running.values())+node['cores']
+                mem_gb=sum(graph[other]['mem_gb'] for other in running.values())+node['mem_gb']
+                if running and (cores > max_cores or mem_gb > max_mem_gb):
+                    waiting.insert(0,name)
+                    break
+                print('running %s' % name)
+                running[pool.submit(run_node,node,log_dir)]=name
+
+            if not running:
+                continue
+            done, _=wait(list(running),return_when=FIRST_COMPLETED)
+            for future in done:
+                name=running.pop(future)
+                if future.exception() is not None:
+                    status[name]='failed'
+                    print('FAILED %s: %s (see %s)' % (name,future.exception(),log_dir))
+                else:
+                    status[name]='run'
+                    stamps[name]=node_stamp(graph[name])
+
+            # save what has been done so far, so an interrupted run picks up where it left off
+            with open(stamps_file+'.tmp','w') as f:
+                json.dump(stamps,f,indent=1)
+            os.replace(stamps_file+'.tmp',stamps_file)
+
+    return {state: [name for name in graph if status[name]==state] for state in ['run','skipped','failed']}
+
+def memory_budget_gb():
+    # the memory slurm gives the job, or all of the memory of this machine
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        return int(os.environ['SLURM_MEM_PER_NODE'])/1024
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1024**3
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the first level FEAT analyses for a grid of participants, '
+                                                 'analyses, and runs')
+    parser.add_argument('subs', help='participant ID numbers separated by commas, e.g., 002,003')
+    parser.add_argument('analysis_types', help='analyses separated by commas, e.g., Imm_Detail,FaceObject')
+    parser.add_argument('--runs', default=default_run, help='runs separated by commas (default: %s)' % default_run)
+    parser.add_argument('--max-cores', default=int(os.environ.get('SLURM_CPUS_PER_TASK',os.cpu_count())), type=int,
+                        help='cores to use at once (default: the cores slurm gives the job, or all)')
+    parser.add_argument('--max-mem-gb', default=memory_budget_gb(), type=float,
+                        help='memory (GB) to use at once (default: what slurm gives the job, or all)')
+    parser.add_argument('--dry-run', action='store_true', help='list what would be run without running it')
+    parser.add_argument('--force', action='store_true', help='run every node even if it is up to date')
+    parser.add_argument('--tool', action='append', default=[], help='use another program for one of the FSL tools, '
+                                                                    'e.g., --tool feat=/path/to/fake_feat')
+    args = parser.parse_args()
+
+    for tool_option in args.tool:
+        name, _, command=tool_option.partition('=')
+        tools[name]=command
+
+    graph=build_graph(args.subs.split(','),args.analysis_types.split(','),args.runs.split(','))
+    start=time.time()
+    result=run_graph(graph,args.max_cores,args.max_mem_gb,args.dry_run,args.force)
+    print('%d steps %s, %d up to date, %d failed (%0.0f s)' % (len(result['run']),
+                                                              'to run' if args.dry_run else 'run',
+                                                              len(result['skipped']),len(result['failed']),
+                                                              time.time()-start))
+    if len(result['failed']) > 0:
+        sys.exit(1)
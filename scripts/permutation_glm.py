@@ -0,0 +1,359 @@
+# Permutation tests of a group GLM, in place of FSL randomise (takes the same inputs and makes the same outputs)
+# Reads the stacked maps (stack_group_files.py) and the .mat / .con files from create_randomise_group_files.py, and
+# tests every contrast of the design in one run. The permutations are done in batches as matrix multiplications: with
+# Freedman-Lane, the data of a contrast are the residuals of its nuisance part (Rz Y), and a shuffled (or sign
+# flipped) copy only enters the t-stat through U' P Rz Y (U is an orthonormal basis of the design), so every
+# contrast and permutation of a batch is one multiplication of the data. The batches are spread over a pool of worker
+# processes, which also do the TFCE and clusters of their permutations. As in randomise, the first permutation is
+# the real labelling, the corrected p-values come from the maximum over the brain of each permutation, and the
+# p-value images are saved as 1 - p
+#
+# example command: python scripts/permutation_glm.py -i all_merged_data_zstat3.nii.gz -o all_group_zstat3
+#     -d all_Imm_Detail_group.mat -t all_Imm_Detail_group.con -m intersect_mask.nii.gz -x -D -C 2.09 -n 1000
+#
+# 10182026
+
+import os
+import math
+import argparse
+import itertools
+import numpy as np
+import nibabel as nib
+import scipy.linalg
+from scipy import ndimage
+from multiprocessing import Pool
+
+# TFCE settings used by randomise -T (height and extent exponents, face connectivity, steps up to the maximum)
+tfce_height=2
+tfce_extent=0.5
+tfce_connectivity=6
+tfce_steps=100
+
+# randomise forms clusters (-C) with 26 connectivity
+cluster_connectivity=26
+
+# how close to the real statistic a permutation can be and still count as at least as big (the same statistic is
+# summed in a different order for different batch sizes)
+tie_tolerance=1e-8
+
+# the memory (bytes) each worker may use for the projected data of a batch of permutations
+batch_bytes=256*1024**2
+
+######################################################################################
+####### Design files
+
+def load_fsl_matrix(file_name):
+    # the numbers after /Matrix in an FSL .mat or .con file (rows x columns)
+    with open(file_name) as f:
+        lines=f.read().splitlines()
+    start=[line.strip() for line in lines].index('/Matrix')+1
+
+    return np.array([[float(value) for value in line.split()] for line in lines[start:] if line.strip() != ''],
+                    ndmin=2)
+
+def load_contrast_names(file_name,n_contrasts):
+    # the /ContrastName of each contrast (numbered if there are none)
+    names=['contrast %d' % (i+1) for i in range(n_contrasts)]
+    with open(file_name) as f:
+        for line in f.read().splitlines():
+            if line.startswith('/ContrastName'):
+                number, _, name=line[len('/ContrastName'):].partition('\t')
+                names[int(number)-1]=name.strip()
+
+    return names
+
+######################################################################################
+####### The model
+
+def contrast_parts(design,contrast):
+    # the nuisance part Z of the design for a contrast (Winkler et al., 2014, appendix A), so that the contrast is
+    # tested on the data with Z taken out (Freedman-Lane); returns Z (subjects x columns, maybe none)
+    D=np.linalg.pinv(design.T @ design)
+    c=contrast[:,None]
+    null_c=scipy.linalg.null_space(c.T)
+    if null_c.shape[1]==0:
+        return np.zeros((len(design),0))
+    Cv=null_c - c @ np.linalg.pinv(c.T @ D @ c) @ c.T @ D @ null_c
+    Z=design @ D @ Cv @ np.linalg.pinv(Cv.T @ D @ Cv)
+
+    return Z[:,np.linalg.norm(Z,axis=0) > 1e-10]
+
+def fit_operators(design,contrasts,data):
+    # what every permutation needs: an orthonormal basis U of the design, and for each contrast the residual forming
+    # matrix of its nuisance part (Rz), the weights of the contrast on U' (w), c' (M'M)^+ c, the part of the data
+    # that is not permuted (c' M^+ Hz Y), and the sum of squares of Rz Y for every voxel
+    n_subjects=len(design)
+    U, s, _=np.linalg.svd(design,full_matrices=False)
+    U=U[:,s > s[0]*n_subjects*np.finfo(float).eps]
+    pinv_design=np.linalg.pinv(design)
+    D=np.linalg.pinv(design.T @ design)
+
+    Rz=np.empty((len(contrasts),n_subjects,n_subjects))
+    w=np.empty((len(contrasts),U.shape[1]))
+    scale=np.empty(len(contrasts))
+    fixed=np.empty((len(contrasts),data.shape[1]))
+    sum_squares=np.empty((len(contrasts),data.shape[1]))
+    for i, contrast in enumerate(contrasts):
+        Z=contrast_parts(design,contrast)
+        Hz=Z @ np.linalg.pinv(Z) if Z.shape[1] > 0 else np.zeros((n_subjects,n_subjects))
+        Rz[i]=np.eye(n_subjects)-Hz
+        w[i]=U.T @ (pinv_design.T @ contrast)
+        scale[i]=contrast @ D @ contrast
+        fixed[i]=(contrast @ pinv_design @ Hz) @ data
+        sum_squares[i]=np.sum((Rz[i] @ data)**2,axis=0)
+
+    return dict(U=U, Rz=Rz, w=w, scale=scale, fixed=fixed, sum_squares=sum_squares, dof=n_subjects-U.shape[1])
+
+def permuted_tstats(data,operators,orders,signs):
+    # t-stats of every contrast for a batch of permutations (orders, permutations x subjects: which subject's
+    # residual goes to each row) and sign flips (signs, permutations x subjects); returns permutations x contrasts x
+    # voxels
+    U, Rz, w=operators['U'], operators['Rz'], operators['w']
+    n_perms, n_subjects=orders.shape
+
+    # U' P, for the permutation matrix P that puts row orders[i] at row i and flips it by signs[i]
+    signed_U=U.T[None,:,:]*signs[:,None,:]
+    inverse=np.argsort(orders,axis=1)
+    UP=np.take_along_axis(signed_U,inverse[:,None,:],axis=2)
+
+    # U' P Rz Y for every permutation and contrast at once
+    projector=np.einsum('brn,cnm->bcrm',UP,Rz)
+    projected=(projector.reshape(-1,n_subjects) @ data).reshape(n_perms,len(Rz),U.shape[1],data.shape[1])
+
+    effect=np.einsum('bcrv,cr->bcv',projected,w)+operators['fixed']
+    residual=np.maximum(operators['sum_squares']-np.sum(projected**2,axis=2),0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        tstats=effect/np.sqrt(residual/operators['dof']*operators['scale'][:,None])
+
+    return np.nan_to_num(tstats,nan=0.0,posinf=0.0,neginf=0.0)
+
+def make_permutations(n_subjects,n_perms,sign_flip,permute,seed=0):
+    # the orders and signs of every permutation, starting with the real labelling
+    # if there are no more possible permutations than asked for, all of them are done (like randomise)
+    n_orders=math.factorial(n_subjects) if permute else 1
+    n_signs=2**n_subjects if sign_flip else 1
+    if n_orders*n_signs <= n_perms:
+        orders=list(itertools.permutations(range(n_subjects))) if permute else [tuple(range(n_subjects))]
+        signs=list(itertools.product([1,-1],repeat=n_subjects)) if sign_flip else [(1,)*n_subjects]
+        pairs=list(itertools.product(orders,signs))
+        return np.array([order for order, _ in pairs]), np.array([sign for _, sign in pairs],dtype=float)
+
+    rng=np.random.default_rng(seed)
+    orders=np.tile(np.arange(n_subjects),(n_perms,1))
+    signs=np.ones((n_perms,n_subjects))
+    for i in range(1,n_perms):
+        if permute:
+            orders[i]=rng.permutation(n_subjects)
+        if sign_flip:
+            signs[i]=rng.choice([-1.0,1.0],n_subjects)
+
+    return orders, signs
+
+######################################################################################
+####### TFCE and clusters
+
+def connectivity_structure(connectivity):
+    return ndimage.generate_binary_structure(3,{6:1,18:2,26:3}[connectivity])
+
+def tfce(stat_volume,height=tfce_height,extent=tfce_extent,connectivity=tfce_connectivity,n_steps=tfce_steps):
+    # threshold-free cluster enhancement of the positive values (steps of 1/n_steps of the maximum, like randomise)
+    enhanced=np.zeros(stat_volume.shape)
+    top=stat_volume.max()
+    if top <= 0:
+        return enhanced
+    step=top/n_steps
+    structure=connectivity_structure(connectivity)
+    for h in np.arange(1,n_steps)*step:
+        labels, n_clusters=ndimage.label(stat_volume > h,structure)
+        if n_clusters==0:
+            break
+        sizes=np.bincount(labels.ravel())
+        sizes[0]=0
+        enhanced+=(sizes[labels]**extent)*(h**height)*step
+
+    return enhanced
+
+def cluster_sizes(stat_volume,threshold,connectivity=cluster_connectivity):
+    # the size of the cluster (above threshold) each voxel is in (0 outside of clusters)
+    labels, _=ndimage.label(stat_volume > threshold,connectivity_structure(connectivity))
+    sizes=np.bincount(labels.ravel())
+    sizes[0]=0
+
+    return sizes[labels]
+
+######################################################################################
+####### Running the permutations
+
+# what the worker processes need (set by start_worker, so it is only sent to each worker once)
+worker=dict()
+
+def start_worker(state):
+    worker.update(state)
+
+def to_volume(values,mask_box):
+    # voxels (in the mask) back into the box around the mask
+    volume=np.zeros(mask_box.shape)
+    volume[mask_box]=values
+
+    return volume
+
+def null_batch(batch):
+    # the null of a batch of permutations: the maximum t (and TFCE and cluster size, if asked for) of each
+    # permutation and contrast, and for each voxel how many permutations were at least as big as the real data
+    orders, signs=batch
+    tstats=permuted_tstats(worker['data'],worker['operators'],orders,signs)
+    n_perms, n_contrasts, _=tstats.shape
+
+    null=dict(max_tstat=tstats.max(axis=2), tstat_counts=np.sum(tstats >= worker['tstats']-tie_tolerance,axis=0))
+    if worker['tfce']:
+        null['max_tfce']=np.zeros((n_perms,n_contrasts))
+        null['tfce_counts']=np.zeros(worker['tstats'].shape,dtype=int)
+    if worker['cluster_threshold'] is not None:
+        null['max_cluster']=np.zeros((n_perms,n_contrasts))
+    for b in range(n_perms):
+        for c in range(n_contrasts):
+            volume=to_volume(tstats[b,c],worker['mask_box'])
+            if worker['tfce']:
+                enhanced=tfce(volume)[worker['mask_box']]
+                null['max_tfce'][b,c]=enhanced.max()
+                null['tfce_counts'][c]+=enhanced >= worker['tfce_stats'][c]-tie_tolerance
+            if worker['cluster_threshold'] is not None:
+                null['max_cluster'][b,c]=cluster_sizes(volume,worker['cluster_threshold']).max()
+
+    return null
+
+def corrected_p(null_max,observed):
+    # 1 - the fraction of the permutations whose maximum is at least the observed value (null_max: permutations)
+    return np.searchsorted(np.sort(null_max),observed-tie_tolerance,side='left')/len(null_max)
+
+def permutation_glm(data,design,contrasts,mask_box,n_perms=5000,sign_flip=False,permute=True,tfce_on=False,
+                    cluster_threshold=None,n_jobs=1,seed=0):
+    # the t-stats and permutation p-values of every contrast (data: subjects x voxels in the mask)
+    # returns a dictionary of contrasts x voxels arrays: tstat, vox_p, vox_corrp, and tfce, tfce_p, tfce_corrp
+    # (with tfce_on) and clustere_corrp (with a cluster_threshold)
+    operators=fit_operators(design,contrasts,data)
+    orders, signs=make_permutations(len(design),n_perms,sign_flip,permute,seed)
+    tstats=permuted_tstats(data,operators,orders[:1],signs[:1])[0]
+
+    state=dict(data=data, operators=operators, tstats=tstats, mask_box=mask_box, tfce=tfce_on,
+               cluster_threshold=cluster_threshold)
+    outputs=dict(tstat=tstats)
+    if tfce_on:
+        state['tfce_stats']=np.array([tfce(to_volume(t,mask_box))[mask_box] for t in tstats])
+        outputs['tfce']=state['tfce_stats']
+
+    # batches small enough for batch_bytes of projected data, and at least one per worker
+    batch_size=max(1,min(batch_bytes//(8*len(contrasts)*operators['U'].shape[1]*data.shape[1]),
+                         math.ceil(len(orders)/n_jobs)))
+    batches=[(orders[i:i+batch_size],signs[i:i+batch_size]) for i in range(0,len(orders),batch_size)]
+    if n_jobs > 1:
+        with Pool(n_jobs,initializer=start_worker,initargs=(state,)) as pool:
+            nulls=pool.map(null_batch,batches)
+    else:
+        start_worker(state)
+        nulls=[null_batch(batch) for batch in batches]
+
+    n_done=len(orders)
+    null=dict(max_tstat=np.concatenate([batch['max_tstat'] for batch in nulls]))
+    outputs['vox_p']=1-sum(batch['tstat_counts'] for batch in nulls)/n_done
+    outputs['vox_corrp']=np.array([corrected_p(null['max_tstat'][:,c],tstats[c]) for c in range(len(contrasts))])
+    if tfce_on:
+        max_tfce=np.concatenate([batch['max_tfce'] for batch in nulls])
+        outputs['tfce_p']=1-sum(batch['tfce_counts'] for batch in nulls)/n_done
+        outputs['tfce_corrp']=np.array([corrected_p(max_tfce[:,c],state['tfce_stats'][c])
+                                        for c in range(len(contrasts))])
+    if cluster_threshold is not None:
+        max_cluster=np.concatenate([batch['max_cluster'] for batch in nulls])
+        outputs['clustere_corrp']=np.zeros(tstats.shape)
+        for c in range(len(contrasts)):
+            sizes=cluster_sizes(to_volume(tstats[c],mask_box),cluster_threshold)[mask_box]
+            outputs['clustere_corrp'][c]=np.where(sizes > 0,corrected_p(max_cluster[:,c],sizes),0)
+
+    return outputs, n_done
+
+def save_outputs(outputs,output_root,mask_nii,box,saved=('tstat','vox_corrp','tfce_corrp','clustere_corrp')):
+    # save the outputs with randomise's names (e.g., <output_root>_vox_corrp_tstat1.nii.gz)
+    mask=np.asarray(mask_nii.dataobj)!=0
+    for name in saved:
+        if name not in outputs:
+            continue
+        for c, values in enumerate(outputs[name]):
+            volume=np.zeros(mask.shape,dtype=np.float32)
+            volume[box][mask[box]]=values
+            file_name='%s_tstat%d.nii.gz' % (output_root,c+1) if name=='tstat' else \
+                '%s_%s_tstat%d.nii.gz' % (output_root,name,c+1)
+            output_nii=nib.Nifti1Image(volume,mask_nii.affine,header=mask_nii.header)
+            output_nii.set_data_dtype(np.float32)
+            nib.save(output_nii,file_name)
+
+def mask_bounding_box(mask):
+    # the slices of the smallest box around the mask (the TFCE and clusters only need to look in there)
+    return tuple(slice(idxs.min(),idxs.max()+1) for idxs in np.nonzero(mask))
+
+if __name__ == '__main__':
+    # the same flags as randomise (for the options we use)
+    parser = argparse.ArgumentParser(description='Permutation tests of a group GLM (like FSL randomise)')
+    parser.add_argument('-i', dest='input', required=True, help='4D file of the stacked maps')
+    parser.add_argument('-o', dest='output', required=True, help='root of the output names')
+    parser.add_argument('-d', dest='design', default=None, help='design matrix (.mat)')
+    parser.add_argument('-t', dest='contrasts', default=None, help='t contrasts (.con)')
+    parser.add_argument('-m', dest='mask', default=None, help='mask (default: voxels that are not zero for everyone)')
+    parser.add_argument('-1', dest='one_sample', action='store_true', help='one-sample test of the mean (sign flips)')
+    parser.add_argument('-n', dest='n_perms', default=5000, type=int, help='number of permutations (default: 5000)')
+    parser.add_argument('-x', dest='voxelwise', action='store_true', help='save voxelwise corrected p-values')
+    parser.add_argument('-T', dest='tfce', action='store_true', help='TFCE (and save its corrected p-values)')
+    parser.add_argument('-C', dest='cluster_threshold', default=None, type=float,
+                        help='cluster-forming threshold for cluster extent corrected p-values')
+    parser.add_argument('-D', dest='demean', action='store_true', help='demean the data and design')
+    parser.add_argument('--uncorrp', action='store_true', help='also save the uncorrected p-values')
+    parser.add_argument('--permutation-method', default='auto', choices=['auto','freedman-lane','sign-flip','both'],
+                        help='shuffle the subjects (freedman-lane), flip their signs, or both (default: sign flips '
+                             'for a one-sample test, otherwise shuffles)')
+    parser.add_argument('--seed', default=0, type=int, help='random seed (default: 0)')
+    parser.add_argument('--n-jobs', default=int(os.environ.get('SLURM_CPUS_PER_TASK',os.cpu_count())), type=int,
+                        help='worker processes (default: the cores slurm gives the job, or all)')
+    args = parser.parse_args()
+
+    merged_nii=nib.load(args.input)
+    merged=np.asarray(merged_nii.dataobj,dtype=np.float32)
+    if merged.ndim==3:
+        merged=merged[...,None]
+    if args.mask is not None:
+        mask_nii=nib.load(args.mask)
+        mask=np.asarray(mask_nii.dataobj)!=0
+    else:
+        mask=np.all(merged!=0,axis=3)
+        mask_nii=nib.Nifti1Image(mask.astype(np.uint8),merged_nii.affine)
+    data=merged[mask].T.astype(float) # subjects x voxels
+    del merged
+
+    # the design (a column of ones for a one-sample test) and the contrasts
+    n_subjects=len(data)
+    design=np.ones((n_subjects,1)) if args.one_sample or args.design is None else load_fsl_matrix(args.design)
+    contrasts=load_fsl_matrix(args.contrasts) if args.contrasts is not None else np.ones((1,1))
+    if design.shape != (n_subjects,contrasts.shape[1]):
+        raise ValueError('the design is %s but there are %d maps and %d columns in the contrasts' % (
+            design.shape,n_subjects,contrasts.shape[1]))
+    if args.demean:
+        design=design-design.mean(axis=0)
+        data=data-data.mean(axis=0)
+
+    method=args.permutation_method
+    if method=='auto':
+        method='sign-flip' if args.one_sample or args.design is None else 'freedman-lane'
+    box=mask_bounding_box(mask)
+    outputs, n_done=permutation_glm(data,design,contrasts,mask[box],args.n_perms,
+                                    sign_flip=method in ['sign-flip','both'],
+                                    permute=method in ['freedman-lane','both'],tfce_on=args.tfce,
+                                    cluster_threshold=args.cluster_threshold,n_jobs=args.n_jobs,seed=args.seed)
+    print('Ran %d permutations (%s) on %d voxels' % (n_done,method,data.shape[1]))
+    names=load_contrast_names(args.contrasts,len(contrasts)) if args.contrasts is not None else ['mean']
+    for c, name in enumerate(names):
+        print('tstat%d (%s): max t %0.2f, min corrected p %0.4f' % (c+1,name,outputs['tstat'][c].max(),
+                                                                  1-outputs['vox_corrp'][c].max()))
+
+    saved=['tstat']+(['vox_corrp'] if args.voxelwise else [])+(['tfce_corrp'] if args.tfce else [])+\
+        (['clustere_corrp'] if args.cluster_threshold is not None else [])
+    if args.uncorrp:
+        saved+=['vox_p']+(['tfce_p'] if args.tfce else [])
+    save_outputs(outputs,args.output,mask_nii,box,saved)
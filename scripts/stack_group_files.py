@@ -0,0 +1,177 @@
+# Stack the participants' maps into the 4D file that randomise takes (used by scripts/run_randomise.sh)
+# This used to be an fslmerge for every participant, which reread and rewrote the whole growing file each time, with
+# a flirt for every participant whose map was not in standard space yet, one after the other. Now the missing
+# standard space maps are made in parallel, and the stack is filled in one pass (masked, so the background is zero)
+# and written once. A .json next to the stack says which files it was made from, so if none of them (or the mask)
+# changed it is left alone, and a standard space map is only remade if its map changed
+#
+# With --mem-type, the participants are the ones of the memory design (e.g., all_Imm_Detail_group_recog_mem.txt), for
+# when a participant is left out of that design only (see create_randomise_group_files.py)
+#
+# example command: python scripts/stack_group_files.py all Imm_Detail zstat3 --n-jobs 8
+#
+# 10182026
+
+import os
+import json
+import argparse
+import subprocess
+import numpy as np
+import nibabel as nib
+from nibabel.processing import resample_from_to
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# set the base dir
+base_dir='' # ommitted for privacy
+mask_file='%s/data/intersect_mask.nii.gz' % base_dir # this is in 2mm iso standard space; 91 x 109 x 91
+
+def participants_file(suffix,analysis_type,mem_type=None):
+    # the list of participants made by create_randomise_group_files.py (of the memory design, if given)
+    if mem_type is not None:
+        return '%s/randomise_group_files/%s_%s_group_%s_mem.txt' %(base_dir,suffix,analysis_type,mem_type)
+    return '%s/randomise_group_files/%s_%s.txt' %(base_dir,suffix,analysis_type)
+
+def merged_file_name(suffix,analysis_type,contrast_num,mem_type=None):
+    if mem_type is not None:
+        suffix='%s_group_%s_mem' %(suffix,mem_type)
+    return '%s/data/randomise/%s/%s_merged_data_%s.nii.gz' %(base_dir,analysis_type,suffix,contrast_num)
+
+def load_participants(suffix,analysis_type,mem_type=None):
+    # participant IDs (numbers only, e.g., 002) in the order of the design matrix
+    with open(participants_file(suffix,analysis_type,mem_type)) as f:
+        return f.read().split()
+
+def subject_files(ppt,analysis_type,contrast_num):
+    # the map of a participant and its standard space version
+    # if this is a glm output vs. mvpa output, we will have the outputs stored in different places
+    if analysis_type in ['trialwise_detailed','trialwise_recognition']:
+        # this is already aligned to standard, so just supply both as the same file
+        file_name='%s/data/similarity_searchlight/sub-%s_%s_%s_summed_zscore_v2.nii.gz' %(base_dir,ppt,analysis_type,
+                                                                                            contrast_num)
+        return file_name, file_name
+
+    stats_path='%s/data/memory_feat_folders/sub-%s/Memory_%s.feat/stats' %(base_dir,ppt,analysis_type)
+    return '%s/%s.nii.gz' %(stats_path,contrast_num), '%s/%s_registered_standard.nii.gz' %(stats_path,contrast_num)
+
+def file_stamp(file_name):
+    # what we check to know whether a file has changed
+    file_stat=os.stat(file_name)
+    return dict(path=os.path.abspath(file_name), size=file_stat.st_size, mtime=file_stat.st_mtime)
+
+def needs_registering(file_name,file_name_standard):
+    # is the standard space map missing, or older than the map it was made from?
+    return file_name != file_name_standard and (not os.path.exists(file_name_standard) or
+                                                os.path.getmtime(file_name_standard) < os.path.getmtime(file_name))
+
+def register_to_standard(file_name,file_name_standard,resampler='flirt'):
+    # put a map in standard space -- not re-registering, just changing the voxel size (trilinear, like flirt)
+    if resampler == 'flirt':
+        subprocess.run(['flirt','-in',file_name,'-ref',mask_file,'-applyxfm','-usesqform','-out',file_name_standard],
+                       check=True)
+    else:
+        standard_nii=resample_from_to(nib.load(file_name),nib.load(mask_file),order=1)
+        tmp_file=file_name_standard.replace('.nii.gz','.tmp.nii.gz') # so a half-written file is never used
+        nib.save(standard_nii,tmp_file)
+        os.replace(tmp_file,file_name_standard)
+
+    return file_name_standard
+
+def register_missing(files,resampler='flirt',n_jobs=1):
+    # make the standard space maps that are missing or out of date, n_jobs at a time
+    to_register=[(file_name,file_name_standard) for file_name, file_name_standard in files
+                 if needs_registering(file_name,file_name_standard)]
+    if len(to_register)==0:
+        return []
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(register_to_standard,*zip(*to_register),[resampler]*len(to_register)))
+
+def stack_maps(standard_files,mask,out=None,n_jobs=1):
+    # fill x by y by z by participant (float32, zero outside of the mask) with the standard space maps, reading
+    # n_jobs at a time (the decompression is most of the time); out can be a preallocated (e.g., memory-mapped) array
+    if out is None:
+        out=np.empty(mask.shape+(len(standard_files),),dtype=np.float32)
+    brain=mask!=0
+
+    def fill(i):
+        data=np.asarray(nib.load(standard_files[i]).dataobj,dtype=np.float32)
+        if data.shape[:3] != mask.shape:
+            raise ValueError('%s is %s, not the shape of the mask %s' % (standard_files[i],data.shape,mask.shape))
+        out[...,i]=np.where(brain,data.reshape(mask.shape),0)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        list(pool.map(fill,range(len(standard_files))))
+
+    return out
+
+def stack_group_files(suffix,analysis_type,contrast_num,resampler='flirt',n_jobs=1,memmap=False,force=False,
+                      mem_type=None):
+    # make (or keep, if nothing changed) the merged file for randomise and return its name
+    merged_file=merged_file_name(suffix,analysis_type,contrast_num,mem_type)
+    info_file=merged_file.replace('.nii.gz','.json')
+    os.makedirs(os.path.dirname(merged_file),exist_ok=True)
+
+    # the participants with a map (the others are left out, like before)
+    files=[]
+    included=[]
+    for ppt in load_participants(suffix,analysis_type,mem_type):
+        file_name, file_name_standard=subject_files(ppt,analysis_type,contrast_num)
+        if os.path.exists(file_name):
+            files.append((file_name,file_name_standard))
+            included.append(ppt)
+        else:
+            print('zstats not run for sub-%s maybe check why?' % ppt)
+
+    for file_name_standard in register_missing(files,resampler,n_jobs):
+        print('registered %s' % file_name_standard)
+    standard_files=[file_name_standard for _, file_name_standard in files]
+
+    # is the stack already made from these files?
+    info=dict(participants=included, inputs=[file_stamp(file_name) for file_name in standard_files],
+              mask=file_stamp(mask_file))
+    if not force and os.path.exists(merged_file) and os.path.exists(info_file):
+        with open(info_file) as f:
+            if json.load(f)==info:
+                print('%s is up to date with its %d participants' % (merged_file,len(included)))
+                return merged_file
+
+    print('Stacking %d participants into %s' % (len(included),merged_file))
+    mask_nii=nib.load(mask_file)
+    mask=np.asarray(mask_nii.dataobj)
+    out=None
+    if memmap:
+        # keep the stack on disk rather than in memory while it is filled
+        memmap_file=merged_file.replace('.nii.gz','.tmp.npy')
+        out=np.lib.format.open_memmap(memmap_file,mode='w+',dtype=np.float32,shape=mask.shape+(len(included),))
+    stack=stack_maps(standard_files,mask,out,n_jobs)
+
+    merged_nii=nib.Nifti1Image(stack,mask_nii.affine,header=mask_nii.header)
+    merged_nii.set_data_dtype(np.float32)
+    tmp_file=merged_file.replace('.nii.gz','.tmp.nii.gz')
+    nib.save(merged_nii,tmp_file)
+    os.replace(tmp_file,merged_file)
+    if memmap:
+        del stack, out, merged_nii
+        os.remove(memmap_file)
+
+    with open(info_file,'w') as f:
+        json.dump(info,f,indent=1)
+
+    return merged_file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stack the participants\' maps into one 4D file for randomise')
+    parser.add_argument('suffix', help='group of participants, e.g., all, comp, pi')
+    parser.add_argument('analysis_type', help='for instance FaceObject or trialwise_detailed')
+    parser.add_argument('contrast_num', help='for instance zstat3, or difference for mvpa')
+    parser.add_argument('--resampler', default='flirt', choices=['flirt','nibabel'],
+                        help='how to put the maps in standard space (default: flirt; nibabel does not need FSL)')
+    parser.add_argument('--n-jobs', default=int(os.environ.get('SLURM_CPUS_PER_TASK',os.cpu_count())), type=int,
+                        help='maps to register and read at once (default: the cores slurm gives the job, or all)')
+    parser.add_argument('--memmap', action='store_true', help='fill the stack on disk instead of in memory')
+    parser.add_argument('--force', action='store_true', help='make the stack even if nothing changed')
+    parser.add_argument('--mem-type', help='use the participants of this memory design (detailed or recog)')
+    args = parser.parse_args()
+
+    stack_group_files(args.suffix,args.analysis_type,args.contrast_num,args.resampler,args.n_jobs,args.memmap,
+                      args.force,args.mem_type)
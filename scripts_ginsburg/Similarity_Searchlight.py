@@ -7,6 +7,11 @@
 # 04262024
 # allow the possibility of also looking at pre- and post-encoding separately
 # 07112024
+# kernel functions moved to reinstatement_utils.py, with an analytic option for the summed z-scores
+# 10182026
+#
+# example command: python scripts_ginsburg/Similarity_Searchlight.py 002 trialwise_detailed --zscore-mode analytic
+# on a workstation without MPI: python scripts_ginsburg/Similarity_Searchlight.py 002 trialwise_detailed --backend local
 
 ######################################################################################
 ########## Step 1: Import stuff
@@ -14,347 +19,535 @@
 # Import a few things 
 import warnings
 warnings.filterwarnings('ignore')
+import os
+import argparse
+import contextlib
+import json
+import functools
+import time
 import numpy as np
-import pandas as pd
-import sys 
-import scipy.stats as stats
 import nibabel as nib
+import searchlight_profile
 from nibabel.processing import conform
-from nilearn import image 
-from brainiak.fcma.util import compute_correlation
-from brainiak.searchlight.searchlight import Searchlight
-from mpi4py import MPI
-
-# Pull out the MPI information, make sure the rank is called rank
-comm = MPI.COMM_WORLD
-rank = comm.rank
-size = comm.size
-
-# define the path and some file names 
-base_dir='' # ommitted for privacy 
-mvpa_preproc_path='%s/mvpa_preproc_files/' % base_dir
-output_path='%s/similarity_searchlight/' % base_dir
-timing_path='%s/Ginsburg_Timing_Info/' % base_dir
+from searchlight_data import output_path, get_tasks, load_trial_info, load_zscored_run, \
+    make_center_ids, run_file, load_zscored_slab, load_cached_run, cached_run_volume, cached_run_block, distribute_from_cache, \
+    file_stamp, mask_file, load_native_atlas, load_atlas_names, cached_native_mask, native_grid, trial_info_files
+from reinstatement_utils import reinstatement_kernel, slab_correlation_kernel, zscore_modes, make_trial_operator, \
+    variant_labels, output_labels, null_output_labels, make_permutations
+from sliding_searchlight import split_rows
+from searchlight_scheduler import default_pool_size, center_costs, block_costs, balance, balance_report, \
+    scatter_blocks, share_blocks, release_shared, run_blocks, run_sliding_pool, empty_results, add_results
+from searchlight_checkpoint import checkpoint_dir, save_checkpoint, finished_units, load_checkpoint_chunks
+from precision_check import compare_precision
+from searchlight_profile import profile_report
+from roi_reinstatement import parcel_outputs, roi_table, roi_output_name
+
+# which quantiles of the permutation null to save
+null_quantile_levels=[0.025,0.05,0.5,0.95,0.975]
 
 # add a random seed for the bootstrapping stuff !! 
-np.random.seed(0)
+# every searchlight center gets its own stream from this seed (see center_rng), so results do not
+# depend on how the blocks are split across MPI ranks
+random_seed=0
 
 ######################################################################################
 ####### Step 2 - load in the data
 
-# which subject are you using?
-sub_id=sys.argv[1]
-elfk_id='EL%s'% sub_id #elfk ID form
-sub_id='sub-%s'% sub_id #subject ID form
-
-# which similarity analysis are you running? 
+parser = argparse.ArgumentParser(description='Run the reinstatement similarity searchlight for one or more '
+                                             'participants')
+# several participants are run one after the other in the same job (see Step 5)
+parser.add_argument('sub_id', help='participant ID number, e.g., 002, or several separated by commas (002,003,004), '
+                                   'or a text file with an ID on each line')
 # persistence (vox x vox similarity post > pre) or trialwise (reinstatement of trials) by memory type 
-analysis_type=sys.argv[2] 
-
-# preset
-bcvar=[]
-data=[]
-
-# first get the encoding trial information if you are running a trialwise analysis 
-if 'trialwise' in analysis_type:
-
-    # first get the timing that we care about 
-    timing_all=np.loadtxt('%s/%s_trial_timing.txt' %(timing_path,elfk_id))
-    bcvar.append(timing_all)
-    
-    memory_regs=pd.read_csv('%s/%s_memory_regressors.csv' %(timing_path,elfk_id))
-    
-    # then get the values for the specific type we are looking at (recognition, coarse, detailed)
-    memory_reg = memory_regs[analysis_type.split('_')[1]]
-    bcvar.append(np.array(memory_reg))
-    
-else:
-    bcvar.append([None]) # Nothing in the first part of the bcvar 
-    bcvar.append([None]) # Nothing in the second part of the bcvar 
-    
-# which tasks are we getting  -- note that one subject had rest run 3 instead of rest run 2
-if sub_id == 'sub-141':
-	tasks=['memory_run-1','rest_run-1','rest_run-3']
+parser.add_argument('analysis_type', help='which similarity analysis, e.g., trialwise_detailed')
+# several memory regressors (columns of the *_memory_regressors.csv) and variants can be run off the same correlations
+# each regressor is saved as its own analysis type (e.g., trialwise_recognition)
+parser.add_argument('--regressors', nargs='+', default=None,
+                    help='memory regressors to run (default: the one in the analysis type, e.g., detailed)')
+parser.add_argument('--variants', nargs='+', default=['corrected'], choices=list(variant_labels),
+                    help='corrected (post - pre) and/or uncorrected (pre and post separately) (default: corrected)')
+# the permutation null shuffles the memory labels across trials and reuses each center's correlations
+# (fastest with --zscore-mode analytic, which does all of the shuffles at once)
+parser.add_argument('--permutations', default=0, type=int,
+                    help='number of memory label shuffles for a permutation null of the difference maps (default: 0)')
+parser.add_argument('--save-null', action='store_true',
+                    help='also save the whole null distribution of every voxel (native space .npz)')
+# read the masked, z-scored runs from the cache (made the first time, and again whenever the run or mask changes)
+parser.add_argument('--cache', action='store_true', help='load the runs through the cache in searchlight_data.py')
+parser.add_argument('--cache-dtype', default=None, choices=['float64','float32'],
+                    help='precision of the cached runs (default: the same as --precision)')
+# every rank reads only its own part of the runs from the cache, instead of rank 0 loading and sending everything
+parser.add_argument('--distributed-load', action='store_true',
+                    help='each rank reads its own blocks straight from the cache (implies --cache)')
+# bootstrap resamples 1000 times per center, analytic uses the closed form of the same z-score (much faster)
+parser.add_argument('--zscore-mode', default='bootstrap', choices=zscore_modes,
+                    help='how to calculate the summed z-scores (default: bootstrap)')
+parser.add_argument('--tr-length', default=2, type=float, help='TR length in seconds (default: 2)')
+# brainiak rebuilds every searchlight, sliding keeps running sums as the searchlight moves (sliding_searchlight.py)
+parser.add_argument('--engine', default='brainiak', choices=['brainiak','sliding'],
+                    help='which searchlight engine to use (default: brainiak)')
+# the blocks (or rows) are balanced across ranks by how many full searchlights they have, and each rank runs its
+# share on a pool of workers that read the data from shared memory (searchlight_scheduler.py)
+parser.add_argument('--pool-size', default=None, type=int,
+                    help='worker processes per rank (default: SLURM_CPUS_PER_TASK, or outside of slurm 1 for the '
+                         'MPI backend and all cores for the local backend)')
+parser.add_argument('--max-blk-edge', default=5, type=int,
+                    help='largest edge of the blocks the brainiak engine splits the volume into (default: 5)')
+# save every finished block as the job goes, so a job that runs out of time can be started again where it stopped
+parser.add_argument('--checkpoint', action='store_true',
+                    help='save finished blocks and skip the ones a previous job with the same settings finished')
+# mpi runs brainiak's Searchlight over MPI ranks, local runs the same searchlight on one node without MPI or brainiak
+parser.add_argument('--backend', default='mpi', choices=['mpi','local'],
+                    help='mpi (brainiak and mpi4py) or local (numpy only, one node) (default: mpi)')
+# fewer files for the group analyses: one 4D file per job instead of one per output
+parser.add_argument('--multi-volume', action='store_true',
+                    help='save all of the outputs as one 4D NIfTI (with a .json of the volume order) instead of a '
+                         'file for each')
+# float32 halves the memory of the runs (and everything made from them); before it starts, the outputs at a sample of
+# centers are checked against float64, and the job stops if too many of them are further apart than the tolerance
+# (see precision_check.py)
+parser.add_argument('--precision', default='float64', choices=['float64','float32'],
+                    help='precision of the runs and the encoding trials (default: float64)')
+parser.add_argument('--precision-check', default=50, type=int,
+                    help='number of centers to compare float32 with float64 on (default: 50, 0 to skip)')
+parser.add_argument('--precision-tolerance', default=1e-3, type=float,
+                    help='largest difference in the z-scores for the precision check (default: 0.001)')
+parser.add_argument('--precision-max-fraction', default=0.02, type=float,
+                    help='fraction of the checked outputs allowed over the tolerance (default: 0.02)')
+# ROI mode: the same outputs once for every parcel of a labelled atlas instead of the searchlight, saved as a table
+# (roi_reinstatement.py); only rank 0 does anything, so this is best run with --backend local
+parser.add_argument('--atlas', default=None,
+                    help='labelled atlas (in the space of the brain mask) to run the parcels of instead of the '
+                         'searchlight')
+parser.add_argument('--atlas-labels', default=None,
+                    help='text file with a label and a name on each line, for the parcel names in the table')
+# time every stage of the kernels and count the centers (and skipped centers) on every rank, and save it all as a
+# report with the outputs (searchlight_profile.py); when this is off, the kernels only check a flag
+parser.add_argument('--profile', action='store_true',
+                    help='save a report of the time spent in each stage of the kernels and by each rank')
+args = parser.parse_args()
+searchlight_profile.enable(args.profile)
+if args.atlas is not None:
+    args.distributed_load = False # rank 0 needs all of the data
+if args.distributed_load:
+    args.cache = True
+if args.pool_size is None:
+    args.pool_size = default_pool_size(args.backend)
+if args.cache_dtype is None:
+    args.cache_dtype = args.precision
+
+# Pull out the MPI information, make sure the rank is called rank
+# (brainiak and mpi4py are only imported for the MPI backend)
+if args.backend == 'mpi':
+    from brainiak.searchlight.searchlight import Searchlight
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    block_fn = None # brainiak's _singlenode_searchlight
 else:
-	tasks=['memory_run-1','rest_run-1','rest_run-2']
+    from local_searchlight import LocalSearchlight as Searchlight, SerialComm, singlenode_searchlight as block_fn
+    comm = SerialComm()
+rank = comm.rank
+size = comm.size
 
-# only load in the data on rank 0 though 
-if rank ==0:
-    for task in tasks:
-        preproc_file='%s/%s_task-%s_filtered_func_data.nii.gz' %(mvpa_preproc_path, sub_id, task)
-        data_4d=nib.load(preproc_file) # load 
-        data_4d_zscore = stats.zscore(data_4d.get_fdata(),axis=3) # zscore over time
-        data.append(data_4d_zscore) # append
+# what has been put in native space so far (the atlas and the standard space resampling), by grid, so that
+# participants on the same grid share it
+native_spaces = dict()
 
-else:
-    data += [None]
+def subject_list(sub_ids):
+    # the participants to run: one ID, several separated by commas, or a text file with an ID on each line
+    if os.path.isfile(sub_ids):
+        with open(sub_ids) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
 
-print("Loaded participant %s \n" % (elfk_id))
+    return sub_ids.split(',')
 
-# get brain mask (intersect of all participants)
-brain_nii=nib.load('/burg/psych/users/elfk/tsy2105/intersect_mask.nii.gz')
-affine_mat_standard = brain_nii.affine
-dimsize = brain_nii.header.get_zooms()
+def run_subject(sub):
+    # the whole searchlight (or ROI table) for one participant, with the imports and MPI set up above shared by
+    # every participant in the queue
 
-# Now put it in native space for running the searchlight
-brain_nii_native = conform(brain_nii, out_shape =data_4d.shape[:3],
-                                    voxel_size = (data_4d.affine[0,0],
-                                                  data_4d.affine[1,1],
-                                                  data_4d.affine[2,2])) # put in the same shape as native brain 
-brain_nii_native = image.binarize_img(brain_nii_native,threshold=0.1) # binarize the image 
-affine_mat_native = brain_nii_native.affine
+    # which subject are you using?
+    elfk_id='EL%s'% sub #elfk ID form
+    sub_id='sub-%s'% sub #subject ID form
 
-######################################################################################
-####### Step 3 - set up the searchlight
+    # which similarity analysis are you running? 
+    analysis_type=args.analysis_type
 
-mask=brain_nii_native.get_fdata()
-sl_rad = 3
-max_blk_edge = 5
-pool_size = 1
+    # which memory regressors? (by default just the one in the analysis type, e.g., detailed for trialwise_detailed)
+    if args.regressors is None:
+        regressors=[analysis_type.split('_')[1]]
+    else:
+        regressors=args.regressors
+
+    # preset
+    bcvar=dict(random_seed=random_seed, zscore_mode=args.zscore_mode, variants=args.variants)
+    data=[]
 
-# Create the searchlight object
-sl = Searchlight(sl_rad=sl_rad,max_blk_edge=max_blk_edge)
+    # first get the encoding trial information if you are running a trialwise analysis 
+    if 'trialwise' in analysis_type:
+        bcvar['timing_all'], bcvar['memory_regs'] = load_trial_info(elfk_id,regressors)
 
-# Distribute the information to the searchlights (note that data is already a list)
-sl.distribute(data, mask)
+        # the shuffles for the permutation null are the same for every center (so the null maps line up)
+        if args.permutations > 0:
+            bcvar['permutations'] = make_permutations(len(bcvar['memory_regs'][0]),args.permutations,random_seed)
+    else:
+        bcvar['timing_all'] = None # Nothing for the timing
+        bcvar['memory_regs'] = None # Nothing for the memory regressors
+    bcvar['trial_operator'] = None # made from the timing once the data are loaded
+
+    tasks=get_tasks(sub_id)
+    load_start = time.perf_counter()
+
+    # the sliding engine's ranks each run a slab of rows, so every rank reads only its slab of the runs (plus the
+    # searchlight radius) in Step 4, from the cache or the NIfTIs, rather than every rank loading the whole runs
+    sliding_slabs = args.engine=='sliding' and args.atlas is None
+    cached_runs = None
+
+    # with a distributed load, every rank opens the cache and reads its own part of it later
+    if args.distributed_load or (sliding_slabs and args.cache):
+
+        # make (or update) the cache on rank 0 first, then everyone opens it (memory-mapped, so nothing is read yet)
+        if rank == 0:
+            for task in tasks:
+                load_cached_run(sub_id,task,args.cache_dtype)
+        comm.Barrier()
+        cached_runs = [load_cached_run(sub_id,task,args.cache_dtype) for task in tasks]
+        data_4d = nib.load(run_file(sub_id,tasks[0])) # just the header, for the native space
+
+        if bcvar['timing_all'] is not None:
+            bcvar['trial_operator'] = make_trial_operator(bcvar['timing_all'],cached_runs[0]['shape'][3],
+                                                          args.tr_length).astype(args.precision)
+
+    elif sliding_slabs:
+        data += [None]*(len(tasks)+1) # read in Step 4
+        data_4d = nib.load(run_file(sub_id,tasks[0])) # just the header, for the native space
+
+        if bcvar['timing_all'] is not None:
+            bcvar['trial_operator'] = make_trial_operator(bcvar['timing_all'],data_4d.shape[3],
+                                                          args.tr_length).astype(args.precision)
+
+    # otherwise only load in the data on rank 0 though
+    elif rank ==0:
+        for task in tasks:
+            if args.cache:
+                data_4d_zscore = cached_run_volume(load_cached_run(sub_id,task,args.cache_dtype))
+                data_4d = nib.load(run_file(sub_id,task)) # just the header
+            else:
+                data_4d_zscore, data_4d = load_zscored_run(sub_id,task,args.precision)
+            data.append(data_4d_zscore) # append
+
+        # also add a volume of voxel indices so each searchlight knows which center it is (for the random streams)
+        data.append(make_center_ids(data_4d.shape[:3]))
+
+        # make the trial averaging matrix once here, it is broadcast with the rest of the bcvar
+        if bcvar['timing_all'] is not None:
+            bcvar['trial_operator'] = make_trial_operator(bcvar['timing_all'],data[0].shape[3],
+                                                          args.tr_length).astype(args.precision)
 
-sl.broadcast(bcvar)
+    else:
+        data += [None]*(len(tasks)+1) # one for every run plus the center indices
+        data_4d = nib.load(run_file(sub_id,tasks[0])) # just the header, for the native space
+
+    print("Loaded participant %s \n" % (elfk_id))
+    load_seconds = time.perf_counter() - load_start
+
+    # get brain mask (intersect of all participants) and put it in native space for running the searchlight
+    # (once for every grid, the subjects of a queue share it)
+    brain_nii, brain_nii_native = cached_native_mask(data_4d)
+    affine_mat_standard = brain_nii.affine
+    dimsize = brain_nii.header.get_zooms()
+    affine_mat_native = brain_nii_native.affine
 
 ######################################################################################
-####### Step 4 - define kernel and its internal functions
-# Note the most important function is reinstatement_kernel which is passed to the searchlight. It then calls the other functions
-
-def bootstrap_summed_diff_zscore(data_1,data_2,nPerm=1000):
-   # bootstrap resampling for the difference in two different data distributions
-   # instead of averaging, though, sum over values 
-    perm_dist_1=np.zeros(nPerm)
-    perm_dist_2=np.zeros(nPerm)
-    for perm in range(nPerm):
-        # get it for data 1 
-        sampidx=np.random.choice(np.arange(len(data_1)),len(data_1),replace=True)
-        perm_dist_1[perm] = np.nansum(np.array(data_1)[sampidx])
-    
-        # get it for data 2
-        sampidx=np.random.choice(np.arange(len(data_2)),len(data_2),replace=True)
-        perm_dist_2[perm] = np.nansum(np.array(data_2)[sampidx])
-        
-    # turn it into a zscore = mean of diff minus the null (which is 0) divided by standard dev of the diff
-    diff_dist = perm_dist_1 - perm_dist_2
-    zscore=(np.mean(diff_dist))/np.std(diff_dist)
-   
-    return zscore, diff_dist
-
-def convert_encode_data_to_trials(preproc_data,timing_all):
-    # turn a vox by TR array into a trial by vox array based on timing information 
-    
-    all_trials = [] 
-    
-    for i in range(timing_all.shape[0]):
-        # What is the time stamp
-        time = timing_all[i,0]
-
-        # What TR does this timepoint refer to?
-        TR_start = int(time / 2) # TR length is 2 
-
-        # What TR does this timepoint refer to?
-        TR_end = int((time+timing_all[i,1])/2) # TR length is 2 
-
-        # Add the condition label to this timepoint
-        trial_pattern = np.nanmean(preproc_data[:,TR_start:TR_end],axis=1)
-
-        # add the trials
-        all_trials.append(trial_pattern)
-
-    # then stack 
-    all_trials = np.stack(all_trials)
-
-    return all_trials.T
-
-
-def calculate_trialwise_reinstatement(enc_trialwise_data,rest1_data,rest2_data,memory_reg):
-    # correlate the activity pattern of each encoding trial with every possible TR in rest runs
-    # calculate how much these patterns were activated on average (reinstated) and then subtract
-    # post vs. pre rest run for remembered vs. forgotten encoding trials
-    
-    # correlate every event trial with every rest TR, using brainiak tools to speed up the process 
-    tr_corr_pre = compute_correlation(enc_trialwise_data.T.copy(order='C'),rest1_data.T.copy(order='C'))
-    tr_corr_post = compute_correlation(enc_trialwise_data.T.copy(order='C'),rest2_data.T.copy(order='C'))
-
-    # preset 
-    zscore_vals=dict()
-    distribution_vals =dict()
-    for mem_idx, mem_type in enumerate(['forgotten','remembered']):
-
-        # Step 1: threshold the pre-rest by memory behavior for both pre and post rest 
-        memory_idxs = np.array(memory_reg)==mem_idx # find the indices 
-        
-        # threshold the pre rest by memory behavior 
-        tr_corr_pre_thresh=tr_corr_pre.copy()
-        tr_corr_pre_thresh[~memory_idxs]=np.nan
-
-        # and threshold the post rest by memory behavior 
-        tr_corr_post_thresh=tr_corr_post.copy()
-        tr_corr_post_thresh[~memory_idxs]=np.nan
-
-        # Step 2: threshold the correlations that are greater than 1.5 sds from the mean
-        pre_idxs = tr_corr_pre_thresh > np.nanmean(tr_corr_pre_thresh)+np.nanstd(tr_corr_pre_thresh)*1.5
-        tr_corr_pre_thresh[~pre_idxs]=np.nan
-
-        post_idxs = tr_corr_post_thresh > np.nanmean(tr_corr_post_thresh)+np.nanstd(tr_corr_post_thresh)*1.5
-        tr_corr_post_thresh[~post_idxs]=np.nan
-
-        # Step 3: turn the post - pre values into z-scores for later analysis 
-        zscore, diff_dist = bootstrap_summed_diff_zscore(tr_corr_post_thresh[~np.isnan(tr_corr_post_thresh)],
-                                             tr_corr_pre_thresh[~np.isnan(tr_corr_pre_thresh)])
-        # save them out 
-        zscore_vals[mem_type]=zscore
-        distribution_vals[mem_type] = diff_dist
-    
-    # Step 4: get the difference of remem and forgotten 
-    zscore_diff=(np.mean(distribution_vals['remembered'] -
-                         distribution_vals['forgotten']))/np.std(distribution_vals['remembered'] - 
-                                                                 distribution_vals['forgotten'])
-
-    return [zscore_vals['remembered'], zscore_vals['forgotten'], zscore_diff]
-
-def calculate_trialwise_reinstatement_uncorrected(enc_trialwise_data,rest1_data,rest2_data,memory_reg):
-    # correlate the activity pattern of each encoding trial with every possible TR in rest runs
-    # calculate how much these patterns were activated on average (reinstated) and then subtract
-    # remembered vs. forgotten encoding trials (i.e., don't subtract post vs. pre here) 
-    
-    # correlate every event trial with every rest TR, using brainiak tools to speed up the process 
-    tr_corr_pre = compute_correlation(enc_trialwise_data.T.copy(order='C'),rest1_data.T.copy(order='C'))
-    tr_corr_post = compute_correlation(enc_trialwise_data.T.copy(order='C'),rest2_data.T.copy(order='C'))
-
-    # preset 
-    pre_vals=dict()
-    post_vals=dict()
-    for mem_idx, mem_type in enumerate(['forgotten','remembered']):
-
-        # Step 1: threshold the pre-rest by memory behavior for both pre and post rest 
-        memory_idxs = np.array(memory_reg)==mem_idx # find the indices 
-        
-        # threshold the pre rest by memory behavior 
-        tr_corr_pre_thresh=tr_corr_pre.copy()
-        tr_corr_pre_thresh[~memory_idxs]=np.nan
-
-        # and threshold the post rest by memory behavior 
-        tr_corr_post_thresh=tr_corr_post.copy()
-        tr_corr_post_thresh[~memory_idxs]=np.nan
-
-        # Step 2: threshold the correlations that are greater than 1.5 sds from the mean
-        pre_idxs = tr_corr_pre_thresh > np.nanmean(tr_corr_pre_thresh)+np.nanstd(tr_corr_pre_thresh)*1.5
-        tr_corr_pre_thresh[~pre_idxs]=np.nan
-
-        post_idxs = tr_corr_post_thresh > np.nanmean(tr_corr_post_thresh)+np.nanstd(tr_corr_post_thresh)*1.5
-        tr_corr_post_thresh[~post_idxs]=np.nan
-
-        # !!! This part differs !!! 
-        # Step 3: save out the values 
-        pre_vals[mem_type]=tr_corr_pre_thresh[~np.isnan(tr_corr_pre_thresh)]
-        post_vals[mem_type]=tr_corr_post_thresh[~np.isnan(tr_corr_post_thresh)]
-    
-    # Step 4: get the difference of remem and forgotten for post and pre encoding separately
-    zscore_diff_pre, _ = bootstrap_summed_diff_zscore(pre_vals['remembered'],pre_vals['forgotten'])
-    zscore_diff_post, _ = bootstrap_summed_diff_zscore(post_vals['remembered'],post_vals['forgotten'])
-
-    return [zscore_diff_pre, zscore_diff_post]
-    
-
-def reinstatement_kernel(data,sl_mask,myrad,bcvar):
-    #'''Searchlight kernel that reshapes the data and decides whether there are enough voxels to run the algorithm'''
-    
-    timing_all=bcvar[0] # timing of encoding trials during the memory task
-    memory_reg=bcvar[1] # memory regressor
-    
-    # Make sure that we mask the data
-    sl_mask_1d=sl_mask.reshape(sl_mask.shape[0] * sl_mask.shape[1] * sl_mask.shape[2]) # 1 dimensional sl mask
-    
-    #only run this operation if the number of brain voxels is greater than a certain amount
-    if np.sum(sl_mask) >= 50:
-        
-        ## first reshape the data and preprocess it 
-        # cycle through the different runs
-        preproc_dict=dict()
-        for r, run in enumerate(['memory','rest1','rest2']):
-             
-            # reshape 
-            reshaped = data[r].reshape(sl_mask.shape[0] * sl_mask.shape[1] * sl_mask.shape[2], 
-                                             data[r].shape[3]).T
-
-            # Mask the data so that we only include data that is inside of the brain 
-            # (otherwise we may get weird input from non-brain)
-            masked_data=reshaped[:,sl_mask_1d==1]
-            
-            # change the orientation
-            preproc_data = masked_data.T
-            
-            # add to the dictionary
-            preproc_dict[run]=preproc_data
-            
-            # then if the run is the memory run, make the encode trial data
-            if run =='memory':
-                enc_trialwise_data = convert_encode_data_to_trials(preproc_data,timing_all)
-        
-#         # Get the output (post_remem - pre_remem) - (post_forg - post_remem)
-        output = calculate_trialwise_reinstatement(enc_trialwise_data,preproc_dict['rest1'],
-                                                  preproc_dict['rest2'],memory_reg)
-        
-        # Get the output (post_remem - post_forg) AND (pre_remem - pre_forg)
-#         output = calculate_trialwise_reinstatement_uncorrected(enc_trialwise_data,preproc_dict['rest1'],
-#                                                   preproc_dict['rest2'],memory_reg)
-        
+####### Step 3 - set up the searchlight
+
+    mask=brain_nii_native.get_fdata()
+    sl_rad = 3
+    max_blk_edge = args.max_blk_edge
+    pool_size = args.pool_size
+
+    # what are all of the outputs? (remembered, forgotten, difference for corrected; difference_pre, difference_post
+    # for uncorrected; for each regressor) and then the permutation nulls, if there are any
+    labels = output_labels(regressors,args.variants)
+    nulls = null_output_labels(regressors,args.variants) if args.permutations > 0 else []
+    n_outputs = len(labels) + len(nulls)*args.permutations
+
+    # in ROI mode, run every parcel on rank 0, save the table and stop here
+    if args.atlas is not None:
+        if rank == 0:
+            output_suffix = '' if args.zscore_mode == 'bootstrap' else '_%s' % args.zscore_mode
+            grid = native_grid(data_4d)
+            if (grid,'atlas') not in native_spaces:
+                native_spaces[grid,'atlas'] = load_native_atlas(args.atlas,data_4d)
+            parcels, n_voxels, roi_outputs = parcel_outputs(data[:3],native_spaces[grid,'atlas'],mask,bcvar,n_outputs)
+            parcel_names = load_atlas_names(args.atlas_labels) if args.atlas_labels is not None else None
+            output_name = roi_output_name(sub_id,analysis_type,args.atlas,output_suffix)
+            roi_table(sub_id,parcels,n_voxels,roi_outputs,labels,nulls,args.permutations,parcel_names).to_csv(
+                output_name,index=False)
+            print('Saved %d parcels to %s' % (len(parcels),output_name))
+        return
+
+    # with float32, first make sure the outputs are close enough to float64 (on rank 0, everyone stops if they are not)
+    if args.precision == 'float32' and args.precision_check > 0 and bcvar['timing_all'] is not None:
+        check_passed = None
+        if rank == 0:
+            precision_check = compare_precision(sub_id,tasks,mask,bcvar,sl_rad,len(labels),args.precision_check,
+                                                random_seed,args.precision_tolerance)
+            check_passed = precision_check['fraction_over_tolerance'] <= args.precision_max_fraction
+            print('float32 vs. float64 on %d centers: median abs diff %0.2e, %0.1f%% of outputs over %0.0e' % (
+                precision_check['n_centers'],precision_check['median_abs_diff'],
+                100*precision_check['fraction_over_tolerance'],args.precision_tolerance))
+            with open('%s/%s_%s_precision_check.json' %(output_path,sub_id,analysis_type),'w') as f:
+                json.dump(precision_check,f,indent=1)
+        if not comm.bcast(check_passed):
+            raise SystemExit('too many float32 outputs are further from float64 than --precision-tolerance, '
+                             'run with float64')
+
+    # how much work is each searchlight center? (centers with too few brain voxels are almost free)
+    costs = center_costs(mask,sl_rad)
+
+    # with a checkpoint, skip the blocks (or rows) that a previous job with the same settings and inputs finished
+    checkpoint_run = None
+    finished = set()
+    if args.checkpoint:
+        if rank == 0:
+            settings = dict(sub_id=sub_id, analysis_type=analysis_type, regressors=regressors, variants=args.variants,
+                            zscore_mode=args.zscore_mode, permutations=args.permutations, tr_length=args.tr_length,
+                            random_seed=random_seed, engine=args.engine, sl_rad=sl_rad, max_blk_edge=max_blk_edge,
+                            precision=args.precision, cache_dtype=args.cache_dtype if args.cache else None,
+                            runs=[file_stamp(run_file(sub_id,task)) for task in tasks], mask=file_stamp(mask_file),
+                            trial_info=[file_stamp(file_name) for file_name in trial_info_files(elfk_id)])
+            checkpoint_run = checkpoint_dir(sub_id,analysis_type,settings)
+            finished = finished_units(checkpoint_run)
+            print('Checkpoint %s has %d finished %s' % (checkpoint_run,len(finished),
+                                                        'blocks' if args.engine=='brainiak' else 'rows'))
+        checkpoint_run, finished = comm.bcast((checkpoint_run,finished))
+
+    if args.engine=='brainiak':
+        # Create the searchlight object
+        sl = Searchlight(sl_rad=sl_rad,max_blk_edge=max_blk_edge)
+
+        # balance the blocks across the ranks by their cost (each rank gets its blocks most expensive first)
+        all_blocks = [block for block in sl._get_blocks(mask) if tuple(block[0]) not in finished]
+        rank_blocks, predicted_costs = balance(block_costs(all_blocks,costs,sl_rad),size)
+        rank_blocks = [[all_blocks[b] for b in blocks] for blocks in rank_blocks]
+        n_items = [len(blocks) for blocks in rank_blocks]
+
+        # Distribute the information to the searchlights (note that data is already a list)
+        if args.distributed_load:
+            distribute_from_cache(sl,cached_runs,mask,rank_blocks[rank])
+        else:
+            scatter_blocks(sl,data,mask,rank_blocks,comm)
+
+        # the pool workers read the blocks from shared memory
+        shared_blocks = share_blocks(sl) if pool_size > 1 else None
+
+        sl.broadcast(bcvar)
+
     else:
-        output=np.nan
-        
-    return output
+        # each rank takes a run of neighbouring rows of centers with about the same cost
+        for row in finished:
+            costs[row] = 0
+        rank_rows = [[row for row in rows if row not in finished] for rows in split_rows(mask,sl_rad,size,costs)]
+        predicted_costs = [sum(costs[i,j].sum() for (i,j) in rows) for rows in rank_rows]
+        n_items = [len(rows) for rows in rank_rows]
 
 #############################################################
 #############################################################
 #####Step 4 - go go go searchlight !!
+# Note the most important function is reinstatement_kernel (in reinstatement_utils.py) which is passed to the searchlight
+
+    print("Begin SearchLight in rank %s\n" % rank)
+    searchlight_start = time.perf_counter()
+    searchlight_profile.take() # start the profile over here (e.g., the precision check runs the kernel too)
+
+    if args.engine=='brainiak':
+        def block_done(block, chunk):
+            # save each block to the checkpoint as it finishes
+            save_checkpoint(checkpoint_run,'block_%d_%d_%d' % tuple(block[0]),[block[0]],chunk)
 
-print("Begin SearchLight in rank %s\n" % rank)
-
-all_sl_result = sl.run_searchlight(reinstatement_kernel,pool_size=pool_size)
-
-print("End SearchLight in rank %s\n" % rank)
-
-# save the data if on rank 0
-if rank == 0:
-    
-    coords = np.where(mask)
-    
-    all_sl_result = all_sl_result[mask==1]
-    all_sl_result = [3*[0] if not n else n for n in all_sl_result] # replace all None
-    
-    # cycle through remembered vs. forgotten 
-    for i, label in enumerate(['remembered','forgotten','difference']):
-    
-    # cycle through post vs. pre 
-    #for i, label in enumerate(['difference_pre','difference_post']):
-    
-        # get the values and turn them into a double, removing the nans 
-        sl_result = [r[i] for r in all_sl_result]
-        #print(label,sl_result)
-        
-        result_vol = np.zeros((mask.shape[0], mask.shape[1], mask.shape[2]))  
-        result_vol[coords[0], coords[1], coords[2]] = sl_result   
-        result_vol = result_vol.astype('double')
-        result_vol[np.isnan(result_vol)] = 0
-
-        # Save the results!
-        output_name = '%s/%s_%s_%s_summed_zscore_v2.nii.gz' %(output_path,sub_id,analysis_type,label)
-        sl_nii_native = nib.Nifti1Image(result_vol, affine_mat_native)
-        sl_nii_standard = conform(sl_nii_native, out_shape =brain_nii.shape,
-                                        voxel_size = (affine_mat_standard[0,0],
-                                                      affine_mat_standard[1,1],
-                                                      affine_mat_standard[2,2]),order=0)
+        results, busy_time = run_blocks(sl,reinstatement_kernel,n_outputs,pool_size,
+                                        block_done if checkpoint_run is not None else None,block_fn)
+        if shared_blocks is not None:
+            release_shared(shared_blocks)
 
+    else:
+        # each rank only needs the x slab its rows cover (plus the radius)
+        my_rows = rank_rows[rank]
+        my_chunks = []
+        busy_time = 0
+        if len(my_rows) > 0:
+            x_start = max(my_rows[0][0]-sl_rad,0)
+            x_end = min(my_rows[-1][0]+sl_rad+1,mask.shape[0])
+            if cached_runs is not None:
+                runs = [cached_run_block(cached_run,(x_start,0,0),(x_end-x_start,)+mask.shape[1:])
+                        for cached_run in cached_runs]
+            else:
+                runs = [load_zscored_slab(sub_id,task,x_start,x_end,args.precision) for task in tasks]
+
+            # the encoding trial patterns for every voxel at once, then slide through the rows (on the pool)
+            start_time = time.perf_counter()
+            enc_trials = runs[0] @ bcvar['trial_operator']
+            center_fn = functools.partial(slab_correlation_kernel,bcvar=bcvar,volume_shape=mask.shape,x_start=x_start)
+
+            def chunk_done(rows, chunk):
+                # save each chunk of rows to the checkpoint as it finishes (back in the coordinates of the volume)
+                chunk = dict(chunk, centers=chunk['centers']+[x_start,0,0])
+                save_checkpoint(checkpoint_run,'rows_%d_%d' % (rows[0][0]+x_start,rows[0][1]),
+                                [(i+x_start,j) for (i,j) in rows],chunk)
+
+            my_chunks = run_sliding_pool(enc_trials,runs[1:3],mask[x_start:x_end],sl_rad,center_fn,
+                                         [(i-x_start,j) for (i,j) in my_rows],n_outputs,pool_size,costs[x_start:x_end],
+                                         chunk_done if checkpoint_run is not None else None)
+            busy_time = time.perf_counter() - start_time
+            for chunk in my_chunks:
+                chunk['centers'] += [x_start,0,0]
+
+        # put it together on rank 0
+        all_chunks = comm.gather(my_chunks)
+        results = None
+        if rank == 0:
+            results = empty_results(mask,n_outputs)
+            for rank_chunks in all_chunks:
+                for chunk in rank_chunks:
+                    add_results(results,chunk)
+
+    # and the blocks that were finished by an earlier job come from the checkpoint
+    if rank == 0 and checkpoint_run is not None:
+        for chunk in load_checkpoint_chunks(checkpoint_run):
+            add_results(results,chunk)
+
+    print("End SearchLight in rank %s\n" % rank)
+
+    # with --profile, gather every rank's profile on rank 0 once they are all done (the time a rank spent waiting
+    # for the others, or with nothing to do, is its idle time) and save the report
+    if args.profile:
+        comm.Barrier()
+        rank_profile = searchlight_profile.take()
+        rank_profile.update(rank=rank, pool_size=pool_size, n_items=n_items[rank], load_seconds=load_seconds,
+                            busy_seconds=busy_time, wall_seconds=time.perf_counter()-searchlight_start)
+        all_profiles = comm.gather(rank_profile)
+        if rank == 0:
+            profile_info = profile_report(all_profiles)
+            profile_info.update(sub_id=sub_id, analysis_type=analysis_type, engine=args.engine,
+                                backend=args.backend, zscore_mode=args.zscore_mode, permutations=args.permutations)
+            totals = profile_info['totals']
+            print('Profile: %d centers (%d skipped), %s per center' % (
+                totals['counts'].get('centers',0),totals['counts'].get('skipped_centers',0),
+                ', '.join('%s %0.2f ms' % (stage,1000*seconds)
+                          for stage, seconds in totals['seconds_per_center'].items())))
+            with open('%s/%s_%s_searchlight_profile.json' %(output_path,sub_id,analysis_type),'w') as f:
+                json.dump(profile_info,f,indent=1)
+
+    # how well were the ranks balanced?
+    all_busy_times = comm.gather(busy_time)
+    if rank == 0:
+        balance_info = balance_report(predicted_costs,all_busy_times,n_items)
+        balance_info.update(engine=args.engine, pool_size=pool_size, max_blk_edge=max_blk_edge)
+        print('Predicted imbalance %0.3f, achieved imbalance %0.3f (slowest rank / average rank)' % (
+            balance_info['predicted_imbalance'],balance_info['achieved_imbalance']))
+        with open('%s/%s_%s_searchlight_balance.json' %(output_path,sub_id,analysis_type),'w') as f:
+            json.dump(balance_info,f,indent=1)
+
+    def standard_space_rows():
+        # which voxel of the results (row, or -1 for none) each voxel in standard space gets its value from
+        # the resampling is nearest neighbour, so it is worked out once by resampling the row numbers and then used for
+        # every output (the same as resampling each output volume on its own)
+        row_vol = np.zeros(mask.shape)
+        row_vol[mask==1] = np.arange(1,np.sum(mask==1)+1)
+        row_nii_standard = conform(nib.Nifti1Image(row_vol, affine_mat_native), out_shape =brain_nii.shape,
+                                   voxel_size = (affine_mat_standard[0,0],
+                                                 affine_mat_standard[1,1],
+                                                 affine_mat_standard[2,2]),order=0)
+
+        return np.rint(row_nii_standard.get_fdata()).astype(int) - 1, row_nii_standard.affine
+
+    def save_standard(values, output_name):
+        # put the values of the voxels in the mask (voxels, or voxels x volumes) in standard space and save it
+        # voxels outside of the mask, and nans, are 0
+        values = np.where(np.isnan(values),0,values).astype('double').reshape(len(values),-1)
+        values = np.vstack([values,np.zeros((1,values.shape[1]))]) # so that row -1 is 0
+        standard_vol = values[standard_rows]
+        if standard_vol.shape[3] == 1:
+            standard_vol = standard_vol[:,:,:,0]
+
+        sl_nii_standard = nib.Nifti1Image(standard_vol, affine_standard)
         hdr = sl_nii_standard.header
-        hdr.set_zooms((dimsize[0], dimsize[1], dimsize[2]))
+        hdr.set_zooms((dimsize[0], dimsize[1], dimsize[2]) + hdr.get_zooms()[3:])
         nib.save(sl_nii_standard, output_name)  # Save
 
-    print('Finished searchlight')
-    
-    
-    
\ No newline at end of file
+    # save the data if on rank 0
+    if rank == 0:
+
+        # keep the analytic maps separate from the bootstrapped ones that go into the group analyses
+        output_suffix = '' if args.zscore_mode == 'bootstrap' else '_%s' % args.zscore_mode
+
+        coords = np.where(mask)
+        grid = native_grid(data_4d)
+        if (grid,'standard_rows') not in native_spaces:
+            native_spaces[grid,'standard_rows'] = standard_space_rows()
+        standard_rows, affine_standard = native_spaces[grid,'standard_rows']
+
+        # voxels x outputs, nan for the voxels without outputs (results['valid'] is False for those)
+        all_sl_result = results['values']
+
+        if args.multi_volume:
+            # every output in one file, with the order of the volumes next to it
+            output_root = '%s/%s_%s_all_outputs_summed_zscore_v2%s' %(output_path,sub_id,analysis_type.split('_')[0],
+                                                                      output_suffix)
+            save_standard(all_sl_result[:,:len(labels)], output_root+'.nii.gz')
+            with open(output_root+'.json','w') as f:
+                json.dump(['%s_%s' % (regressor,label) for regressor, variant, label in labels],f,indent=1)
+        else:
+            # cycle through every regressor and output
+            for i, (regressor, variant, label) in enumerate(labels):
+
+                # Save the results!
+                output_name = '%s/%s_%s_%s_%s_summed_zscore_v2%s.nii.gz' %(output_path,sub_id,
+                                                                         analysis_type.split('_')[0],
+                                                                         regressor,label,output_suffix)
+                save_standard(all_sl_result[:,i], output_name)
+
+        # then the permutation nulls: a p-value map (how often the shuffled z is at least as big as the real one)
+        # and the null quantiles, plus the whole null distribution in native space if asked for
+        for n, (regressor, variant, label) in enumerate(nulls):
+            start = len(labels) + n*args.permutations
+            null_zscores = all_sl_result[:,start:start+args.permutations] # voxels x permutations
+            real_zscores = all_sl_result[:,labels.index((regressor,variant,label))]
+            output_root = '%s/%s_%s_%s_%s' %(output_path,sub_id,analysis_type.split('_')[0],regressor,label)
+
+            p_vals = (1 + np.sum(null_zscores >= real_zscores[:,None],axis=1)) / (1 + args.permutations)
+            p_vals[np.isnan(real_zscores)] = np.nan
+            null_quantiles = np.nanquantile(null_zscores,null_quantile_levels,axis=1).T # voxels x quantiles
+
+            for values, map_name in [(p_vals,'perm_p'),(null_quantiles,'null_quantiles')]:
+                save_standard(values, '%s_%s_summed_zscore_v2%s.nii.gz' %(output_root,map_name,output_suffix))
+
+            if args.save_null:
+                np.savez_compressed('%s_null_summed_zscore_v2%s.npz' %(output_root,output_suffix),
+                                    null_zscores=null_zscores.astype(np.float32), coords=np.array(coords).T,
+                                    affine=affine_mat_native, permutations=bcvar['permutations'])
+
+        print('Finished searchlight')
+
+######################################################################################
+####### Step 5 - run every participant in the queue
+# the imports, MPI, and the native space masks are shared, but every participant has its own outputs and, when
+# there is more than one, its own log (in logs/ in the output directory) instead of the job's output
+
+subjects = subject_list(args.sub_id)
+for s, sub in enumerate(subjects):
+    if len(subjects) == 1:
+        run_subject(sub)
+        continue
+
+    log_file = '%s/logs/sub-%s_%s_searchlight.log' %(output_path,sub,args.analysis_type)
+    if rank == 0:
+        os.makedirs(os.path.dirname(log_file),exist_ok=True)
+        print('Participant %d of %d: sub-%s (log: %s)' % (s+1,len(subjects),sub,log_file), flush=True)
+    comm.Barrier()
+
+    start_time = time.perf_counter()
+    with open(log_file,'a',buffering=1) as log, contextlib.redirect_stdout(log):
+        run_subject(sub)
+    if rank == 0:
+        print('Finished sub-%s in %0.1f s' % (sub,time.perf_counter()-start_time), flush=True)
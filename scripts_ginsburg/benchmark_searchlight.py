@@ -0,0 +1,203 @@
+# Benchmarks of the similarity searchlight on synthetic data (synthetic_data.py), so that changes to the speed of
+# Similarity_Searchlight.py can be measured anywhere, not just on the cluster with the real data
+# This times the kernel functions on one searchlight's worth of voxels (calls per second and peak memory) and then
+# runs the whole searchlight on one node (--backend local, with --profile) for a synthetic participant (centers per
+# second and the peak memory of the largest process). Every run is added to a JSON history, and compared with the
+# last run with the same sizes, so slow-downs show up
+#
+# example command: python scripts_ginsburg/benchmark_searchlight.py --size small --history benchmark_history.json
+#
+# 10182026
+
+import os
+import sys
+import json
+import time
+import runpy
+import platform
+import resource
+import argparse
+import datetime
+import subprocess
+import tempfile
+import tracemalloc
+import numpy as np
+from synthetic_data import make_synthetic_subject, trial_timing, point_to
+from reinstatement_utils import bootstrap_summed_diff_zscore, convert_encode_data_to_trials, \
+    calculate_trialwise_reinstatement, make_trial_operator, compute_correlation, supra_threshold_values
+
+# the sizes of the synthetic participant (volume, TRs per run, encoding trials)
+sizes=dict(small=dict(shape=[20,24,20],n_TRs=100,n_trials=30),
+           medium=dict(shape=[30,36,30],n_TRs=150,n_trials=40),
+           large=dict(shape=[45,54,45],n_TRs=200,n_trials=60))
+
+# how much slower than the last run counts as a slow-down
+slowdown_tolerance=0.1
+
+def time_calls(fn,min_seconds=1.0,max_calls=10000):
+    # call fn for at least min_seconds (after one call to warm up) and return the calls per second and the most
+    # memory allocated during one call (bytes)
+    tracemalloc.start()
+    fn()
+    _, peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    n_calls=0
+    start=time.perf_counter()
+    while time.perf_counter()-start < min_seconds and n_calls < max_calls:
+        fn()
+        n_calls+=1
+
+    return dict(calls_per_second=n_calls/(time.perf_counter()-start), peak_kb=peak/1024)
+
+def benchmark_kernels(n_TRs,n_trials,n_voxels=343,seed=0,min_seconds=1.0):
+    # the kernel functions on made up data for one searchlight (n_voxels is a full 7 x 7 x 7 cube)
+    rng=np.random.default_rng(seed)
+    memory_data, rest1_data, rest2_data=[rng.standard_normal((n_voxels,n_TRs)) for _ in range(3)]
+    timing=trial_timing(n_trials,n_TRs)
+    trial_operator=make_trial_operator(timing,n_TRs)
+    memory_reg=rng.integers(0,2,n_trials)
+    enc_trialwise_data=convert_encode_data_to_trials(memory_data,timing,trial_operator=trial_operator)
+
+    # the supra-threshold values of one memory type for the bootstrap, so it gets as many values as it would
+    tr_corr_pre=compute_correlation(enc_trialwise_data.T.copy(order='C'),rest1_data.T.copy(order='C'))
+    tr_corr_post=compute_correlation(enc_trialwise_data.T.copy(order='C'),rest2_data.T.copy(order='C'))
+    post_vals=supra_threshold_values(tr_corr_post,memory_reg)['remembered']
+    pre_vals=supra_threshold_values(tr_corr_pre,memory_reg)['remembered']
+
+    kernels=dict(
+        convert_encode_data_to_trials=lambda: convert_encode_data_to_trials(memory_data,timing,
+                                                                            trial_operator=trial_operator),
+        bootstrap_summed_diff_zscore=lambda: bootstrap_summed_diff_zscore(post_vals,pre_vals,
+                                                                          rng=np.random.default_rng(seed)),
+        calculate_trialwise_reinstatement_bootstrap=lambda: calculate_trialwise_reinstatement(
+            enc_trialwise_data,rest1_data,rest2_data,memory_reg,np.random.default_rng(seed),'bootstrap'),
+        calculate_trialwise_reinstatement_analytic=lambda: calculate_trialwise_reinstatement(
+            enc_trialwise_data,rest1_data,rest2_data,memory_reg,zscore_mode='analytic'))
+
+    results=dict()
+    for name, fn in kernels.items():
+        results[name]=time_calls(fn,min_seconds)
+        print('%s: %0.1f calls/s, %0.0f kB peak' % (name,results[name]['calls_per_second'],results[name]['peak_kb']))
+
+    return results
+
+def benchmark_searchlight(data_dir,sub,searchlight_args):
+    # run the whole searchlight on a synthetic participant in another process (so its memory is its own)
+    # returns the centers per second (from the profile), the time it took, and the peak memory of the largest process
+    report_file='%s/benchmark_run.json' % data_dir
+    start=time.perf_counter()
+    subprocess.run([sys.executable,os.path.abspath(__file__),'--run-searchlight',data_dir,report_file,sub,
+                    'trialwise_detailed','--backend','local','--profile']+searchlight_args,check=True,
+                   stdout=subprocess.DEVNULL)
+    seconds=time.perf_counter()-start
+
+    with open(report_file) as f:
+        run_info=json.load(f)
+    with open('%s/similarity_searchlight/sub-%s_trialwise_detailed_searchlight_profile.json' %(data_dir,sub)) as f:
+        profile=json.load(f)
+    counts=profile['totals']['counts']
+    searchlight_seconds=max(rank['wall_seconds'] for rank in profile['ranks'])
+
+    return dict(centers=counts.get('centers',0), skipped_centers=counts.get('skipped_centers',0),
+                searchlight_seconds=searchlight_seconds, total_seconds=seconds,
+                centers_per_second=counts.get('centers',0)/searchlight_seconds, peak_mb=run_info['peak_mb'])
+
+def run_searchlight(data_dir,report_file,searchlight_args):
+    # (in the process benchmark_searchlight starts) run Similarity_Searchlight.py on the synthetic data and save
+    # the peak memory of this process and its pool workers (ru_maxrss is in kB on linux)
+    point_to(data_dir)
+    sys.argv=['Similarity_Searchlight.py']+searchlight_args
+    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)),'Similarity_Searchlight.py'),
+                   run_name='__main__')
+    peak_kb=max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    with open(report_file,'w') as f:
+        json.dump(dict(peak_mb=peak_kb/1024),f)
+
+def git_commit():
+    # the commit being benchmarked, if this is a git checkout
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],capture_output=True,text=True,check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_with_history(history,entry):
+    # compare the throughputs with the last run with the same settings, and say which got slower
+    previous=[old for old in history if old['settings']==entry['settings']]
+    if len(previous)==0:
+        print('No earlier run with these settings to compare with')
+        return
+    previous=previous[-1]
+
+    throughputs=[(name,result['calls_per_second'],previous['kernels'].get(name,{}).get('calls_per_second'))
+                 for name, result in entry['kernels'].items()]
+    for engine, result in entry['searchlight'].items():
+        throughputs.append(('searchlight_%s' % engine,result['centers_per_second'],
+                            previous['searchlight'].get(engine,{}).get('centers_per_second')))
+    for name, new, old in throughputs:
+        if old is None:
+            continue
+        change=new/old-1
+        print('%s: %+0.1f%% vs. %s (%s)%s' % (name,100*change,previous['date'],previous['commit'],
+                                            '  <-- slower' if change < -slowdown_tolerance else ''))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run-searchlight':
+        run_searchlight(sys.argv[2],sys.argv[3],sys.argv[4:])
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description='Benchmark the similarity searchlight on synthetic data')
+    parser.add_argument('--size', default='small', choices=list(sizes), help='size of the synthetic data '
+                                                                             '(default: small)')
+    parser.add_argument('--shape', nargs=3, type=int, default=None, help='size of the volume (overrides --size)')
+    parser.add_argument('--n-trs', default=None, type=int, help='TRs per run (overrides --size)')
+    parser.add_argument('--n-trials', default=None, type=int, help='encoding trials (overrides --size)')
+    parser.add_argument('--engines', nargs='*', default=['brainiak','sliding'], choices=['brainiak','sliding'],
+                        help='searchlight engines to run end to end (default: both, none to skip)')
+    parser.add_argument('--zscore-mode', default='analytic', choices=['bootstrap','analytic'],
+                        help='z-scores for the end to end searchlight (default: analytic)')
+    parser.add_argument('--pool-size', default=1, type=int, help='worker processes for the searchlight (default: 1)')
+    parser.add_argument('--min-seconds', default=1.0, type=float, help='time to spend on each kernel (default: 1)')
+    parser.add_argument('--data-dir', default=None, help='where to make the synthetic data (default: a temporary '
+                                                         'directory)')
+    parser.add_argument('--history', default='benchmark_history.json', help='JSON file the results are added to '
+                                                                             '(default: benchmark_history.json)')
+    args = parser.parse_args()
+
+    settings=dict(sizes[args.size])
+    for name, value in [('shape',args.shape),('n_TRs',args.n_trs),('n_trials',args.n_trials)]:
+        if value is not None:
+            settings[name]=value
+    settings.update(zscore_mode=args.zscore_mode, pool_size=args.pool_size)
+
+    print('Kernels (%d TRs, %d trials)' % (settings['n_TRs'],settings['n_trials']))
+    kernels=benchmark_kernels(settings['n_TRs'],settings['n_trials'],min_seconds=args.min_seconds)
+
+    searchlight=dict()
+    if len(args.engines) > 0:
+        data_dir=args.data_dir if args.data_dir is not None else tempfile.mkdtemp(prefix='synthetic_searchlight_')
+        make_synthetic_subject(data_dir,'001',settings['shape'],settings['n_TRs'],settings['n_trials'])
+        for engine in args.engines:
+            searchlight[engine]=benchmark_searchlight(data_dir,'001',['--engine',engine,'--zscore-mode',
+                                                                      args.zscore_mode,'--pool-size',
+                                                                      str(args.pool_size)])
+            print('Searchlight (%s, %s): %0.1f centers/s, %d centers in %0.1f s, %0.0f MB peak' % (
+                engine,'x'.join(str(s) for s in settings['shape']),searchlight[engine]['centers_per_second'],
+                searchlight[engine]['centers'],searchlight[engine]['searchlight_seconds'],
+                searchlight[engine]['peak_mb']))
+
+    # add it to the history
+    entry=dict(date=datetime.datetime.now().isoformat(timespec='seconds'), commit=git_commit(),
+               host=platform.node(), python=platform.python_version(), numpy=np.__version__,
+               settings=settings, kernels=kernels, searchlight=searchlight)
+    history=[]
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history=json.load(f)
+    compare_with_history(history,entry)
+    history.append(entry)
+    with open(args.history,'w') as f:
+        json.dump(history,f,indent=1)
+    print('Added to %s' % args.history)
@@ -0,0 +1,102 @@
+# Time the thresholding step of the reinstatement kernels (supra_threshold_values in reinstatement_utils.py)
+# against the way it used to be done (copying and nan-filling both correlation matrices for every memory type and
+# taking nanmean / nanstd), on made up trial x TR correlations, so no data is needed
+# Reports the time and the peak memory allocated per center for both, and how often they keep different values
+#
+# example command: python scripts_ginsburg/benchmark_thresholding.py 60 300 500
+# (trials, TRs per rest run, number of centers)
+#
+# 10182026
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+from reinstatement_utils import compute_correlation, supra_threshold_values
+
+def copy_threshold_values(tr_corr_pre,tr_corr_post,memory_reg):
+    # the thresholding of trialwise_reinstatement_from_correlations before supra_threshold_values
+    pre_vals=dict()
+    post_vals=dict()
+    for mem_idx, mem_type in enumerate(['forgotten','remembered']):
+        memory_idxs = np.array(memory_reg)==mem_idx
+
+        tr_corr_pre_thresh=tr_corr_pre.copy()
+        tr_corr_pre_thresh[~memory_idxs]=np.nan
+        tr_corr_post_thresh=tr_corr_post.copy()
+        tr_corr_post_thresh[~memory_idxs]=np.nan
+
+        pre_idxs = tr_corr_pre_thresh > np.nanmean(tr_corr_pre_thresh)+np.nanstd(tr_corr_pre_thresh)*1.5
+        tr_corr_pre_thresh[~pre_idxs]=np.nan
+        post_idxs = tr_corr_post_thresh > np.nanmean(tr_corr_post_thresh)+np.nanstd(tr_corr_post_thresh)*1.5
+        tr_corr_post_thresh[~post_idxs]=np.nan
+
+        pre_vals[mem_type]=tr_corr_pre_thresh[~np.isnan(tr_corr_pre_thresh)]
+        post_vals[mem_type]=tr_corr_post_thresh[~np.isnan(tr_corr_post_thresh)]
+
+    return pre_vals, post_vals
+
+def fused_threshold_values(tr_corr_pre,tr_corr_post,memory_reg):
+    return supra_threshold_values(tr_corr_pre,memory_reg), supra_threshold_values(tr_corr_post,memory_reg)
+
+def make_correlations(n_trials,n_TRs,n_centers,n_voxels=200,seed=0):
+    # trial x TR correlations of random patterns (pre and post rest) and memory labels, for every center
+    rng=np.random.default_rng(seed)
+    memory_reg=rng.integers(0,2,n_trials)
+    centers=[]
+    for _ in range(n_centers):
+        enc_trials=rng.standard_normal((n_trials,n_voxels))
+        centers.append([compute_correlation(enc_trials,rng.standard_normal((n_TRs,n_voxels))) for _ in range(2)])
+
+    return centers, memory_reg
+
+def time_per_center(threshold_fn,centers,memory_reg,n_repeats=5):
+    # best of n_repeats of the mean time per center, in seconds
+    times=[]
+    for _ in range(n_repeats):
+        start=time.perf_counter()
+        for tr_corr_pre, tr_corr_post in centers:
+            threshold_fn(tr_corr_pre,tr_corr_post,memory_reg)
+        times.append((time.perf_counter()-start)/len(centers))
+
+    return min(times)
+
+def peak_memory_per_center(threshold_fn,centers,memory_reg):
+    # the most memory allocated at once while thresholding one center, in bytes (not counting what is kept)
+    tracemalloc.start()
+    peaks=[]
+    for tr_corr_pre, tr_corr_post in centers:
+        tracemalloc.reset_peak()
+        baseline=tracemalloc.get_traced_memory()[0]
+        threshold_fn(tr_corr_pre,tr_corr_post,memory_reg)
+        peaks.append(tracemalloc.get_traced_memory()[1]-baseline)
+    tracemalloc.stop()
+
+    return np.median(peaks)
+
+if __name__ == '__main__':
+    n_trials=int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    n_TRs=int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    n_centers=int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    centers, memory_reg = make_correlations(n_trials,n_TRs,n_centers)
+    print('%d centers of %d trials x %d TRs (%d kB per correlation matrix)' % (
+        n_centers,n_trials,n_TRs,centers[0][0].nbytes//1024))
+
+    results=dict()
+    for name, threshold_fn in [('copy',copy_threshold_values),('fused',fused_threshold_values)]:
+        results[name]=(time_per_center(threshold_fn,centers,memory_reg),
+                       peak_memory_per_center(threshold_fn,centers,memory_reg))
+        print('%s: %0.1f us and %d kB peak per center' % (name,results[name][0]*1e6,results[name][1]//1024))
+    print('fused is %0.1fx faster with %0.1fx less peak memory' % (results['copy'][0]/results['fused'][0],
+                                                                 results['copy'][1]/results['fused'][1]))
+
+    # the thresholds are now made from float64 row sums rather than float32 nanmean / nanstd, so a value right at
+    # the threshold can (rarely) be kept by one and not the other
+    n_different=0
+    for tr_corr_pre, tr_corr_post in centers:
+        copy_vals=copy_threshold_values(tr_corr_pre,tr_corr_post,memory_reg)
+        fused_vals=fused_threshold_values(tr_corr_pre,tr_corr_post,memory_reg)
+        n_different+=any(not np.array_equal(copy_vals[rest][mem_type],fused_vals[rest][mem_type])
+                         for rest in range(2) for mem_type in ['forgotten','remembered'])
+    print('%d of %d centers keep different values' % (n_different,n_centers))
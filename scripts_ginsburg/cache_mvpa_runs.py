@@ -0,0 +1,23 @@
+# Make (or update) the cache of masked, z-scored runs for the similarity analyses ahead of time
+# Each run is saved once as an uncompressed voxel x time array that can be memory-mapped (see searchlight_data.py),
+# so the searchlight and any other analysis can open it lazily instead of decompressing the NIfTI again
+#
+# example command: python scripts_ginsburg/cache_mvpa_runs.py float32 002 003 004
+#
+# 10182026
+
+import sys
+from searchlight_data import get_tasks, cache_is_current, make_cached_run
+
+# what precision? (float64 or float32)
+dtype=sys.argv[1]
+
+# which participants? (numbers only, e.g., 002)
+for ppt in sys.argv[2:]:
+    sub_id='sub-%s' % ppt
+    for task in get_tasks(sub_id):
+        if cache_is_current(sub_id,task,dtype):
+            print('cache is up to date for %s %s' % (sub_id,task))
+        else:
+            print('caching %s %s' % (sub_id,task))
+            make_cached_run(sub_id,task,dtype)
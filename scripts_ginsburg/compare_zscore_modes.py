@@ -0,0 +1,80 @@
+# Check the analytic z-scores against the bootstrapped z-scores of the reinstatement searchlight
+# This runs reinstatement_kernel both ways on a random sample of searchlight centers (no MPI needed) and
+# reports the voxelwise difference for each output, so we know how far the fast maps are from the real ones
+#
+# example command: python scripts_ginsburg/compare_zscore_modes.py 002 trialwise_detailed 500
+#
+# 10182026
+
+import warnings
+warnings.filterwarnings('ignore')
+import sys
+import numpy as np
+import pandas as pd
+from searchlight_data import output_path, get_tasks, load_trial_info, load_zscored_run, load_native_mask, \
+    make_center_ids
+from reinstatement_utils import reinstatement_kernel, make_trial_operator, variant_labels
+
+# which subject and analysis?
+elfk_id='EL%s' % sys.argv[1]
+sub_id='sub-%s' % sys.argv[1]
+analysis_type=sys.argv[2]
+
+# how many centers should we check?
+if len(sys.argv) > 3:
+    n_centers=int(sys.argv[3])
+else:
+    n_centers=200
+
+# same settings as the searchlight
+sl_rad=3
+random_seed=0
+labels=variant_labels['corrected']
+
+# load the data the same way as the searchlight
+timing_all, memory_regs = load_trial_info(elfk_id,[analysis_type.split('_')[1]])
+data=[]
+for task in get_tasks(sub_id):
+    data_4d_zscore, data_4d = load_zscored_run(sub_id,task)
+    data.append(data_4d_zscore)
+data.append(make_center_ids(data_4d.shape[:3]))
+trial_operator=make_trial_operator(timing_all,data[0].shape[3])
+_, brain_nii_native = load_native_mask(data_4d)
+mask=brain_nii_native.get_fdata()
+
+# pick the centers (only those the searchlight would run, i.e., not within the radius of the edge)
+inner_mask=np.zeros(mask.shape,dtype=bool)
+inner_mask[sl_rad:-sl_rad,sl_rad:-sl_rad,sl_rad:-sl_rad]=mask[sl_rad:-sl_rad,sl_rad:-sl_rad,sl_rad:-sl_rad]==1
+centers=np.argwhere(inner_mask)
+rng=np.random.default_rng(random_seed)
+centers=centers[rng.choice(len(centers),min(n_centers,len(centers)),replace=False)]
+
+# run both versions on every center
+results=[]
+for center in centers:
+    searchlight_slice=tuple(slice(c-sl_rad,c+sl_rad+1) for c in center)
+    sl_data=[d[searchlight_slice] for d in data]
+    sl_mask=mask[searchlight_slice]
+
+    outputs=dict()
+    for zscore_mode in ['bootstrap','analytic']:
+        bcvar=dict(timing_all=timing_all, memory_regs=memory_regs, variants=['corrected'], trial_operator=trial_operator,
+                   random_seed=random_seed, zscore_mode=zscore_mode)
+        outputs[zscore_mode]=np.array(reinstatement_kernel(sl_data,sl_mask,sl_rad,bcvar),dtype=float)*np.ones(len(labels))
+
+    for i, label in enumerate(labels):
+        results.append([center[0],center[1],center[2],label,outputs['bootstrap'][i],outputs['analytic'][i]])
+
+results_df=pd.DataFrame(results,columns=['x','y','z','label','bootstrap','analytic'])
+results_df['difference']=results_df.analytic-results_df.bootstrap
+
+# report how close they are
+print('Compared %d centers for %s %s' % (len(centers),sub_id,analysis_type))
+for label, label_df in results_df.groupby('label',sort=False):
+    label_df=label_df.dropna()
+    print('%s: mean abs diff %0.4f, max abs diff %0.4f, r = %0.4f (%d centers)' % (label,
+            np.mean(np.abs(label_df.difference)),np.max(np.abs(label_df.difference)),
+            np.corrcoef(label_df.bootstrap,label_df.analytic)[0,1],len(label_df)))
+
+# and save the voxelwise values
+results_df.to_csv('%s/%s_%s_zscore_mode_comparison.csv' % (output_path,sub_id,analysis_type),index=False)
@@ -0,0 +1,77 @@
+# Single node stand-ins for brainiak's Searchlight and MPI, for Similarity_Searchlight.py --backend local
+# Quick checks on a workstation should not need mpi4py, brainiak or an MPI stack, so these do the same thing as
+# brainiak's Searchlight with the Cube shape (the same blocks and the same kernel call at every center) in numpy,
+# for one process. searchlight_scheduler.py uses them the same way it uses brainiak's, so the maps are the same
+# 10182026
+
+import numpy as np
+
+class SerialComm:
+    # stands in for MPI.COMM_WORLD when this is the only process
+    rank=0
+    size=1
+
+    def gather(self,value,root=0):
+        return [value]
+
+    def bcast(self,value,root=0):
+        return value
+
+    def scatter(self,values,root=0):
+        return values[0]
+
+    def Barrier(self):
+        pass
+
+class LocalSearchlight:
+    # the parts of brainiak's Searchlight (with the default Cube shape and no minimum of active voxels) that
+    # searchlight_scheduler.py uses, with the same names so either one can be passed to it
+    def __init__(self,sl_rad=1,max_blk_edge=10):
+        self.sl_rad=sl_rad
+        self.max_blk_edge=max_blk_edge
+        self.shape=np.ones((2*sl_rad+1,)*3,dtype=bool)
+        self.min_active_voxels_proportion=0
+        self.comm=SerialComm()
+        self.bcast_var=None
+
+    def _get_blocks(self,mask):
+        # split the volume into blocks of max_blk_edge centers (plus the sl_rad padding), leaving out empty ones
+        blocks=[]
+        outer_edge=self.max_blk_edge+2*self.sl_rad
+        for i in range(0,mask.shape[0],self.max_blk_edge):
+            for j in range(0,mask.shape[1],self.max_blk_edge):
+                for k in range(0,mask.shape[2],self.max_blk_edge):
+                    block_shape=mask[i:i+outer_edge,j:j+outer_edge,k:k+outer_edge].shape
+                    if np.any(mask[i+self.sl_rad:i+block_shape[0]-self.sl_rad,
+                                   j+self.sl_rad:j+block_shape[1]-self.sl_rad,
+                                   k+self.sl_rad:k+block_shape[2]-self.sl_rad]):
+                        blocks.append(((i,j,k),block_shape))
+
+        return blocks
+
+    def _get_block_data(self,mat,block):
+        # a copy of a block of a 3D or 4D volume
+        (corner, block_shape)=block
+        return mat[corner[0]:corner[0]+block_shape[0],corner[1]:corner[1]+block_shape[1],
+                   corner[2]:corner[2]+block_shape[2]].copy()
+
+    def broadcast(self,bcast_var):
+        self.bcast_var=bcast_var
+
+def singlenode_searchlight(data,msk,sl_rad,bcast_var,extra_params):
+    # run voxel_fn at every center of one block, like brainiak's _singlenode_searchlight
+    # returns the block (without the padding) with the output of each center, and None where there is no center
+    voxel_fn, shape_mask, min_active_voxels_proportion=extra_params
+    outmat=np.empty(tuple(s-2*sl_rad for s in msk.shape),dtype=object)
+    for i in range(outmat.shape[0]):
+        for j in range(outmat.shape[1]):
+            for k in range(outmat.shape[2]):
+                if msk[i+sl_rad,j+sl_rad,k+sl_rad]:
+                    searchlight_slice=np.s_[i:i+2*sl_rad+1,j:j+2*sl_rad+1,k:k+2*sl_rad+1]
+                    voxel_fn_mask=msk[searchlight_slice]*shape_mask
+                    if (min_active_voxels_proportion == 0
+                            or np.count_nonzero(voxel_fn_mask)/voxel_fn_mask.size > min_active_voxels_proportion):
+                        outmat[i,j,k]=voxel_fn([subject[searchlight_slice] for subject in data],voxel_fn_mask,
+                                               sl_rad,bcast_var)
+
+    return outmat
@@ -0,0 +1,97 @@
+# Check the float32 version of the reinstatement searchlight against float64 (Similarity_Searchlight.py --precision)
+# This runs reinstatement_kernel on a random sample of searchlight centers with the runs loaded both ways and
+# reports how far apart the outputs are, so a float32 searchlight can stop before it starts if they are too far apart
+#
+# example command: python scripts_ginsburg/precision_check.py 002 trialwise_detailed 100
+#
+# 10182026
+
+import sys
+import numpy as np
+import nibabel as nib
+from searchlight_data import get_tasks, load_trial_info, load_zscored_run, load_native_mask, make_center_ids, \
+    run_file
+from reinstatement_utils import reinstatement_kernel, make_trial_operator, output_labels
+from sliding_searchlight import searchlight_centers
+
+def sample_centers(mask,sl_rad,n_centers,seed=0):
+    # a random sample of the centers the searchlight runs
+    centers=np.argwhere(searchlight_centers(mask,sl_rad))
+    rng=np.random.default_rng(seed)
+
+    return centers[rng.choice(len(centers),min(n_centers,len(centers)),replace=False)]
+
+def center_cubes(volume,centers,sl_rad):
+    # the searchlight cube around each center
+    return [volume[tuple(slice(c-sl_rad,c+sl_rad+1) for c in center)] for center in centers]
+
+def kernel_at_centers(sub_id,tasks,mask,centers,sl_rad,bcvar,n_outputs,dtype='float64'):
+    # run reinstatement_kernel at the centers with the runs loaded in this precision
+    # returns centers x outputs (nan for centers with too few voxels)
+
+    # load one run at a time and only keep the cubes around the centers
+    cubes=[]
+    for task in tasks:
+        data_4d_zscore, _ = load_zscored_run(sub_id,task,dtype)
+        cubes.append(center_cubes(data_4d_zscore,centers,sl_rad))
+        del data_4d_zscore
+    cubes.append(center_cubes(make_center_ids(mask.shape),centers,sl_rad))
+    mask_cubes=center_cubes(mask,centers,sl_rad)
+
+    bcvar=dict(bcvar,trial_operator=bcvar['trial_operator'].astype(dtype))
+    outputs=np.full((len(centers),n_outputs),np.nan)
+    for c in range(len(centers)):
+        output=reinstatement_kernel([run_cubes[c] for run_cubes in cubes],mask_cubes[c],sl_rad,bcvar)
+        if not np.isscalar(output):
+            outputs[c]=output
+
+    return outputs
+
+def compare_precision(sub_id,tasks,mask,bcvar,sl_rad,n_outputs,n_centers=50,seed=0,tolerance=1e-3):
+    # how far the float32 outputs are from the float64 ones at a sample of centers
+    # (without the permutation null, which is made from the same correlations as the outputs)
+    # most outputs are within ~1e-4, but a correlation right at the 1.5 sd threshold can land on the other side of it
+    # in float32 and move that center's z-scores a lot, so this also counts how many outputs are over the tolerance
+    bcvar=dict(bcvar)
+    bcvar.pop('permutations',None)
+    centers=sample_centers(mask,sl_rad,n_centers,seed)
+    outputs_64=kernel_at_centers(sub_id,tasks,mask,centers,sl_rad,bcvar,n_outputs,'float64')
+    outputs_32=kernel_at_centers(sub_id,tasks,mask,centers,sl_rad,bcvar,n_outputs,'float32')
+
+    # a center that only has outputs in one of them is as far apart as it gets
+    both_nan=np.isnan(outputs_64) & np.isnan(outputs_32)
+    abs_diff=np.where(both_nan,0,np.nan_to_num(np.abs(outputs_32-outputs_64),nan=np.inf))
+    finite_diff=abs_diff[np.isfinite(abs_diff)]
+
+    return dict(n_centers=len(centers), centers=centers.tolist(), tolerance=tolerance,
+                fraction_over_tolerance=float(np.mean(abs_diff > tolerance)) if abs_diff.size else 0.0,
+                max_abs_diff=float(abs_diff.max(initial=0)),
+                median_abs_diff=float(np.median(finite_diff)) if finite_diff.size else 0.0,
+                max_abs_diff_per_output=abs_diff.max(axis=0,initial=0).tolist())
+
+if __name__ == '__main__':
+    # which subject and analysis?
+    elfk_id='EL%s' % sys.argv[1]
+    sub_id='sub-%s' % sys.argv[1]
+    analysis_type=sys.argv[2]
+
+    # how many centers should we check?
+    n_centers=int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    # same settings as the searchlight
+    sl_rad=3
+    random_seed=0
+    labels=output_labels([analysis_type.split('_')[1]],['corrected'])
+
+    timing_all, memory_regs = load_trial_info(elfk_id,[analysis_type.split('_')[1]])
+    tasks=get_tasks(sub_id)
+    data_4d=nib.load(run_file(sub_id,tasks[0])) # just the header
+    _, brain_nii_native = load_native_mask(data_4d)
+    bcvar=dict(timing_all=timing_all, memory_regs=memory_regs, variants=['corrected'], random_seed=random_seed,
+               zscore_mode='bootstrap', trial_operator=make_trial_operator(timing_all,data_4d.shape[3]))
+
+    check=compare_precision(sub_id,tasks,brain_nii_native.get_fdata(),bcvar,sl_rad,len(labels),n_centers,random_seed)
+    print('Compared %d centers for %s %s: %0.1f%% of outputs differ by more than %0.0e' % (
+        check['n_centers'],sub_id,analysis_type,100*check['fraction_over_tolerance'],check['tolerance']))
+    for (regressor, variant, label), max_diff in zip(labels,check['max_abs_diff_per_output']):
+        print('%s: max abs diff %0.2e' % (label,max_diff))
@@ -0,0 +1,453 @@
+# Kernel functions for the similarity searchlight (Similarity_Searchlight.py)
+# These live outside of the searchlight script so they can be imported without setting up MPI
+# (e.g., for checking the searchlight on a sample of centers), and only need numpy and scipy
+# 10182026
+
+import math
+import numpy as np
+import scipy.stats as stats
+import searchlight_profile
+
+# the most bootstrap draws (resamples x values) to hold in memory at once
+bootstrap_max_draws=2**22
+
+# how the summed z-scores are calculated: 'bootstrap' resamples, 'analytic' uses the closed form
+zscore_modes=['bootstrap','analytic']
+
+# the outputs of each variant of the reinstatement analysis
+# corrected is (post_remem - pre_remem) - (post_forg - pre_forg), uncorrected is (post_remem - post_forg) AND (pre_remem - pre_forg)
+variant_labels=dict(corrected=['remembered','forgotten','difference'],
+                    uncorrected=['difference_pre','difference_post'])
+
+# the outputs of each variant that compare remembered vs. forgotten, and so get a permutation null
+null_labels=dict(corrected=['difference'],
+                 uncorrected=['difference_pre','difference_post'])
+
+# the most permutations x trials x TRs to threshold at once for the permutation null
+permutation_max_values=2**24
+
+######################################################################################
+####### Correlations
+
+def compute_correlation(matrix1,matrix2):
+    # brainiak's fcma.util.compute_correlation in numpy, so the kernels do not need brainiak: the Pearson correlation
+    # of every row of matrix1 with every row of matrix2, done the same way (float32, rows z-scored with ddof=0,
+    # nans set to 0, divided by the square root of the number of columns, then one matrix multiplication)
+    if matrix1.shape[1] != matrix2.shape[1]:
+        raise ValueError('Dimension discrepancy')
+    matrix1=np.nan_to_num(stats.zscore(matrix1.astype(np.float32,copy=False),axis=1,ddof=0))/math.sqrt(matrix1.shape[1])
+    matrix2=np.nan_to_num(stats.zscore(matrix2.astype(np.float32,copy=False),axis=1,ddof=0))/math.sqrt(matrix2.shape[1])
+
+    return np.ascontiguousarray(matrix1 @ matrix2.T)
+
+######################################################################################
+####### z-scores for the summed values
+
+def center_rng(center_id,seed=0):
+    # make a random number generator that belongs to one searchlight center
+    # the stream only depends on the seed and the center's voxel index, not on which rank/block runs it
+    return np.random.default_rng([seed,int(center_id)])
+
+def bootstrap_summed_distribution(data,nPerm=1000,rng=None,method='index'):
+    # draw all of the bootstrap resamples at once and sum each of them
+    # 'index' draws a resamples x values matrix of indices, 'multinomial' draws how often each value is picked
+    if rng is None:
+        rng=np.random.default_rng()
+
+    data=np.nan_to_num(np.asarray(data,dtype=float).ravel()) # nans add nothing to the sum, like nansum
+    n_vals=len(data)
+    perm_dist=np.zeros(nPerm)
+    if n_vals==0:
+        return perm_dist
+
+    # do the resamples in chunks so the index/count matrix stays a reasonable size
+    chunk_size=max(1,bootstrap_max_draws//n_vals)
+    for start in range(0,nPerm,chunk_size):
+        n_chunk=min(chunk_size,nPerm-start)
+        if method=='index':
+            sampidx=rng.integers(0,n_vals,size=(n_chunk,n_vals))
+            perm_dist[start:start+n_chunk]=data[sampidx].sum(axis=1)
+        elif method=='multinomial':
+            counts=rng.multinomial(n_vals,np.full(n_vals,1/n_vals),size=n_chunk)
+            perm_dist[start:start+n_chunk]=counts @ data
+        else:
+            raise ValueError('unknown bootstrap method %s' % method)
+
+    return perm_dist
+
+def bootstrap_summed_diff_zscore(data_1,data_2,nPerm=1000,rng=None,method='index'):
+    # bootstrap resampling for the difference in two different data distributions
+    # instead of averaging, though, sum over values
+    perm_dist_1=bootstrap_summed_distribution(data_1,nPerm,rng,method)
+    perm_dist_2=bootstrap_summed_distribution(data_2,nPerm,rng,method)
+
+    # turn it into a zscore = mean of diff minus the null (which is 0) divided by standard dev of the diff
+    diff_dist = perm_dist_1 - perm_dist_2
+    zscore=(np.mean(diff_dist))/np.std(diff_dist)
+
+    return zscore, diff_dist
+
+def analytic_summed_moments(data):
+    # the mean and variance of the sum of a bootstrap resample, without resampling
+    # n draws with replacement: mean = n * sample mean (the sum), variance = n * sample variance (ddof=0)
+    data=np.nan_to_num(np.asarray(data,dtype=float).ravel()) # nans add nothing to the sum, like nansum
+    if len(data)==0:
+        return 0.0, 0.0
+
+    return data.sum(), len(data)*data.var()
+
+def analytic_summed_diff_zscore(data_1,data_2):
+    # closed form of bootstrap_summed_diff_zscore (what it converges to as nPerm grows)
+    # the two resamples are independent, so the means subtract and the variances add
+    mean_1, var_1 = analytic_summed_moments(data_1)
+    mean_2, var_2 = analytic_summed_moments(data_2)
+    diff_moments = (mean_1 - mean_2, var_1 + var_2)
+
+    return moments_zscore(diff_moments), diff_moments
+
+def moments_zscore(moments):
+    # mean of diff divided by standard dev of the diff (nan when there is no spread, like the bootstrap)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.float64(moments[0])/np.sqrt(np.float64(moments[1]))
+
+def summed_diff_zscore(data_1,data_2,zscore_mode='bootstrap',rng=None):
+    # z-score for the summed difference of two sets of values, either bootstrapped or analytic
+    # returns the z-score and the difference (a distribution or its mean and variance) for difference_zscore
+    started=searchlight_profile.start()
+    if zscore_mode=='bootstrap':
+        zscore, diff=bootstrap_summed_diff_zscore(data_1,data_2,rng=rng)
+    elif zscore_mode=='analytic':
+        zscore, diff=analytic_summed_diff_zscore(data_1,data_2)
+    else:
+        raise ValueError('unknown zscore mode %s' % zscore_mode)
+    searchlight_profile.stop('zscore',started)
+
+    return zscore, diff
+
+def difference_zscore(diff_1,diff_2):
+    # z-score for the difference between two of the differences from summed_diff_zscore
+    if isinstance(diff_1,tuple):
+        return moments_zscore((diff_1[0] - diff_2[0], diff_1[1] + diff_2[1]))
+
+    return (np.mean(diff_1 - diff_2))/np.std(diff_1 - diff_2)
+
+######################################################################################
+####### Reinstatement
+
+def make_trial_operator(timing_all,n_TRs,TR_length=2):
+    # turn the timing information into a TR by trial averaging matrix, so that trials = vox x TR data @ operator
+    # the timing is the same for every searchlight center, so this only needs to be made once
+
+    trial_operator = np.zeros((n_TRs,timing_all.shape[0]))
+
+    for i in range(timing_all.shape[0]):
+        # What is the time stamp
+        time = timing_all[i,0]
+
+        # What TR does this timepoint refer to?
+        TR_start = int(time / TR_length)
+
+        # What TR does this timepoint refer to?
+        TR_end = int((time+timing_all[i,1]) / TR_length)
+
+        # average over the TRs of this trial (indexing the same way as slicing the data would)
+        trial_TRs = np.arange(n_TRs)[TR_start:TR_end]
+        if len(trial_TRs) == 0:
+            trial_operator[:,i] = np.nan # the mean of no TRs is nan
+        else:
+            trial_operator[trial_TRs,i] = 1 / len(trial_TRs)
+
+    return trial_operator
+
+def convert_encode_data_to_trials(preproc_data,timing_all,TR_length=2,trial_operator=None):
+    # turn a vox by TR array into a vox by trial array based on timing information
+    # NOTE: this is a mean rather than a nanmean over TRs, which is the same here because a voxel
+    # can only be nan after z-scoring if it is nan for the whole run
+    if trial_operator is None:
+        trial_operator = make_trial_operator(timing_all,preproc_data.shape[1],TR_length)
+
+    return preproc_data @ trial_operator
+
+def row_moments(tr_corr):
+    # the sum and sum of squares of every row (trial) of the correlations, in float64, which are all that is needed
+    # for the mean and sd of any group of trials
+    return tr_corr.sum(axis=1,dtype=float), np.einsum('ij,ij->i',tr_corr,tr_corr,dtype=float)
+
+def group_thresholds(row_sums,row_sums_sq,n_cols,group_idxs):
+    # the 1.5 sd threshold (mean + 1.5 * sd, ddof=0) of the correlations of each group of trials, from the row sums
+    # group_idxs is groups x trials, True for the trials in the group (nan for a group with no trials)
+    group_idxs=group_idxs.astype(float)
+    n_vals=group_idxs.sum(axis=1)*n_cols
+    with np.errstate(divide='ignore',invalid='ignore'):
+        group_mean=(group_idxs @ row_sums)/n_vals
+        group_var=(group_idxs @ row_sums_sq)/n_vals-group_mean**2
+
+    return group_mean+np.sqrt(np.maximum(group_var,0))*1.5
+
+def supra_threshold_values(tr_corr,memory_reg):
+    # the correlations of the forgotten (0) and remembered (1) trials that are greater than 1.5 sds from the mean of
+    # that memory type, in the same order as boolean indexing would give them
+    # the mean and sd come from the row sums, so the only arrays made are one boolean mask and the values themselves
+    started=searchlight_profile.start()
+    memory_reg=np.asarray(memory_reg)
+    group_idxs=np.stack([memory_reg==mem_idx for mem_idx in range(2)])
+    thresholds=group_thresholds(*row_moments(tr_corr),tr_corr.shape[1],group_idxs)
+
+    values=dict()
+    for mem_type, memory_idxs, thresh in zip(['forgotten','remembered'],group_idxs,thresholds):
+        above=np.greater(tr_corr,thresh) # compared in float64
+        above[~memory_idxs]=False
+        values[mem_type]=tr_corr[above]
+    searchlight_profile.stop('threshold',started)
+
+    return values
+
+def calculate_trialwise_reinstatement(enc_trialwise_data,rest1_data,rest2_data,memory_reg,rng=None,
+                                      zscore_mode='bootstrap'):
+    # correlate the activity pattern of each encoding trial with every possible TR in rest runs
+    # calculate how much these patterns were activated on average (reinstated) and then subtract
+    # post vs. pre rest run for remembered vs. forgotten encoding trials
+
+    # correlate every event trial with every rest TR, using brainiak tools to speed up the process
+    tr_corr_pre = compute_correlation(enc_trialwise_data.T.copy(order='C'),rest1_data.T.copy(order='C'))
+    tr_corr_post = compute_correlation(enc_trialwise_data.T.copy(order='C'),rest2_data.T.copy(order='C'))
+
+    return trialwise_reinstatement_from_correlations(tr_corr_pre,tr_corr_post,memory_reg,rng,zscore_mode)
+
+def trialwise_reinstatement_from_correlations(tr_corr_pre,tr_corr_post,memory_reg,rng=None,zscore_mode='bootstrap'):
+    # the rest of calculate_trialwise_reinstatement once the trial x TR correlations are made
+    # (so the correlations can also come from somewhere else, e.g., the sliding searchlight)
+
+    # Step 1 and 2: threshold the pre and post rest by memory behavior, keeping the correlations that are greater
+    # than 1.5 sds from the mean of each memory type (see supra_threshold_values)
+    pre_vals=supra_threshold_values(tr_corr_pre,memory_reg)
+    post_vals=supra_threshold_values(tr_corr_post,memory_reg)
+
+    # preset
+    zscore_vals=dict()
+    distribution_vals =dict()
+    for mem_type in ['forgotten','remembered']:
+
+        # Step 3: turn the post - pre values into z-scores for later analysis
+        zscore, diff_dist = summed_diff_zscore(post_vals[mem_type],pre_vals[mem_type],zscore_mode,rng)
+        # save them out
+        zscore_vals[mem_type]=zscore
+        distribution_vals[mem_type] = diff_dist
+
+    # Step 4: get the difference of remem and forgotten
+    zscore_diff=difference_zscore(distribution_vals['remembered'],distribution_vals['forgotten'])
+
+    return [zscore_vals['remembered'], zscore_vals['forgotten'], zscore_diff]
+
+def calculate_trialwise_reinstatement_uncorrected(enc_trialwise_data,rest1_data,rest2_data,memory_reg,rng=None,
+                                                  zscore_mode='bootstrap'):
+    # correlate the activity pattern of each encoding trial with every possible TR in rest runs
+    # calculate how much these patterns were activated on average (reinstated) and then subtract
+    # remembered vs. forgotten encoding trials (i.e., don't subtract post vs. pre here)
+
+    # correlate every event trial with every rest TR, using brainiak tools to speed up the process
+    tr_corr_pre = compute_correlation(enc_trialwise_data.T.copy(order='C'),rest1_data.T.copy(order='C'))
+    tr_corr_post = compute_correlation(enc_trialwise_data.T.copy(order='C'),rest2_data.T.copy(order='C'))
+
+    return trialwise_reinstatement_uncorrected_from_correlations(tr_corr_pre,tr_corr_post,memory_reg,rng,zscore_mode)
+
+def trialwise_reinstatement_uncorrected_from_correlations(tr_corr_pre,tr_corr_post,memory_reg,rng=None,
+                                                          zscore_mode='bootstrap'):
+    # the rest of calculate_trialwise_reinstatement_uncorrected once the trial x TR correlations are made
+
+    # Step 1 and 2: threshold the pre and post rest by memory behavior, keeping the correlations that are greater
+    # than 1.5 sds from the mean of each memory type (see supra_threshold_values)
+    pre_vals=supra_threshold_values(tr_corr_pre,memory_reg)
+    post_vals=supra_threshold_values(tr_corr_post,memory_reg)
+
+    # !!! This part differs !!!
+    # Step 3: get the difference of remem and forgotten for post and pre encoding separately
+    zscore_diff_pre, _ = summed_diff_zscore(pre_vals['remembered'],pre_vals['forgotten'],zscore_mode,rng)
+    zscore_diff_post, _ = summed_diff_zscore(post_vals['remembered'],post_vals['forgotten'],zscore_mode,rng)
+
+    return [zscore_diff_pre, zscore_diff_post]
+
+
+######################################################################################
+####### Permutation null (shuffled memory labels)
+
+def make_permutations(n_trials,n_perm,seed=0):
+    # the trial shuffles for the permutation null (permutations x trials), the same for every searchlight center
+    rng=np.random.default_rng(seed)
+    return np.stack([rng.permutation(n_trials) for _ in range(n_perm)])
+
+def supra_threshold_moments(tr_corr,group_idxs):
+    # for every row of group_idxs (shuffles x trials, True for the trials in the group), threshold the
+    # correlations of the group like trialwise_reinstatement_from_correlations (greater than 1.5 sds from the mean)
+    # and get the count, sum and sum of squares of what is left, without copying the correlations for every shuffle
+
+    # mean and sd of each group from the row sums (the same thresholds as supra_threshold_values)
+    thresh=group_thresholds(*row_moments(tr_corr),tr_corr.shape[1],group_idxs)
+    corr=tr_corr.astype(float)
+    group_idxs=group_idxs.astype(float)
+
+    # then threshold a chunk of shuffles at a time
+    counts=np.zeros(len(group_idxs))
+    sums=np.zeros(len(group_idxs))
+    sums_sq=np.zeros(len(group_idxs))
+    chunk_size=max(1,permutation_max_values//corr.size)
+    for start in range(0,len(group_idxs),chunk_size):
+        chunk=slice(start,start+chunk_size)
+        above=(corr[None,:,:] > thresh[chunk,None,None]) & (group_idxs[chunk,:,None]==1)
+        counts[chunk]=above.sum(axis=(1,2))
+        sums[chunk]=np.einsum('pts,ts->p',above,corr)
+        sums_sq[chunk]=np.einsum('pts,ts->p',above,corr**2)
+
+    return counts, sums, sums_sq
+
+def moments_from_sums(counts,sums,sums_sq):
+    # analytic_summed_moments from the count, sum and sum of squares of the values
+    with np.errstate(divide='ignore',invalid='ignore'):
+        variance=np.where(counts>0,sums_sq-sums**2/counts,0)
+
+    return sums, np.maximum(variance,0)
+
+def permutation_null(tr_corr_pre,tr_corr_post,memory_reg,permutations,variant,zscore_mode='bootstrap',rng=None):
+    # z-scores of the remembered vs. forgotten outputs (null_labels) with the memory labels shuffled across trials
+    # returns an array of null labels x permutations
+    shuffled_regs=np.array(memory_reg)[permutations]
+
+    if zscore_mode=='bootstrap':
+        # no shortcut for the resampling, so go through the shuffles one at a time
+        null_zscores=[]
+        for shuffled_reg in shuffled_regs:
+            if variant=='corrected':
+                null_zscores.append(trialwise_reinstatement_from_correlations(tr_corr_pre,tr_corr_post,shuffled_reg,
+                                                                              rng=rng,zscore_mode=zscore_mode)[2:])
+            else:
+                null_zscores.append(trialwise_reinstatement_uncorrected_from_correlations(tr_corr_pre,tr_corr_post,
+                                                                              shuffled_reg,rng=rng,
+                                                                              zscore_mode=zscore_mode))
+        return np.array(null_zscores,dtype=float).T
+
+    # the analytic z-scores for every shuffle at once
+    moments=dict()
+    for mem_idx, mem_type in enumerate(['forgotten','remembered']):
+        memory_idxs=shuffled_regs==mem_idx
+        moments[mem_type,'pre']=moments_from_sums(*supra_threshold_moments(tr_corr_pre,memory_idxs))
+        moments[mem_type,'post']=moments_from_sums(*supra_threshold_moments(tr_corr_post,memory_idxs))
+
+    if variant=='corrected':
+        # (post_remem - pre_remem) - (post_forg - pre_forg), all four sums are independent so the variances add
+        mean=(moments['remembered','post'][0]-moments['remembered','pre'][0]
+              -moments['forgotten','post'][0]+moments['forgotten','pre'][0])
+        var=sum(moments[key][1] for key in moments)
+        return np.array([moments_zscore((mean,var))])
+
+    # (pre_remem - pre_forg) and (post_remem - post_forg)
+    return np.array([moments_zscore((moments['remembered',rest][0]-moments['forgotten',rest][0],
+                                     moments['remembered',rest][1]+moments['forgotten',rest][1]))
+                     for rest in ['pre','post']])
+
+######################################################################################
+####### Searchlight kernels
+
+def output_labels(regressors,variants):
+    # what each output of the kernel is: (regressor, variant, label), in the order the kernel returns them
+    return [(regressor,variant,label) for regressor in regressors
+            for variant in variants for label in variant_labels[variant]]
+
+def null_output_labels(regressors,variants):
+    # which outputs get a permutation null: (regressor, variant, label), in the order the kernel returns them
+    # (after all of the output_labels, with one value per permutation for each)
+    return [(regressor,variant,label) for regressor in regressors
+            for variant in variants for label in null_labels[variant]]
+
+def reinstatement_outputs(center_id,tr_corr_pre,tr_corr_post,bcvar):
+    # threshold and z-score the same correlations for every memory regressor and variant
+    # bcvar['memory_regs'] is a list of memory regressors and bcvar['variants'] a list of variants (see variant_labels)
+    output=[]
+    for memory_reg in bcvar['memory_regs']:
+        for variant in bcvar['variants']:
+            # start the center's random stream over, so every output is the same as if it was run on its own
+            rng=center_rng(center_id,bcvar['random_seed'])
+
+            if variant=='corrected':
+                output+=trialwise_reinstatement_from_correlations(tr_corr_pre,tr_corr_post,memory_reg,rng=rng,
+                                                                  zscore_mode=bcvar['zscore_mode'])
+            else:
+                output+=trialwise_reinstatement_uncorrected_from_correlations(tr_corr_pre,tr_corr_post,memory_reg,
+                                                                              rng=rng,zscore_mode=bcvar['zscore_mode'])
+
+    # then the permutation null of the remembered vs. forgotten outputs, from the same correlations
+    if bcvar.get('permutations') is not None:
+        for memory_reg in bcvar['memory_regs']:
+            for variant in bcvar['variants']:
+                rng=center_rng(center_id,bcvar['random_seed'])
+                started=searchlight_profile.start() # (the thresholds and z-scores of the shuffles count as null)
+                null_zscores=permutation_null(tr_corr_pre,tr_corr_post,memory_reg,bcvar['permutations'],variant,
+                                              zscore_mode=bcvar['zscore_mode'],rng=rng)
+                searchlight_profile.stop('null',started)
+                output+=list(null_zscores.ravel())
+
+    return output
+
+def reinstatement_kernel(data,sl_mask,myrad,bcvar):
+    #'''Searchlight kernel that reshapes the data and decides whether there are enough voxels to run the algorithm'''
+
+    trial_operator=bcvar['trial_operator'] # TR by trial averaging matrix for the encoding trials
+
+    # the last data entry holds the voxel index, so the center of the searchlight says which center this is
+    center_id=data[-1][myrad,myrad,myrad,0]
+
+    # Make sure that we mask the data
+    sl_mask_1d=sl_mask.reshape(sl_mask.shape[0] * sl_mask.shape[1] * sl_mask.shape[2]) # 1 dimensional sl mask
+
+    #only run this operation if the number of brain voxels is greater than a certain amount
+    searchlight_profile.count('centers')
+    if np.sum(sl_mask) >= 50:
+
+        ## first reshape the data and preprocess it
+        # cycle through the different runs
+        started=searchlight_profile.start()
+        preproc_dict=dict()
+        for r, run in enumerate(['memory','rest1','rest2']):
+
+            # reshape
+            reshaped = data[r].reshape(sl_mask.shape[0] * sl_mask.shape[1] * sl_mask.shape[2],
+                                             data[r].shape[3]).T
+
+            # Mask the data so that we only include data that is inside of the brain
+            # (otherwise we may get weird input from non-brain)
+            masked_data=reshaped[:,sl_mask_1d==1]
+
+            # change the orientation
+            preproc_data = masked_data.T
+
+            # add to the dictionary
+            preproc_dict[run]=preproc_data
+        searchlight_profile.stop('prepare',started)
+
+        # then make the encode trial data from the memory run
+        started=searchlight_profile.start()
+        enc_trialwise_data = convert_encode_data_to_trials(preproc_dict['memory'],None,trial_operator=trial_operator)
+        searchlight_profile.stop('encode',started)
+
+        # correlate every event trial with every rest TR once, then get every regressor and variant from them
+        started=searchlight_profile.start()
+        tr_corr_pre = compute_correlation(enc_trialwise_data.T.copy(order='C'),preproc_dict['rest1'].T.copy(order='C'))
+        tr_corr_post = compute_correlation(enc_trialwise_data.T.copy(order='C'),preproc_dict['rest2'].T.copy(order='C'))
+        searchlight_profile.stop('correlate',started)
+        output = reinstatement_outputs(center_id,tr_corr_pre,tr_corr_post,bcvar)
+
+    else:
+        searchlight_profile.count('skipped_centers')
+        output=np.nan
+
+    return output
+
+def correlation_kernel(center_id,correlations,bcvar):
+    # the part of reinstatement_kernel that comes after the correlations, for searchlights that make
+    # the trial x TR correlations themselves (e.g., sliding_searchlight.py)
+    return reinstatement_outputs(center_id,correlations[0],correlations[1],bcvar)
+
+def slab_correlation_kernel(center,correlations,bcvar,volume_shape,x_start=0):
+    # correlation_kernel for a center given as (x, y, z) within a slab of the volume that starts at x = x_start
+    # (module level, so it can be sent to pool workers with functools.partial)
+    center_id=np.ravel_multi_index((center[0]+x_start,center[1],center[2]),volume_shape)
+    return correlation_kernel(center_id,correlations,bcvar)
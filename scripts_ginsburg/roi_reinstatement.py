@@ -0,0 +1,160 @@
+# ROI version of the reinstatement searchlight (Similarity_Searchlight.py --atlas)
+# Instead of a searchlight around every voxel, the same outputs (reinstatement_outputs in reinstatement_utils.py)
+# are calculated once for every parcel of a labelled atlas, using the voxels of the parcel that are in the brain
+# mask, and saved as a table with a row for each parcel and output. The encoding trials of every atlas voxel are
+# made with one matrix multiplication, the voxels of every parcel are z-scored for the correlations in one pass over
+# the data (parcel_zscores, in place, block by block), and each parcel is then one multiplication of its block of
+# voxels (without copying it), so a whole atlas takes seconds. The participants are still run one after the other
+# (each has its own runs and trial timing, so they can't be stacked)
+#
+# example command: python scripts_ginsburg/roi_reinstatement.py atlas.nii.gz trialwise_detailed 002 003 004
+#
+# 10182026
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from searchlight_data import output_path, get_tasks, load_trial_info, load_zscored_run, cached_native_mask, \
+    native_grid, load_native_atlas, load_atlas_names, run_file
+from reinstatement_utils import reinstatement_outputs, make_trial_operator, zscore_modes, \
+    variant_labels, output_labels, null_output_labels, make_permutations
+
+def parcel_voxels(atlas,mask):
+    # the voxels (flat indices of the volume, in order) of every parcel that are in the brain mask
+    # returns the parcel labels and a list with the voxels of each
+    flat_voxels=np.flatnonzero((atlas>0) & (mask==1))
+    voxel_labels=atlas.ravel()[flat_voxels]
+    order=np.argsort(voxel_labels,kind='stable') # stable, so the voxels of each parcel stay in order
+    parcels, starts=np.unique(voxel_labels[order],return_index=True)
+
+    return parcels, np.split(flat_voxels[order],starts[1:])
+
+def parcel_zscores(data,bounds):
+    # the data (voxels x trials or TRs, the voxels of each parcel in a block of rows from bounds[p] to bounds[p+1])
+    # z-scored over the voxels of each parcel (ddof=0, nans set to 0) and divided by the square root of the parcel's
+    # number of voxels, in float32, as compute_correlation does to each matrix in reinstatement_utils.py
+    # the blocks are z-scored in place in one copy of the data, so it is only gone through once
+    zscored=data.astype(np.float32)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for start, end in zip(bounds[:-1],bounds[1:]):
+            block=zscored[start:end]
+            block-=block.mean(axis=0,dtype=np.float64).astype(np.float32)
+            block*=(1/np.sqrt(np.mean(np.square(block),axis=0,dtype=np.float64)*(end-start))).astype(np.float32)
+
+    return np.nan_to_num(zscored,copy=False)
+
+def parcel_correlation(enc_zscored,rest_zscored,rows):
+    # compute_correlation(encoding trials, rest TRs) of one parcel from the parcel_zscores of the data: one
+    # multiplication of the parcel's block of rows (views, so nothing is copied); returns trials x TRs
+    return np.ascontiguousarray(enc_zscored[rows].T @ rest_zscored[rows])
+
+def parcel_outputs(runs,atlas,mask,bcvar,n_outputs,min_voxels=50):
+    # reinstatement_outputs for every parcel, from the z-scored runs (memory, rest 1, rest 2; x by y by z by TR)
+    # returns the parcel labels, the number of voxels in each, and parcels x outputs (nan for parcels with fewer
+    # than min_voxels voxels, like reinstatement_kernel does for searchlights)
+    parcels, voxels=parcel_voxels(atlas,mask)
+    n_voxels=np.array([len(parcel) for parcel in voxels])
+    outputs=np.full((len(parcels),n_outputs),np.nan)
+    if len(parcels)==0:
+        return parcels, n_voxels, outputs
+
+    # pull the voxels of every parcel out of the runs at once, and make the encoding trials for all of them
+    all_voxels=np.concatenate(voxels)
+    memory_data, rest1_data, rest2_data=[run.reshape(-1,run.shape[3])[all_voxels] for run in runs[:3]]
+    enc_trialwise_data=memory_data @ bcvar['trial_operator']
+
+    # z-score the voxels of every parcel at once, then each parcel is one set of correlations (the parcel label picks
+    # its random stream, like a center does)
+    bounds=np.cumsum(np.concatenate([[0],n_voxels]))
+    enc_zscored, rest1_zscored, rest2_zscored=[parcel_zscores(data,bounds)
+                                               for data in [enc_trialwise_data,rest1_data,rest2_data]]
+    for p, parcel in enumerate(parcels):
+        if n_voxels[p] < min_voxels:
+            continue
+        rows=slice(bounds[p],bounds[p+1])
+        tr_corr_pre=parcel_correlation(enc_zscored,rest1_zscored,rows)
+        tr_corr_post=parcel_correlation(enc_zscored,rest2_zscored,rows)
+        outputs[p]=reinstatement_outputs(parcel,tr_corr_pre,tr_corr_post,bcvar)
+
+    return parcels, n_voxels, outputs
+
+def roi_table(sub_id,parcels,n_voxels,outputs,labels,nulls,n_permutations,parcel_names=None):
+    # a tidy table of the outputs of parcel_outputs: one row for every parcel and output, with the permutation
+    # p-value (how often the shuffled z is at least as big as the real one) for the outputs that have a null
+    rows=[]
+    for p, parcel in enumerate(parcels):
+        for i, (regressor, variant, label) in enumerate(labels):
+            row=dict(sub_id=sub_id, parcel=int(parcel))
+            if parcel_names is not None:
+                row['parcel_name']=parcel_names.get(int(parcel),'')
+            row.update(n_voxels=int(n_voxels[p]), regressor=regressor, variant=variant, output=label,
+                       zscore=outputs[p,i])
+            if (regressor, variant, label) in nulls:
+                start=len(labels)+nulls.index((regressor,variant,label))*n_permutations
+                null_zscores=outputs[p,start:start+n_permutations]
+                row['perm_p']=(1+np.sum(null_zscores>=outputs[p,i]))/(1+n_permutations)
+                if np.isnan(outputs[p,i]):
+                    row['perm_p']=np.nan
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+def roi_output_name(sub_id,analysis_type,atlas_file,output_suffix=''):
+    # where the table of a subject goes (named after the atlas file)
+    atlas_name=os.path.basename(atlas_file).split('.')[0]
+    return '%s/%s_%s_roi_%s_summed_zscore_v2%s.csv' %(output_path,sub_id,analysis_type.split('_')[0],atlas_name,
+                                                       output_suffix)
+
+if __name__ == '__main__':
+    # several subjects at once on one machine (no MPI or brainiak), with the same settings as the searchlight
+    parser = argparse.ArgumentParser(description='Run the reinstatement analysis on the parcels of an atlas')
+    parser.add_argument('atlas', help='labelled atlas in the same space as the brain mask (0 is background)')
+    parser.add_argument('analysis_type', help='which similarity analysis, e.g., trialwise_detailed')
+    parser.add_argument('sub_ids', nargs='+', help='participant ID numbers, e.g., 002 003')
+    parser.add_argument('--atlas-labels', default=None, help='text file with a label and a name on each line')
+    parser.add_argument('--regressors', nargs='+', default=None,
+                        help='memory regressors to run (default: the one in the analysis type, e.g., detailed)')
+    parser.add_argument('--variants', nargs='+', default=['corrected'], choices=list(variant_labels),
+                        help='corrected (post - pre) and/or uncorrected (pre and post separately) (default: corrected)')
+    parser.add_argument('--permutations', default=0, type=int,
+                        help='number of memory label shuffles for a permutation null (default: 0)')
+    parser.add_argument('--zscore-mode', default='bootstrap', choices=zscore_modes,
+                        help='how to calculate the summed z-scores (default: bootstrap)')
+    parser.add_argument('--tr-length', default=2, type=float, help='TR length in seconds (default: 2)')
+    args = parser.parse_args()
+
+    random_seed=0
+    regressors=args.regressors if args.regressors is not None else [args.analysis_type.split('_')[1]]
+    labels=output_labels(regressors,args.variants)
+    nulls=null_output_labels(regressors,args.variants) if args.permutations > 0 else []
+    n_outputs=len(labels)+len(nulls)*args.permutations
+    parcel_names=load_atlas_names(args.atlas_labels) if args.atlas_labels is not None else None
+    output_suffix='' if args.zscore_mode == 'bootstrap' else '_%s' % args.zscore_mode
+
+    # the atlas and mask only need to be put in native space once for every grid the runs are on
+    native_atlases=dict()
+    for sub in args.sub_ids:
+        elfk_id='EL%s' % sub
+        sub_id='sub-%s' % sub
+        tasks=get_tasks(sub_id)
+
+        data_4d=nib.load(run_file(sub_id,tasks[0])) # just the header
+        grid=native_grid(data_4d)
+        if grid not in native_atlases:
+            native_atlases[grid]=load_native_atlas(args.atlas,data_4d)
+        atlas, mask=native_atlases[grid], cached_native_mask(data_4d)[1].get_fdata()
+
+        bcvar=dict(random_seed=random_seed, zscore_mode=args.zscore_mode, variants=args.variants)
+        bcvar['timing_all'], bcvar['memory_regs']=load_trial_info(elfk_id,regressors)
+        if args.permutations > 0:
+            bcvar['permutations']=make_permutations(len(bcvar['memory_regs'][0]),args.permutations,random_seed)
+        runs=[load_zscored_run(sub_id,task)[0] for task in tasks]
+        bcvar['trial_operator']=make_trial_operator(bcvar['timing_all'],runs[0].shape[3],args.tr_length)
+
+        parcels, n_voxels, outputs=parcel_outputs(runs,atlas,mask,bcvar,n_outputs)
+        output_name=roi_output_name(sub_id,args.analysis_type,args.atlas,output_suffix)
+        roi_table(sub_id,parcels,n_voxels,outputs,labels,nulls,args.permutations,parcel_names).to_csv(output_name,
+                                                                                                     index=False)
+        print('Saved %d parcels for %s to %s' % (len(parcels),sub_id,output_name))
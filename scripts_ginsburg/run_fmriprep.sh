@@ -12,7 +12,12 @@
 # 1) define the participant object name to be input into the fMRIPrep function
 # ID number of subject you want to run; $1 is used when running a batch of participants
 # To run one subject, specify the specific ID number after the --participant flag (e.g. sub-PA001)
+# When submitted as a job array (submit_fmriprep.py), $1 is a list of participants and the array task ID picks the line
 subj=$1
+if [ -n "$SLURM_ARRAY_TASK_ID" ] && [ -f "$1" ]
+then
+    subj=`sed -n "$((SLURM_ARRAY_TASK_ID+1))p" $1`
+fi
 
 # 2) load the singularity software
 module load singularity
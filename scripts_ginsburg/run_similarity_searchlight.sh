@@ -3,16 +3,17 @@
 #SBATCH --account=psych
 #SBATCH --job-name=sim_searchlight
 #SBATCH --output=logs/sim_searchlight-%j
-#SBATCH -c 5
+#SBATCH -c 5 # the searchlight runs a pool of this many workers (SLURM_CPUS_PER_TASK)
 #SBATCH --time=3:59:00
 #SBATCH --mem=10gb
 
 # get the inputs
-sub=$1 # name of the subject
+sub=$1 # name of the subject (or several, e.g., 002,003,004, or a text file with one on each line, run one after the other)
 analysis_type=$2 # what type of analysis will you run? trialwise_detailed, trialwise_recognition, etc.  
+shift 2 # anything else (e.g., --zscore-mode analytic) gets passed along to the python script
 
 # activate the conda environment we need (contains the requirements outlined in the README) 
 conda activate brainiak
 
 # run the actual script 
-python scripts_ginsburg/Similarity_Searchlight.py $sub $analysis_type
\ No newline at end of file
+python scripts_ginsburg/Similarity_Searchlight.py $sub $analysis_type "$@"
\ No newline at end of file
@@ -0,0 +1,74 @@
+# Checkpoints for the similarity searchlight (Similarity_Searchlight.py)
+# A whole-brain run can hit the time limit of the job, so with --checkpoint every finished block (or chunk of rows,
+# for the sliding engine) is saved as it is done, as a small .npz with the centers and their outputs. A job that
+# is started again with the same subject, analysis and settings skips the finished blocks and puts the maps
+# together from the checkpoint. Any change to the settings or to the input files starts a new checkpoint
+# 10182026
+
+import os
+import json
+import hashlib
+import numpy as np
+from searchlight_data import output_path
+
+checkpoint_path='%s/checkpoints/' % output_path
+
+def checkpoint_dir(sub_id,analysis_type,settings):
+    # the checkpoint directory for a run with these settings (anything that changes the outputs should be in them,
+    # including the file_stamp of the inputs), made if it is not there yet
+    settings_json=json.dumps(settings,sort_keys=True)
+    settings_key=hashlib.sha1(settings_json.encode()).hexdigest()[:12]
+    run_dir='%s/%s_%s_%s/' %(checkpoint_path,sub_id,analysis_type,settings_key)
+    os.makedirs(run_dir,exist_ok=True)
+
+    # keep the settings with it so we know what it was
+    with open(run_dir+'settings.json','w') as f:
+        f.write(settings_json)
+
+    return run_dir
+
+def checkpoint_files(run_dir):
+    # the finished chunks (leaving out temporary files, including the .tmp.npz of older checkpoints)
+    return sorted(os.path.join(run_dir,f) for f in os.listdir(run_dir) if f.endswith('.npz') and
+                  not f.endswith('.tmp.npz'))
+
+def save_checkpoint(run_dir,name,units,chunk):
+    # save the result chunk (see searchlight_scheduler.py) of the finished units (blocks or rows, as rows of an
+    # int array)
+    # write to a temporary file first so a half-written checkpoint is never used (the name does not end in .npz,
+    # so a job killed while saving does not leave something that looks like a chunk)
+    file_name='%s/%s.npz' %(run_dir,name)
+    with open(file_name+'.tmp','wb') as f:
+        np.savez_compressed(f, units=np.array(units,dtype=np.int32), centers=chunk['centers'].astype(np.int16),
+                            values=chunk['values'], valid=chunk['valid'])
+    os.replace(file_name+'.tmp',file_name)
+
+def read_checkpoint(file_name):
+    # the contents of a chunk, or None (with a warning) if it cannot be read, so its units are run again
+    try:
+        with np.load(file_name) as checkpoint:
+            return {key: checkpoint[key] for key in ['units','centers','values','valid']}
+    except Exception as err:
+        print('WARNING: ignoring unreadable checkpoint %s (%s)' % (file_name,err))
+        return None
+
+def finished_units(run_dir):
+    # the units (block corners or rows) that are already in the checkpoint
+    finished=set()
+    for file_name in checkpoint_files(run_dir):
+        checkpoint=read_checkpoint(file_name)
+        if checkpoint is not None:
+            finished.update(tuple(int(u) for u in unit) for unit in checkpoint['units'])
+
+    return finished
+
+def load_checkpoint_chunks(run_dir):
+    # all of the result chunks in the checkpoint
+    chunks=[]
+    for file_name in checkpoint_files(run_dir):
+        checkpoint=read_checkpoint(file_name)
+        if checkpoint is not None:
+            chunks.append(dict(centers=checkpoint['centers'].astype(int), values=checkpoint['values'],
+                               valid=checkpoint['valid']))
+
+    return chunks
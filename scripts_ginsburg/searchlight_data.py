@@ -0,0 +1,242 @@
+# Loading functions for the similarity searchlight (Similarity_Searchlight.py)
+# Shared with the scripts that check the searchlight, so that everything reads the data the same way
+# 10182026
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+import nibabel as nib
+from nibabel.processing import conform
+from nilearn import image
+
+# define the path and some file names
+base_dir='' # ommitted for privacy
+mvpa_preproc_path='%s/mvpa_preproc_files/' % base_dir
+output_path='%s/similarity_searchlight/' % base_dir
+timing_path='%s/Ginsburg_Timing_Info/' % base_dir
+mask_file='/burg/psych/users/elfk/tsy2105/intersect_mask.nii.gz' # brain mask (intersect of all participants)
+cache_path='%s/mvpa_cache/' % base_dir # masked, z-scored copies of the preprocessed runs (see load_cached_run)
+
+# how much of a run (bytes, as stored) to read at a time when making the cache (a slab of slices, all time points)
+cache_slab_bytes=512*1024**2
+
+def get_tasks(sub_id):
+    # which tasks are we getting  -- note that one subject had rest run 3 instead of rest run 2
+    if sub_id == 'sub-141':
+        return ['memory_run-1','rest_run-1','rest_run-3']
+    else:
+        return ['memory_run-1','rest_run-1','rest_run-2']
+
+def trial_info_files(elfk_id):
+    # the timing of the encoding trials and the memory regressors of a participant
+    return '%s/%s_trial_timing.txt' %(timing_path,elfk_id), '%s/%s_memory_regressors.csv' %(timing_path,elfk_id)
+
+def load_trial_info(elfk_id,regressors):
+    # get the timing of the encoding trials and the memory regressors for a trialwise analysis
+    timing_file, memory_file=trial_info_files(elfk_id)
+
+    # first get the timing that we care about
+    timing_all=np.loadtxt(timing_file)
+
+    memory_regs=pd.read_csv(memory_file)
+
+    # then get the values for the specific types we are looking at (recognition, coarse, detailed)
+    memory_regs = [np.array(memory_regs[regressor]) for regressor in regressors]
+
+    return timing_all, memory_regs
+
+def run_file(sub_id,task):
+    # where is the preprocessed run?
+    return '%s/%s_task-%s_filtered_func_data.nii.gz' %(mvpa_preproc_path, sub_id, task)
+
+def load_zscored_run(sub_id,task,dtype='float64'):
+    # load a preprocessed run and zscore it over time (in float64, or float32 to halve the memory)
+    data_4d=nib.load(run_file(sub_id,task)) # load
+    data_4d_zscore = stats.zscore(data_4d.get_fdata(dtype=dtype),axis=3) # zscore over time
+
+    return data_4d_zscore, data_4d
+
+def load_zscored_slab(sub_id,task,x_start,x_end,dtype='float64'):
+    # the x slab [x_start, x_end) of a preprocessed run zscored over time, without reading the rest of the run into
+    # memory (every voxel is z-scored on its own, so this is that part of load_zscored_run)
+    data_4d=nib.load(run_file(sub_id,task))
+    slab=np.asarray(data_4d.dataobj[x_start:x_end],dtype=dtype)
+
+    return stats.zscore(slab,axis=3)
+
+def load_native_mask(data_4d):
+    # get brain mask (intersect of all participants) and put it in native space for running the searchlight
+    brain_nii=nib.load(mask_file)
+
+    brain_nii_native = conform(brain_nii, out_shape =data_4d.shape[:3],
+                                        voxel_size = (data_4d.affine[0,0],
+                                                      data_4d.affine[1,1],
+                                                      data_4d.affine[2,2])) # put in the same shape as native brain
+    brain_nii_native = image.binarize_img(brain_nii_native,threshold=0.1) # binarize the image
+
+    return brain_nii, brain_nii_native
+
+# the native space masks made so far, by grid (see cached_native_mask)
+native_masks=dict()
+
+def native_grid(data_4d):
+    # what putting something in native space depends on: the shape of the volume and the voxel size
+    return tuple(data_4d.shape[:3]), tuple(float(data_4d.affine[i,i]) for i in range(3))
+
+def cached_native_mask(data_4d):
+    # load_native_mask, made only once for every grid (so a queue of subjects on the same grid only does it once)
+    grid=native_grid(data_4d)
+    if grid not in native_masks:
+        native_masks[grid]=load_native_mask(data_4d)
+
+    return native_masks[grid]
+
+def load_native_atlas(atlas_file,data_4d):
+    # put a labelled atlas (integer labels, 0 for background) in native space the same way as the brain mask,
+    # but with nearest neighbour resampling so that the labels stay labels
+    atlas_nii=nib.load(atlas_file)
+
+    atlas_nii_native = conform(atlas_nii, out_shape =data_4d.shape[:3],
+                                        voxel_size = (data_4d.affine[0,0],
+                                                      data_4d.affine[1,1],
+                                                      data_4d.affine[2,2]),order=0)
+
+    return np.rint(atlas_nii_native.get_fdata()).astype(int)
+
+def load_atlas_names(labels_file):
+    # the names of the parcels of an atlas from a text file with a label and a name on each line (e.g., "17 Left
+    # Hippocampus"; lines starting with # are skipped)
+    parcel_names=dict()
+    with open(labels_file) as f:
+        for line in f:
+            fields=line.strip().split(None,1)
+            if len(fields)==2 and not fields[0].startswith('#'):
+                parcel_names[int(fields[0])]=fields[1]
+
+    return parcel_names
+
+def make_center_ids(shape):
+    # a volume of voxel indices so each searchlight knows which center it is (for the random streams)
+    return np.arange(np.prod(shape)).reshape(tuple(shape)+(1,))
+
+######################################################################################
+####### Cache of the masked, z-scored runs
+# Each run is saved once as an uncompressed voxel x time .npy (only the voxels in the native space mask, z-scored
+# over time) that can be memory-mapped, with the indices of those voxels in the volume as a second .npy and a .json
+# next to them saying where it came from. The cache is remade whenever the preprocessed run or the mask file changes
+
+def file_stamp(file_name):
+    # what we check to know whether a file has changed
+    file_stat=os.stat(file_name)
+    return dict(path=os.path.abspath(file_name), size=file_stat.st_size, mtime=file_stat.st_mtime)
+
+def cache_files(sub_id,task):
+    # where the cache of a run lives (the data, the voxels of the volume they are, and the information about it)
+    cache_root='%s/%s_task-%s_masked_zscore' %(cache_path,sub_id,task)
+    return cache_root+'.npy', cache_root+'_mask_indices.npy', cache_root+'.json'
+
+def cache_is_current(sub_id,task,dtype):
+    # is there a cache of this run that was made from the current run and mask files?
+    data_file, indices_file, info_file = cache_files(sub_id,task)
+    if not all(os.path.exists(file_name) for file_name in [data_file,indices_file,info_file]):
+        return False
+
+    with open(info_file) as f:
+        info=json.load(f)
+
+    return (info['source']==file_stamp(run_file(sub_id,task)) and info['mask']==file_stamp(mask_file)
+            and info['dtype']==np.dtype(dtype).name)
+
+def make_cached_run(sub_id,task,dtype='float64'):
+    # mask and z-score a run and save it to the cache
+    data_4d=nib.load(run_file(sub_id,task))
+    _, brain_nii_native = load_native_mask(data_4d)
+    mask=brain_nii_native.get_fdata()==1
+    mask_indices=np.flatnonzero(mask)
+
+    # which row of the cache each voxel of the mask goes in (in the order of mask_indices)
+    rows=np.full(mask.shape,-1,dtype=np.int64)
+    rows[mask]=np.arange(len(mask_indices))
+
+    # read the run a slab of slices at a time, keeping only the voxels in the mask and z-scoring them over time (so
+    # there is never a copy of the whole 4D run)
+    shape=data_4d.shape
+    slab_slices=max(1,cache_slab_bytes//(shape[0]*shape[1]*shape[3]*data_4d.get_data_dtype().itemsize))
+    masked_data=np.empty((len(mask_indices),shape[3]),dtype=dtype)
+    for z_start in range(0,shape[2],slab_slices):
+        slab_mask=mask[:,:,z_start:z_start+slab_slices]
+        if not slab_mask.any():
+            continue
+        slab=np.asarray(data_4d.dataobj[:,:,z_start:z_start+slab_slices,:])
+        masked_data[rows[:,:,z_start:z_start+slab_slices][slab_mask]]=stats.zscore(slab[slab_mask].astype(float),
+                                                                                   axis=1) # zscore over time
+        del slab
+
+    # write to temporary files first so a half-written cache is never used
+    os.makedirs(cache_path,exist_ok=True)
+    data_file, indices_file, info_file = cache_files(sub_id,task)
+    np.save(data_file+'.tmp.npy',masked_data)
+    np.save(indices_file+'.tmp.npy',mask_indices)
+    info=dict(source=file_stamp(run_file(sub_id,task)), mask=file_stamp(mask_file), dtype=np.dtype(dtype).name,
+              shape=list(data_4d.shape), affine=data_4d.affine.tolist())
+    with open(info_file+'.tmp','w') as f:
+        json.dump(info,f)
+    os.replace(data_file+'.tmp.npy',data_file)
+    os.replace(indices_file+'.tmp.npy',indices_file)
+    os.replace(info_file+'.tmp',info_file)
+
+def load_cached_run(sub_id,task,dtype='float64'):
+    # open the cache of a run (making it first if it is missing or out of date)
+    # returns a dictionary with the memory-mapped voxel x time data and where those voxels are in the volume
+    if not cache_is_current(sub_id,task,dtype):
+        print('Making the cache for %s %s' % (sub_id,task))
+        make_cached_run(sub_id,task,dtype)
+
+    data_file, indices_file, info_file = cache_files(sub_id,task)
+    with open(info_file) as f:
+        info=json.load(f)
+
+    return dict(data=np.load(data_file,mmap_mode='r'), mask_indices=np.load(indices_file),
+                shape=tuple(info['shape']), affine=np.array(info['affine']))
+
+def cached_run_volume(cached_run):
+    # put a cached run back into a 4D volume (zeros outside of the mask) for the searchlight
+    volume=np.zeros(cached_run['shape'],dtype=cached_run['data'].dtype)
+    volume.reshape(-1,cached_run['shape'][3])[cached_run['mask_indices']]=cached_run['data']
+
+    return volume
+
+def cached_run_block(cached_run,corner,block_shape):
+    # read only the part of a cached run inside a block of the volume (zeros outside the mask)
+    # only the rows of the memory-mapped data for voxels in the block are read from disk
+    shape=cached_run['shape']
+    if 'row_lookup' not in cached_run:
+        # which row of the cache each voxel is in (-1 for voxels outside of the mask)
+        row_lookup=np.full(int(np.prod(shape[:3])),-1,dtype=np.int64)
+        row_lookup[cached_run['mask_indices']]=np.arange(len(cached_run['mask_indices']))
+        cached_run['row_lookup']=row_lookup.reshape(shape[:3])
+
+    block=tuple(slice(c,c+s) for c, s in zip(corner,block_shape))
+    rows=cached_run['row_lookup'][block]
+    in_mask=rows>=0
+
+    block_data=np.zeros(rows.shape+(shape[3],),dtype=cached_run['data'].dtype)
+    block_data[in_mask]=cached_run['data'][rows[in_mask]]
+
+    return block_data
+
+def distribute_from_cache(sl,cached_runs,mask,my_blocks):
+    # what brainiak's Searchlight.distribute does, except every rank reads its own blocks (with the sl_rad
+    # padding around them) from the cache, instead of rank 0 loading everything and scattering it
+    # my_blocks are the blocks of sl._get_blocks(mask) this rank runs (see balance in searchlight_scheduler.py)
+    # NOTE: this sets the same attributes as distribute(), so it depends on how brainiak's Searchlight works inside
+    sl.mask=mask
+    sl.blocks=my_blocks
+    sl.submasks=[sl._get_block_data(mask,block) for block in my_blocks]
+    sl.subproblems=[[cached_run_block(cached_run,*block) for block in my_blocks] for cached_run in cached_runs]
+
+    # the voxel indices go last, like in the data list
+    center_ids=make_center_ids(mask.shape)
+    sl.subproblems.append([sl._get_block_data(center_ids,block) for block in my_blocks])
@@ -0,0 +1,83 @@
+# Optional profiling of the similarity searchlight (Similarity_Searchlight.py --profile)
+# The kernels mark where each stage starts and stops (reshaping and masking, the encoding trials, the correlations,
+# the thresholding, the z-scores, the permutation null) and count the centers they run and skip. This is all off
+# unless enable() is called: then start() is one check of a global and stop() returns straight away, so it can be
+# left in for real jobs. Pool workers send their profile back with their results (take) and each rank adds them to
+# its own (add), so rank 0 can gather one profile per rank and write them out as a report
+# 10182026
+
+import time
+
+enabled=False
+
+# this process's totals: seconds and calls for every stage, and the counts (e.g., centers, skipped_centers)
+stage_seconds=dict()
+stage_calls=dict()
+counts=dict()
+
+# whether a stage is being timed, stages inside of it are left to it (so the stages never overlap)
+timing=False
+
+def enable(on=True):
+    # turn the profiling on (or off) for this process (pool workers get it from the pool's initializer)
+    global enabled
+    enabled=on
+
+def start():
+    # start timing a stage (None when profiling is off, or when this is inside another stage)
+    global timing
+    if not enabled or timing:
+        return None
+    timing=True
+    return time.perf_counter()
+
+def stop(stage,started):
+    # stop timing the stage that start() returned started for
+    global timing
+    if started is None:
+        return
+    stage_seconds[stage]=stage_seconds.get(stage,0)+time.perf_counter()-started
+    stage_calls[stage]=stage_calls.get(stage,0)+1
+    timing=False
+
+def count(name,n=1):
+    # add to one of the counts
+    if enabled:
+        counts[name]=counts.get(name,0)+n
+
+def take():
+    # this process's profile so far, starting over (None when profiling is off)
+    if not enabled:
+        return None
+    profile=dict(stage_seconds=dict(stage_seconds), stage_calls=dict(stage_calls), counts=dict(counts))
+    for totals in [stage_seconds,stage_calls,counts]:
+        totals.clear()
+
+    return profile
+
+def add(profile):
+    # add a profile from take() (e.g., from a pool worker) to this process's
+    if profile is None:
+        return
+    for totals, name in [(stage_seconds,'stage_seconds'),(stage_calls,'stage_calls'),(counts,'counts')]:
+        for key, value in profile[name].items():
+            totals[key]=totals.get(key,0)+value
+
+def profile_report(rank_profiles):
+    # the report of a run from the profile of each rank (take() plus busy_seconds and wall_seconds, the time it
+    # spent running its centers and the time from the start of the searchlight to when every rank was done)
+    # adds each rank's idle time and the totals over the ranks, with the time per center of each stage
+    totals=dict(stage_seconds=dict(), stage_calls=dict(), counts=dict())
+    for profile in rank_profiles:
+        profile['idle_seconds']=profile['wall_seconds']-profile['busy_seconds']
+        for name in totals:
+            for key, value in profile[name].items():
+                totals[name][key]=totals[name].get(key,0)+value
+
+    n_centers=totals['counts'].get('centers',0)
+    totals['seconds_per_center']={stage: seconds/n_centers for stage, seconds in totals['stage_seconds'].items()
+                                  if n_centers > 0}
+    for name in ['busy_seconds','idle_seconds']:
+        totals[name]=sum(profile[name] for profile in rank_profiles)
+
+    return dict(n_ranks=len(rank_profiles), ranks=rank_profiles, totals=totals)
@@ -0,0 +1,289 @@
+# Scheduling for the similarity searchlight (Similarity_Searchlight.py)
+# Not every part of the volume costs the same: blocks at the edge of the brain have few centers, and centers with
+# fewer than 50 brain voxels return right away. This estimates the cost of every center from the mask, balances the
+# blocks (or rows, for the sliding engine) across the MPI ranks with those costs, and runs each rank's share on a
+# local pool of workers (the cores slurm gives the job) that read the data from shared memory instead of copies
+# 10182026
+
+import os
+import time
+import numpy as np
+from multiprocessing import Pool, shared_memory
+from scipy import ndimage
+from sliding_searchlight import searchlight_centers, run_sliding_searchlight
+import searchlight_profile
+
+# how much a center with too few voxels costs compared to a full kernel call (it only counts its voxels)
+skip_cost=0.01
+
+# how many chunks of rows each pool worker gets with the sliding engine (more chunks, better balance and
+# finer checkpoints)
+chunks_per_worker=16
+
+def default_pool_size(backend='mpi'):
+    # the cores slurm gave each task (-c in the sbatch script); outside of slurm, 1 per MPI rank, or all of the
+    # cores this process can use for the local backend
+    if 'SLURM_CPUS_PER_TASK' in os.environ:
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    return len(os.sched_getaffinity(0)) if backend == 'local' else 1
+
+######################################################################################
+####### Cost estimates and balancing
+
+def center_costs(mask,sl_rad,min_voxels=50):
+    # the relative cost of every searchlight center: 1 for a full kernel call, skip_cost for centers with fewer
+    # than min_voxels brain voxels in the cube, and 0 where there is no center
+    width=2*sl_rad+1
+    n_vox=np.rint(ndimage.uniform_filter((mask==1).astype(float),size=width,mode='constant')*width**3)
+    costs=np.where(n_vox>=min_voxels,1.0,skip_cost)
+    costs[~searchlight_centers(mask,sl_rad)]=0
+
+    return costs
+
+def block_costs(blocks,costs,sl_rad):
+    # the cost of each of brainiak's blocks ((corner, shape), with the sl_rad padding) is the cost of its centers
+    return np.array([costs[tuple(slice(c+sl_rad,c+s-sl_rad) for c, s in zip(corner,shape))].sum()
+                     for corner, shape in blocks])
+
+def balance(costs,n_parts):
+    # longest processing time first: hand out the most expensive items first, each to the part with the least work
+    # returns the items in each part (most expensive first) and the total cost of each part
+    parts=[[] for _ in range(n_parts)]
+    loads=np.zeros(n_parts)
+    for item in np.argsort(-np.asarray(costs),kind='stable'):
+        part=int(np.argmin(loads))
+        parts[part].append(int(item))
+        loads[part]+=costs[item]
+
+    return parts, loads
+
+def balance_report(predicted,busy,n_items):
+    # how even the work was across the ranks: the predicted cost and the time each rank spent working
+    # (the imbalance is the slowest rank over the average rank, so 1 is perfectly balanced)
+    predicted=np.asarray(predicted,dtype=float)
+    busy=np.asarray(busy,dtype=float)
+
+    return dict(n_ranks=len(busy), n_items=[int(n) for n in n_items], predicted_cost=predicted.tolist(),
+                busy_seconds=busy.tolist(),
+                predicted_imbalance=float(predicted.max()/predicted.mean()) if predicted.mean() > 0 else 1.0,
+                achieved_imbalance=float(busy.max()/busy.mean()) if busy.mean() > 0 else 1.0)
+
+######################################################################################
+####### Shared memory for the pool workers
+
+attached_memory=dict() # the blocks of shared memory this process has open, by name
+
+def attach_shared(name):
+    # open a block of shared memory (once per process)
+    if name not in attached_memory:
+        attached_memory[name]=shared_memory.SharedMemory(name=name)
+    return attached_memory[name]
+
+class SharedArray:
+    # a numpy array in shared memory that is pickled as just where it is, so a pool worker reads the one copy
+    # instead of being sent its own. Indexing it indexes the array, so it can stand in for a block of data
+    def __init__(self,name,shape,dtype,offset=0):
+        self.name=name
+        self.shape=tuple(shape)
+        self.ndim=len(self.shape)
+        self.dtype=np.dtype(dtype)
+        self.offset=offset
+
+    def __reduce__(self):
+        return (SharedArray,(self.name,self.shape,self.dtype.str,self.offset))
+
+    def array(self):
+        return np.ndarray(self.shape,dtype=self.dtype,buffer=attach_shared(self.name).buf,offset=self.offset)
+
+    def __getitem__(self,key):
+        return self.array()[key]
+
+def share_arrays(arrays):
+    # copy arrays into one block of shared memory (each starting on a 64 byte boundary)
+    # returns a SharedArray for each, and the block of memory to give to release_shared when done
+    arrays=[np.ascontiguousarray(array) for array in arrays]
+    offsets=np.cumsum([0]+[-(-array.nbytes//64)*64 for array in arrays])
+    memory=shared_memory.SharedMemory(create=True,size=max(int(offsets[-1]),1))
+    attached_memory[memory.name]=memory
+
+    shared=[]
+    for array, offset in zip(arrays,offsets):
+        shared_array=SharedArray(memory.name,array.shape,array.dtype,int(offset))
+        shared_array.array()[...]=array
+        shared.append(shared_array)
+
+    return shared, memory
+
+def release_shared(memory):
+    # free a block of shared memory made by share_arrays
+    attached_memory.pop(memory.name,None)
+    memory.close()
+    memory.unlink()
+
+def start_pool(pool_size):
+    # a pool of workers that profile (searchlight_profile.py) if this process does
+    return Pool(pool_size,initializer=searchlight_profile.enable,initargs=(searchlight_profile.enabled,))
+
+######################################################################################
+####### Results
+# The outputs of a set of centers are kept as a result chunk: a dictionary with the centers (n x 3), their outputs
+# (n x outputs, nan for centers with too few voxels) and whether each center has outputs (valid). The results of
+# the whole searchlight are the same for every voxel in the mask, in the order of np.where(mask)
+
+def result_chunk(center_outputs,n_outputs):
+    # turn (center, output) pairs (output is nan for centers with too few voxels) into a result chunk
+    centers=np.array([center for center, _ in center_outputs],dtype=int).reshape(-1,3)
+    valid=np.array([not np.isscalar(output) for _, output in center_outputs],dtype=bool)
+    values=np.full((len(center_outputs),n_outputs),np.nan)
+    if valid.any():
+        values[valid]=[output for _, output in center_outputs if not np.isscalar(output)]
+
+    return dict(centers=centers, values=values, valid=valid)
+
+def block_chunk(corner,outmat,sl_rad,n_outputs):
+    # the centers of one block (the object array from the block function, None where there is no center)
+    is_center=np.vectorize(lambda output: output is not None,otypes=[bool])(outmat)
+    return result_chunk([(np.array(corner)+sl_rad+idx,outmat[tuple(idx)]) for idx in np.argwhere(is_center)],
+                        n_outputs)
+
+def empty_results(mask,n_outputs):
+    # the results of the whole searchlight before anything is added: voxels x outputs of nan, which voxels have
+    # outputs, and a volume with the row of each voxel (-1 outside of the mask)
+    voxel_rows=np.full(mask.shape,-1,dtype=np.int64)
+    voxel_rows[mask==1]=np.arange(np.sum(mask==1))
+
+    return dict(values=np.full((np.sum(mask==1),n_outputs),np.nan), valid=np.zeros(np.sum(mask==1),dtype=bool),
+                voxel_rows=voxel_rows)
+
+def add_results(results,chunk):
+    # put a result chunk into the results of the whole searchlight
+    rows=results['voxel_rows'][tuple(chunk['centers'].T)]
+    results['values'][rows]=chunk['values']
+    results['valid'][rows]=chunk['valid']
+
+######################################################################################
+####### brainiak engine
+
+def scatter_blocks(sl,data,mask,rank_blocks,comm):
+    # what brainiak's Searchlight.distribute does, but each rank gets the blocks it was given by balance
+    # (rank 0 has all of the data and sends every rank its blocks, with the sl_rad padding around them)
+    # NOTE: this sets the same attributes as distribute(), so it depends on how brainiak's Searchlight works inside
+    if comm.rank == 0:
+        subproblems=[[[sl._get_block_data(d,block) for block in blocks] for d in data] for blocks in rank_blocks]
+    else:
+        subproblems=None
+
+    sl.mask=mask
+    sl.blocks=rank_blocks[comm.rank]
+    sl.submasks=[sl._get_block_data(mask,block) for block in sl.blocks]
+    sl.subproblems=comm.scatter(subproblems,root=0)
+
+def share_blocks(sl):
+    # move this rank's blocks into shared memory, so the pool workers are not each sent a copy of them
+    # returns the block of memory to give to release_shared when done (None if this rank has no blocks)
+    n_blocks=len(sl.blocks)
+    if n_blocks == 0:
+        return None
+    shared, memory=share_arrays([block for subproblem in sl.subproblems for block in subproblem])
+    sl.subproblems=[shared[start:start+n_blocks] for start in range(0,len(shared),n_blocks)]
+
+    return memory
+
+def run_block(indexed_args):
+    # run one block and turn its centers into a result chunk, keeping track of which block it was
+    # (and sending back the worker's profile, if it is profiling)
+    idx, block_fn, block_args, corner, n_outputs=indexed_args
+    chunk=block_chunk(corner,block_fn(*block_args),block_args[2],n_outputs)
+    return idx, chunk, searchlight_profile.take()
+
+def run_blocks(sl,voxel_fn,n_outputs,pool_size=1,block_done=None,block_fn=None):
+    # brainiak's run_searchlight, except that the blocks are run in the order they were given (most expensive
+    # first) by a pool that hands them out one at a time, and the outputs come back as float arrays
+    # returns the results on rank 0 (see empty_results; None on the other ranks), and how long this rank spent on
+    # its blocks (before waiting for the other ranks to gather the results on rank 0)
+    # block_done(block, chunk) is called as each block finishes (e.g., to save a checkpoint)
+    # block_fn runs the centers of one block, brainiak's _singlenode_searchlight by default
+    # (local_searchlight.singlenode_searchlight for the local backend)
+    # NOTE: like scatter_blocks, this follows how brainiak's Searchlight works inside
+    if block_fn is None:
+        from brainiak.searchlight.searchlight import _singlenode_searchlight as block_fn
+
+    extra_params=(voxel_fn,sl.shape,sl.min_active_voxels_proportion)
+    block_args=[(idx,block_fn,([subproblem[idx] for subproblem in sl.subproblems],sl.submasks[idx],sl.sl_rad,
+                               sl.bcast_var,extra_params),block[0],n_outputs) for idx, block in enumerate(sl.blocks)]
+
+    start=time.perf_counter()
+    chunks=[None]*len(block_args)
+    pool=start_pool(pool_size) if pool_size > 1 else None
+    try:
+        finished=(pool.imap_unordered if pool is not None else map)(run_block,block_args)
+        for idx, chunk, worker_profile in finished:
+            searchlight_profile.add(worker_profile)
+            chunks[idx]=chunk
+            if block_done is not None:
+                block_done(sl.blocks[idx],chunk)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    busy=time.perf_counter()-start
+
+    # put it together on rank 0
+    all_chunks=sl.comm.gather(chunks)
+    results=None
+    if sl.comm.rank == 0:
+        results=empty_results(sl.mask,n_outputs)
+        for rank_chunks in all_chunks:
+            for chunk in rank_chunks:
+                add_results(results,chunk)
+
+    return results, busy
+
+######################################################################################
+####### sliding engine
+
+def sliding_rows(worker_args):
+    # run_sliding_searchlight in a pool worker, on data in shared memory (returns the rows with their result chunk,
+    # and the worker's profile)
+    shared_enc, shared_rest, mask, sl_rad, center_fn, rows, n_outputs=worker_args
+    chunk=result_chunk(run_sliding_searchlight(shared_enc.array(),[rest.array() for rest in shared_rest],
+                                               mask,sl_rad,center_fn,rows=rows),n_outputs)
+    return rows, chunk, searchlight_profile.take()
+
+def run_sliding_pool(enc_trials,rest_data,mask,sl_rad,center_fn,rows,n_outputs,pool_size=1,costs=None,
+                     chunk_done=None):
+    # run_sliding_searchlight on a pool of workers: the rows are balanced into chunks of about the same cost
+    # (handed out most expensive first), and the workers read the data from shared memory
+    # center_fn has to be picklable (e.g., functools.partial of a module level function)
+    # returns a list of result chunks (with the centers in the coordinates of the data given)
+    # chunk_done(rows, chunk) is called as each chunk finishes (e.g., to save a checkpoint)
+    if pool_size <= 1 and chunk_done is None:
+        return [result_chunk(run_sliding_searchlight(enc_trials,rest_data,mask,sl_rad,center_fn,rows=rows),n_outputs)]
+
+    if costs is None:
+        costs=center_costs(mask,sl_rad)
+    row_chunks, _ = balance([costs[i,j].sum() for (i,j) in rows],max(pool_size,1)*chunks_per_worker)
+    row_chunks=[[rows[r] for r in sorted(row_chunk)] for row_chunk in row_chunks if row_chunk]
+
+    chunks=[]
+    if pool_size <= 1:
+        for row_chunk in row_chunks:
+            chunk=result_chunk(run_sliding_searchlight(enc_trials,rest_data,mask,sl_rad,center_fn,rows=row_chunk),
+                               n_outputs)
+            chunk_done(row_chunk,chunk)
+            chunks.append(chunk)
+        return chunks
+
+    shared, memory=share_arrays([enc_trials]+list(rest_data))
+    try:
+        with start_pool(pool_size) as pool:
+            finished=pool.imap_unordered(sliding_rows,[(shared[0],shared[1:],mask,sl_rad,center_fn,row_chunk,
+                                                        n_outputs) for row_chunk in row_chunks])
+            for row_chunk, chunk, worker_profile in finished:
+                searchlight_profile.add(worker_profile)
+                if chunk_done is not None:
+                    chunk_done(row_chunk,chunk)
+                chunks.append(chunk)
+    finally:
+        release_shared(memory)
+
+    return chunks
@@ -0,0 +1,158 @@
+# Sliding searchlight for the trial x TR reinstatement correlations (an alternative to brainiak's Searchlight)
+# Neighbouring centers share most of their voxels, so instead of rebuilding every searchlight cube this walks the
+# centers of each row in scan order and keeps running sums over the voxels inside the cube (the sum and sum of
+# squares of every pattern, and the trial x TR cross-products), adding the slab of voxels that enters the cube and
+# removing the slab that leaves it. The Pearson correlations across voxels are then finished from those sums, which
+# costs trials x TRs per center instead of voxels x trials x TRs
+# 10182026
+
+import numpy as np
+import searchlight_profile
+
+def searchlight_centers(mask,sl_rad):
+    # the centers brainiak's Searchlight runs: in the mask and at least the radius away from the edge of the volume
+    inner_mask=np.zeros(mask.shape,dtype=bool)
+    inner=(slice(sl_rad,mask.shape[0]-sl_rad),slice(sl_rad,mask.shape[1]-sl_rad),slice(sl_rad,mask.shape[2]-sl_rad))
+    inner_mask[inner]=mask[inner]==1
+
+    return inner_mask
+
+def searchlight_rows(mask,sl_rad):
+    # the (x, y) rows that have at least one searchlight center, in scan order
+    return [tuple(row) for row in np.argwhere(searchlight_centers(mask,sl_rad).any(axis=2))]
+
+def split_rows(mask,sl_rad,n_parts,costs=None):
+    # split the rows into n_parts runs of neighbouring rows with about the same number of centers in each
+    # (so each part only needs a slab of the volume, plus the radius on either side)
+    # costs is an optional volume of how long each center takes (e.g., center_costs in searchlight_scheduler.py)
+    rows=searchlight_rows(mask,sl_rad)
+    if costs is None:
+        costs=searchlight_centers(mask,sl_rad)
+    n_centers=np.array([costs[i,j].sum() for (i,j) in rows],dtype=float)
+    bounds=np.searchsorted(np.cumsum(n_centers),np.arange(1,n_parts)*n_centers.sum()/n_parts)
+
+    return [rows[start:end] for start, end in zip(np.r_[0,bounds],np.r_[bounds,len(rows)])]
+
+def pattern_sums(slab):
+    # the sums over voxels of one slab (voxels x patterns) for each pattern
+    # nans are counted and left out of the sums, brainiak's compute_correlation sets those patterns to 0 anyway
+    nans=np.isnan(slab)
+    slab=np.where(nans,0,slab)
+
+    return slab, dict(sum=slab.sum(axis=0), sum_sq=(slab**2).sum(axis=0), n_nan=nans.sum(axis=0))
+
+def slab_sums(enc_slab,rest_slabs):
+    # everything a slab of voxels adds to the running sums of the cube
+    enc_slab, enc_sums=pattern_sums(enc_slab)
+    sums=dict(n_vox=enc_slab.shape[0], enc=enc_sums, rest=[], cross=[])
+    for rest_slab in rest_slabs:
+        rest_slab, rest_sums=pattern_sums(rest_slab)
+        sums['rest'].append(rest_sums)
+        sums['cross'].append(enc_slab.T @ rest_slab) # trials x TRs
+
+    return sums
+
+def add_sums(running,sums,sign=1):
+    # add (or with sign=-1, remove) a slab's sums to the running sums
+    if running is None:
+        running=dict(n_vox=0, enc={key: np.zeros_like(val,dtype=float) for key, val in sums['enc'].items()},
+                     rest=[{key: np.zeros_like(val,dtype=float) for key, val in rest_sums.items()}
+                           for rest_sums in sums['rest']],
+                     cross=[np.zeros_like(cross,dtype=float) for cross in sums['cross']])
+
+    running['n_vox']+=sign*sums['n_vox']
+    for key in running['enc']:
+        running['enc'][key]+=sign*sums['enc'][key]
+    for r, rest_sums in enumerate(sums['rest']):
+        for key in rest_sums:
+            running['rest'][r][key]+=sign*rest_sums[key]
+        running['cross'][r]+=sign*sums['cross'][r]
+
+    return running
+
+def finish_correlation(n_vox,sums_1,sums_2,cross):
+    # Pearson correlation of every pattern in sums_1 with every pattern in sums_2, across the voxels in the cube
+    # like brainiak's compute_correlation: float32 out, and 0 for patterns with nans or no variance
+    var_1=sums_1['sum_sq']-sums_1['sum']**2/n_vox
+    var_2=sums_2['sum_sq']-sums_2['sum']**2/n_vox
+    cov=cross-np.outer(sums_1['sum'],sums_2['sum'])/n_vox
+
+    # patterns that brainiak would zero out (allowing for rounding when the variance should be 0)
+    bad_1=(sums_1['n_nan']>0) | (var_1<=1e-10*np.maximum(sums_1['sum_sq'],1))
+    bad_2=(sums_2['n_nan']>0) | (var_2<=1e-10*np.maximum(sums_2['sum_sq'],1))
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        corr=cov/np.sqrt(np.outer(var_1,var_2))
+    corr[bad_1,:]=0
+    corr[:,bad_2]=0
+
+    return corr.astype(np.float32)
+
+def run_sliding_searchlight(enc_trials,rest_data,mask,sl_rad,center_fn,rows=None,min_voxels=50):
+    # run center_fn(center, correlations) at every searchlight center in the given rows (default: all of them)
+    # enc_trials is the x by y by z by trial encoding data, rest_data a list of x by y by z by TR rest runs
+    # and correlations the trial x TR correlation matrix for each rest run (as if it came from compute_correlation)
+    # the searchlight is brainiak's Cube, so the cube is only limited by the mask
+    # returns a list of (center, output), with nan output for centers with fewer than min_voxels brain voxels
+
+    centers=searchlight_centers(mask,sl_rad)
+    if rows is None:
+        rows=searchlight_rows(mask,sl_rad)
+    width=2*sl_rad+1
+
+    results=[]
+    for (i,j) in rows:
+        ks=np.where(centers[i,j,:])[0]
+        if len(ks)==0:
+            continue
+
+        # everything in the row that the cube will pass over
+        row_slice=np.s_[i-sl_rad:i+sl_rad+1,j-sl_rad:j+sl_rad+1]
+        row_mask=mask[row_slice]==1
+        row_enc=enc_trials[row_slice]
+        row_rest=[rest[row_slice] for rest in rest_data]
+
+        # the sums for each slab (z plane of the cube) are used once when it enters and once when it leaves
+        slab_cache=dict()
+        def get_slab(z):
+            if z not in slab_cache:
+                slab_mask=row_mask[:,:,z]
+                slab_cache[z]=slab_sums(row_enc[:,:,z][slab_mask],[rest[:,:,z][slab_mask] for rest in row_rest])
+            return slab_cache[z]
+
+        running=None
+        current_k=None
+        for k in ks:
+            started=searchlight_profile.start()
+            if running is None or k-current_k >= width:
+                # start over (beginning of the row, or the next center shares no voxels with this one)
+                running=None
+                current_k=k
+                for z in range(k-sl_rad,k+sl_rad+1):
+                    running=add_sums(running,get_slab(z))
+            else:
+                # slide the cube along the row one step at a time
+                while current_k < k:
+                    current_k+=1
+                    running=add_sums(running,get_slab(current_k-sl_rad-1),sign=-1)
+                    running=add_sums(running,get_slab(current_k+sl_rad))
+
+            # drop the slabs the cube has left behind
+            for z in [z for z in slab_cache if z < current_k-sl_rad]:
+                del slab_cache[z]
+            searchlight_profile.stop('slide',started)
+
+            # finish the correlations if there are enough brain voxels
+            center=(i,j,k)
+            searchlight_profile.count('centers')
+            if running['n_vox'] >= min_voxels:
+                started=searchlight_profile.start()
+                correlations=[finish_correlation(running['n_vox'],running['enc'],rest_sums,cross)
+                              for rest_sums, cross in zip(running['rest'],running['cross'])]
+                searchlight_profile.stop('correlate',started)
+                results.append((center,center_fn(center,correlations)))
+            else:
+                searchlight_profile.count('skipped_centers')
+                results.append((center,np.nan))
+
+    return results
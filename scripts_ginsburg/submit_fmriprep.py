@@ -0,0 +1,189 @@
+# Submit the participants in elfk_mem_sublist.txt to fMRIPrep as a slurm job array (instead of supervisor_fmriprep.sh,
+# which submits one job every 10 minutes)
+# Participants whose fMRIPrep outputs are already there, or who are still queued or running from an earlier
+# submission, are left out, and the rest are submitted as one array (run_fmriprep.sh reads its participant from the
+# list with SLURM_ARRAY_TASK_ID) with at most --max-running of them running at once. The resources are the #SBATCH
+# settings of run_fmriprep.sh. Running this again later (or once with --watch, which waits for the array to finish)
+# resubmits only the participants whose jobs ended without outputs, up to --max-attempts times each. Every submission
+# is recorded in logs/fmriprep_submissions.json. The sbatch and squeue commands can be swapped (--sbatch, --squeue),
+# e.g., for stand-ins that do not need slurm
+#
+# example command: python scripts_ginsburg/submit_fmriprep.py elfk_mem_sublist.txt --max-running 20 --watch
+#
+# 10182026
+
+import os
+import glob
+import json
+import time
+import shlex
+import argparse
+import datetime
+import subprocess
+
+base_dir='' # ommitted for privacy
+fmriprep_path='%s/fmriprep_memory' % base_dir
+run_script='%s/scripts_ginsburg/run_fmriprep.sh' % base_dir
+submissions_file='logs/fmriprep_submissions.json'
+
+# the longest array slurm takes (MaxArraySize in slurm.conf), bigger lists are split over several arrays
+max_array_size=1000
+
+def participant_label(sub):
+    # the label fMRIPrep uses (without sub-)
+    return sub[len('sub-'):] if sub.startswith('sub-') else sub
+
+def load_participants(sublist_file):
+    with open(sublist_file) as f:
+        return f.read().split()
+
+def is_finished(sub):
+    # fMRIPrep writes the participant's report when it is done, and the preprocessed runs are in func/
+    label=participant_label(sub)
+    return os.path.exists('%s/sub-%s.html' %(fmriprep_path,label)) and \
+        len(glob.glob('%s/sub-%s/func/*_desc-preproc_bold.nii.gz' %(fmriprep_path,label))) > 0
+
+def job_resources(script_file):
+    # the #SBATCH settings of a job script, as sbatch options (e.g., ['--account=psych','-c','12'])
+    options=[]
+    with open(script_file) as f:
+        for line in f:
+            if line.startswith('#SBATCH'):
+                options+=shlex.split(line[len('#SBATCH'):],comments=True)
+
+    return options
+
+def array_options(resources):
+    # the settings of run_fmriprep.sh for a job array: the log of each participant gets the array and task IDs
+    options=[]
+    for option in resources:
+        if option.startswith('--output='):
+            option=option.replace('%j','%A_%a')
+        options.append(option)
+
+    return options
+
+def parse_squeue(output):
+    # the jobs in the output of squeue -h -o '%i %T': job ID -> {array task: state}, where pending tasks that have not
+    # been split off yet are shown as a range (e.g., 1234_[3-9%20] PENDING)
+    jobs=dict()
+    for line in output.splitlines():
+        if line.strip()=='':
+            continue
+        job, state=line.split()[:2]
+        job_id, _, tasks=job.partition('_')
+        tasks=tasks.split('%')[0].strip('[]')
+        task_ids=[]
+        for part in tasks.split(',') if tasks != '' else []:
+            start, _, stop=part.partition('-')
+            task_ids+=list(range(int(start),int(stop if stop != '' else start)+1))
+        for task_id in task_ids if len(task_ids) > 0 else [None]:
+            jobs.setdefault(job_id,dict())[task_id]=state
+
+    return jobs
+
+def active_participants(submissions,squeue):
+    # the participants whose jobs are still queued or running
+    if len(submissions)==0:
+        return set()
+    # (all of this user's jobs, since squeue -j fails for jobs that have left the queue)
+    output=subprocess.run(shlex.split(squeue)+['-h','-u',os.environ.get('USER',''),'-o','%i %T'],capture_output=True,
+                          text=True,check=True).stdout
+    jobs=parse_squeue(output)
+
+    active=set()
+    for submission in submissions:
+        tasks=jobs.get(submission['job_id'],dict())
+        for task_id, sub in enumerate(submission['participants']):
+            if task_id in tasks or None in tasks:
+                active.add(sub)
+
+    return active
+
+def submit_array(participants,max_running,resources,sbatch,dry_run=False):
+    # submit one array for the participants (with a list of them for run_fmriprep.sh to read); returns the job ID
+    os.makedirs('logs',exist_ok=True)
+    list_file=os.path.abspath('logs/fmriprep_array_%s.txt' % datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f'))
+    if not dry_run:
+        with open(list_file,'w') as f:
+            f.write('\n'.join(participants)+'\n')
+
+    command=shlex.split(sbatch)+['--parsable','--array=0-%d%%%d' %(len(participants)-1,max_running)]+\
+        array_options(resources)+[run_script,list_file]
+    print(' '.join(command))
+    if dry_run:
+        return None
+
+    # --parsable prints the job ID (and the cluster, after a ;)
+    return subprocess.run(command,capture_output=True,text=True,check=True).stdout.strip().split(';')[0]
+
+def load_submissions():
+    if os.path.exists(submissions_file):
+        with open(submissions_file) as f:
+            return json.load(f)
+    return []
+
+def save_submissions(submissions):
+    os.makedirs(os.path.dirname(submissions_file),exist_ok=True)
+    with open(submissions_file+'.tmp','w') as f:
+        json.dump(submissions,f,indent=1)
+    os.replace(submissions_file+'.tmp',submissions_file)
+
+def submit_unfinished(participants,max_running=20,max_attempts=3,sbatch='sbatch',squeue='squeue',dry_run=False,
+                      extra_options=()):
+    # submit the participants that are not finished, queued, or running (and have not run out of attempts)
+    # returns how many are finished, active, submitted, and given up on
+    submissions=load_submissions()
+    active=active_participants(submissions,squeue)
+    attempts=dict()
+    for submission in submissions:
+        for sub in submission['participants']:
+            attempts[sub]=attempts.get(sub,0)+1
+
+    finished=[sub for sub in participants if is_finished(sub)]
+    unfinished=[sub for sub in participants if sub not in finished and sub not in active]
+    to_submit=[sub for sub in unfinished if attempts.get(sub,0) < max_attempts]
+    given_up=[sub for sub in unfinished if attempts.get(sub,0) >= max_attempts]
+    if len(given_up) > 0:
+        print('Not resubmitting (failed %d times, see their logs): %s' % (max_attempts,' '.join(given_up)))
+
+    resources=job_resources(run_script)+list(extra_options)
+    for start in range(0,len(to_submit),max_array_size):
+        array=to_submit[start:start+max_array_size]
+        job_id=submit_array(array,max_running,resources,sbatch,dry_run)
+        if job_id is not None:
+            submissions.append(dict(job_id=job_id, participants=array,
+                                    submitted=datetime.datetime.now().isoformat(timespec='seconds'),
+                                    retries=[sub for sub in array if attempts.get(sub,0) > 0]))
+            save_submissions(submissions)
+            print('Submitted %d participants as job %s' % (len(array),job_id))
+
+    return dict(finished=len(finished), active=len(active), submitted=len(to_submit), given_up=len(given_up))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Submit participants to fMRIPrep as a slurm job array')
+    parser.add_argument('sublist', nargs='?', default='elfk_mem_sublist.txt',
+                        help='text file with a participant on each line (default: elfk_mem_sublist.txt)')
+    parser.add_argument('--max-running', default=20, type=int, help='participants running at once (default: 20)')
+    parser.add_argument('--max-attempts', default=3, type=int,
+                        help='times to submit a participant before giving up (default: 3)')
+    parser.add_argument('--watch', action='store_true',
+                        help='wait for the jobs to finish and resubmit the ones that fail, until all are done')
+    parser.add_argument('--poll-minutes', default=10, type=float, help='how often to check with --watch (default: 10)')
+    parser.add_argument('--sbatch-option', action='append', default=[],
+                        help='extra sbatch options, after the ones in run_fmriprep.sh '
+                             '(e.g., --sbatch-option=--time=23:59:00)')
+    parser.add_argument('--sbatch', default='sbatch', help='command to submit jobs (default: sbatch)')
+    parser.add_argument('--squeue', default='squeue', help='command to list jobs (default: squeue)')
+    parser.add_argument('--dry-run', action='store_true', help='print the sbatch commands without running them')
+    args = parser.parse_args()
+
+    participants=load_participants(args.sublist)
+    while True:
+        counts=submit_unfinished(participants,args.max_running,args.max_attempts,args.sbatch,args.squeue,args.dry_run,
+                                 args.sbatch_option)
+        print('%d of %d participants finished, %d queued or running, %d submitted, %d given up on' % (
+            counts['finished'],len(participants),counts['active'],counts['submitted'],counts['given_up']))
+        if not args.watch or args.dry_run or counts['active']+counts['submitted']==0:
+            break
+        time.sleep(args.poll_minutes*60)
@@ -0,0 +1,108 @@
+# Make a synthetic participant for trying out (and benchmarking) the similarity searchlight without real data
+# This writes the files the searchlight reads, in the same layout as base_dir in searchlight_data.py: the three
+# preprocessed runs, a brain mask, the trial timing and the memory regressors. The encoding run has a random
+# pattern for every trial, and the rest runs replay some of those patterns (post-encoding rest replays the
+# remembered trials more), so the searchlight finds something. Everything comes from one seed, so the same sizes
+# and seed always give the same files
+#
+# example command: python scripts_ginsburg/synthetic_data.py /tmp/synthetic 002 --shape 40 48 40 --n-trs 150
+#
+# 10182026
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+def brain_mask(shape):
+    # an ellipsoid that fills most of the volume
+    grid=np.meshgrid(*[np.linspace(-1,1,s) for s in shape],indexing='ij')
+    return (sum(g**2 for g in grid) <= 0.85).astype(np.uint8)
+
+def trial_timing(n_trials,n_TRs,tr_length=2,duration=4):
+    # onsets and durations of the encoding trials, spread evenly over the run (like *_trial_timing.txt)
+    onsets=np.linspace(2*tr_length,(n_TRs-1)*tr_length-duration,n_trials).round()
+
+    return np.column_stack([onsets,np.full(n_trials,float(duration)),np.ones(n_trials)])
+
+def synthetic_runs(shape,n_TRs,timing,remembered,rng,tr_length=2,replay_rate=(0.05,0.15),noise=1.0):
+    # the encoding run and the pre and post rest runs (x by y by z by TR, float32)
+    # a trial's pattern is there for the TRs of the trial, and is replayed at some rest TRs (at replay_rate[0] in
+    # pre rest, and at replay_rate[1] in post rest if the trial was remembered)
+    n_voxels=int(np.prod(shape))
+    patterns=rng.standard_normal((len(timing),n_voxels)).astype(np.float32)
+
+    encoding=np.zeros((n_TRs,len(timing)),dtype=np.float32)
+    for i, (onset, duration) in enumerate(timing[:,:2]):
+        encoding[int(onset/tr_length):int((onset+duration)/tr_length),i]=1
+
+    runs=[encoding]
+    for rate in replay_rate:
+        trial_rates=np.where(remembered==1,rate,replay_rate[0])
+        runs.append((rng.random((n_TRs,len(timing))) < trial_rates).astype(np.float32))
+
+    volumes=[]
+    for weights in runs:
+        data=weights @ patterns + noise*rng.standard_normal((n_TRs,n_voxels),dtype=np.float32)
+        volumes.append((data.T.reshape(tuple(shape)+(n_TRs,))+100).astype(np.float32))
+
+    return volumes
+
+def make_synthetic_subject(data_dir,sub='002',shape=(30,36,30),n_TRs=150,n_trials=40,voxel_size=3.0,tr_length=2,
+                           seed=0):
+    # write a synthetic participant to data_dir (laid out like base_dir) and return the settings it was made with
+    # the mask is only written if it is not there yet, so several participants can share it
+    settings=dict(sub=sub, shape=list(shape), n_TRs=n_TRs, n_trials=n_trials, voxel_size=voxel_size,
+                  tr_length=tr_length, seed=seed)
+    for folder in ['mvpa_preproc_files','Ginsburg_Timing_Info','similarity_searchlight']:
+        os.makedirs('%s/%s' %(data_dir,folder),exist_ok=True)
+    rng=np.random.default_rng([seed,int(sub)])
+    affine=np.diag([voxel_size,voxel_size,voxel_size,1])
+
+    mask_file='%s/mask.nii.gz' % data_dir
+    if not os.path.exists(mask_file):
+        nib.save(nib.Nifti1Image(brain_mask(shape),affine),mask_file)
+
+    # the trials, and which were remembered for each memory regressor
+    timing=trial_timing(n_trials,n_TRs,tr_length)
+    np.savetxt('%s/Ginsburg_Timing_Info/EL%s_trial_timing.txt' %(data_dir,sub),timing)
+    memory_regs=pd.DataFrame({regressor: rng.integers(0,2,n_trials) for regressor in ['detailed','coarse',
+                                                                                       'recognition']})
+    memory_regs.to_csv('%s/Ginsburg_Timing_Info/EL%s_memory_regressors.csv' %(data_dir,sub),index=False)
+
+    for task, volume in zip(['memory_run-1','rest_run-1','rest_run-2'],
+                            synthetic_runs(shape,n_TRs,timing,memory_regs['detailed'].values,rng,tr_length)):
+        run_nii=nib.Nifti1Image(volume,affine)
+        run_nii.header.set_zooms((voxel_size,)*3+(tr_length,))
+        nib.save(run_nii,'%s/mvpa_preproc_files/sub-%s_task-%s_filtered_func_data.nii.gz' %(data_dir,sub,task))
+
+    with open('%s/synthetic_sub-%s.json' %(data_dir,sub),'w') as f:
+        json.dump(settings,f,indent=1)
+
+    return settings
+
+def point_to(data_dir):
+    # make searchlight_data.py read from (and write to) data_dir instead of base_dir
+    import searchlight_data
+    searchlight_data.base_dir=data_dir
+    searchlight_data.mvpa_preproc_path='%s/mvpa_preproc_files/' % data_dir
+    searchlight_data.output_path='%s/similarity_searchlight/' % data_dir
+    searchlight_data.timing_path='%s/Ginsburg_Timing_Info/' % data_dir
+    searchlight_data.mask_file='%s/mask.nii.gz' % data_dir
+    searchlight_data.cache_path='%s/mvpa_cache/' % data_dir
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make synthetic participants for the similarity searchlight')
+    parser.add_argument('data_dir', help='where to write them (laid out like base_dir)')
+    parser.add_argument('sub_ids', nargs='+', help='participant ID numbers, e.g., 002 003')
+    parser.add_argument('--shape', nargs=3, type=int, default=[30,36,30], help='size of the volume (default: 30 36 30)')
+    parser.add_argument('--n-trs', default=150, type=int, help='TRs per run (default: 150)')
+    parser.add_argument('--n-trials', default=40, type=int, help='encoding trials (default: 40)')
+    parser.add_argument('--seed', default=0, type=int, help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    for sub in args.sub_ids:
+        make_synthetic_subject(args.data_dir,sub,args.shape,args.n_trs,args.n_trials,seed=args.seed)
+        print('Made sub-%s in %s' % (sub,args.data_dir))